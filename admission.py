@@ -0,0 +1,240 @@
+"""Process-wide admission control for invoice extraction.
+
+Every extraction (one invoice, one micro-batch or one streamed invoice) holds one of
+settings.extraction_max_in_flight slots while it renders pages and calls Claude, no
+matter which request, job or helper script started it. Cache and near-duplicate hits
+never take a slot.
+
+Waiting extractions queue per client (the API's X-Client-Id header or the caller's
+address; background jobs queue as "job:<id>"). A freed slot goes to the clients in
+turn, so one large batch cannot starve everyone else. The API rejects new requests
+with 429 + Retry-After while settings.extraction_max_queue invoices are already
+waiting. Admission is checked once per request: a streamed batch upload does not know
+its file count up front, so its files join the queue one by one as they arrive (the
+API caps a batch at extraction_max_queue files).
+
+Like the rate limiter, state is guarded by a threading lock and waiters are woken on
+their own event loop, so one controller serves the API loop and the sync background
+loop alike.
+"""
+import asyncio
+import contextvars
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, Optional
+
+from config import settings
+
+# Who the current extraction is for; set by the API endpoints and the job runner
+_client: contextvars.ContextVar[str] = contextvars.ContextVar("admission_client", default="local")
+# True while the current task tree holds a slot (fallbacks inside a micro-batch reuse it)
+_holding: contextvars.ContextVar[bool] = contextvars.ContextVar("admission_holding", default=False)
+
+RECENT_WAITS = 1000
+
+
+class QueueFull(Exception):
+    """Raised by `AdmissionController.check` when new work should be rejected."""
+
+    def __init__(self, queue_depth: int, retry_after: int):
+        super().__init__(f"Extraction queue is full ({queue_depth} invoices waiting)")
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+
+
+@dataclass
+class _Waiter:
+    loop: asyncio.AbstractEventLoop
+    future: "asyncio.Future[None]"
+    client: str
+    enqueued: float = field(default_factory=time.monotonic)
+    granted: bool = False
+
+
+class AdmissionController:
+    """Global in-flight limit with a bounded, per-client round-robin wait queue."""
+
+    def __init__(self, max_in_flight: int, max_queue: int):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._waiting = 0
+        # client -> its waiters; the first client is served next, then moves to the end
+        self._queues: "OrderedDict[str, Deque[_Waiter]]" = OrderedDict()
+        self._avg_hold = 0.0
+        self._recent_waits: Deque[float] = deque(maxlen=RECENT_WAITS)
+        self._stats: Dict[str, float] = {
+            "granted": 0,
+            "waited": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+            "rejected": 0,
+            "peak_queue_depth": 0,
+        }
+
+    @classmethod
+    def from_settings(cls) -> "AdmissionController":
+        return cls(settings.extraction_max_in_flight, settings.extraction_max_queue)
+
+    def check(self) -> None:
+        """Raise QueueFull if the wait queue is full.
+
+        Checked when a request arrives. The files of an admitted batch may then push the
+        queue past its bound, which keeps a batch from being rejected halfway through.
+        """
+        with self._lock:
+            excess = self._waiting + 1 - self.max_queue
+            if excess <= 0:
+                return
+            self._stats["rejected"] += 1
+            # Time for `excess` queued extractions to drain through the slots
+            hold = self._avg_hold or float(settings.timeout_seconds) / 4
+            retry_after = max(1, math.ceil(hold * excess / self.max_in_flight))
+            raise QueueFull(self._waiting, retry_after)
+
+    async def acquire(self, client: str) -> float:
+        """Wait for a slot (round-robin across clients); returns seconds waited."""
+        with self._lock:
+            if self._in_flight < self.max_in_flight and self._waiting == 0:
+                self._in_flight += 1
+                self._record_wait(0.0)
+                return 0.0
+            waiter = _Waiter(asyncio.get_running_loop(), asyncio.get_running_loop().create_future(), client)
+            self._queues.setdefault(client, deque()).append(waiter)
+            self._waiting += 1
+            self._stats["peak_queue_depth"] = max(self._stats["peak_queue_depth"], self._waiting)
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            with self._lock:
+                if not waiter.granted:
+                    queue = self._queues.get(client)
+                    if queue is not None and waiter in queue:
+                        queue.remove(waiter)
+                        if not queue:
+                            del self._queues[client]
+                    self._waiting -= 1
+                    raise
+            # Cancelled after the slot was handed over: pass it on
+            self.release(0.0)
+            raise
+
+        waited = time.monotonic() - waiter.enqueued
+        with self._lock:
+            self._record_wait(waited)
+        return waited
+
+    def release(self, held: float) -> None:
+        """Give a slot back after holding it for `held` seconds."""
+        with self._lock:
+            self._in_flight -= 1
+            if held > 0:
+                self._avg_hold = held if self._avg_hold == 0.0 else 0.9 * self._avg_hold + 0.1 * held
+            while self._in_flight < self.max_in_flight and self._queues:
+                client, queue = next(iter(self._queues.items()))
+                waiter = queue.popleft()
+                if queue:
+                    self._queues.move_to_end(client)
+                else:
+                    del self._queues[client]
+                self._waiting -= 1
+                self._in_flight += 1
+                try:
+                    waiter.loop.call_soon_threadsafe(_wake, waiter.future)
+                except RuntimeError:
+                    self._in_flight -= 1  # its event loop is closed; nobody is waiting
+                    continue
+                waiter.granted = True
+
+    def _record_wait(self, waited: float) -> None:
+        self._stats["granted"] += 1
+        self._stats["waited"] += 1 if waited > 0 else 0
+        self._stats["wait_total"] += waited
+        self._stats["wait_max"] = max(self._stats["wait_max"], waited)
+        self._recent_waits.append(waited)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats.update({
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self._in_flight,
+                "max_queue": self.max_queue,
+                "queue_depth": self._waiting,
+                "queue_depth_by_client": {client: len(queue) for client, queue in self._queues.items()},
+                "avg_hold": self._avg_hold,
+            })
+            recent = sorted(self._recent_waits)
+        stats["avg_wait"] = stats["wait_total"] / (stats["granted"] or 1)
+        stats["p95_wait"] = recent[int(0.95 * (len(recent) - 1))] if recent else 0.0
+        return stats
+
+
+def _wake(future: "asyncio.Future[None]") -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+_controller: Optional[AdmissionController] = None
+_controller_lock = threading.Lock()
+
+
+def get_admission() -> Optional[AdmissionController]:
+    """Process-wide controller (None when ADMISSION_ENABLED is false)."""
+    global _controller
+    if not settings.admission_enabled:
+        return None
+    with _controller_lock:
+        if _controller is None:
+            _controller = AdmissionController.from_settings()
+        return _controller
+
+
+@contextmanager
+def client_scope(client: str) -> Iterator[None]:
+    """Attribute extractions started in this block (and tasks it creates) to `client`."""
+    token = _client.set(client)
+    try:
+        yield
+    finally:
+        _client.reset(token)
+
+
+class Slot:
+    """A held extraction slot; `release()` exactly once (no-op for re-entrant holds)."""
+
+    def __init__(self, controller: Optional[AdmissionController], waited: float):
+        self.controller = controller
+        self.waited = waited
+        self._acquired = time.monotonic()
+        self._token = _holding.set(True) if controller is not None else None
+
+    def release(self) -> None:
+        if self.controller is None:
+            return
+        _holding.reset(self._token)
+        self.controller.release(time.monotonic() - self._acquired)
+        self.controller = None
+
+
+async def acquire_slot() -> Slot:
+    """Take a slot for the current client, unless this task tree already holds one."""
+    controller = get_admission()
+    if controller is None or _holding.get():
+        return Slot(None, 0.0)
+    return Slot(controller, await controller.acquire(_client.get()))
+
+
+@asynccontextmanager
+async def extraction_slot() -> AsyncIterator[Slot]:
+    slot = await acquire_slot()
+    try:
+        yield slot
+    finally:
+        slot.release()
@@ -0,0 +1,142 @@
+"""Process-wide Anthropic client factory with a shared, tuned httpx connection pool.
+
+Every InvoiceProcessor (API, benchmark, helper scripts) goes through this module so the
+process keeps one keep-alive pool per event loop instead of one client per processor:
+- AsyncAnthropic clients are created once per event loop (httpx pools are loop-bound)
+- sync callers share a single background event loop (and therefore a single pool),
+  which makes the sync API safe to call from many worker threads at once
+- pool limits and connect/read timeouts come from config.Settings
+- Claude calls are counted in flight from the request until the reply (streamed replies:
+  until the stream is consumed), failed and cancelled calls included
+"""
+import asyncio
+import threading
+import weakref
+from typing import Any, Dict, Optional
+
+import httpx
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+
+from config import settings
+
+_lock = threading.Lock()
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncAnthropic]" = weakref.WeakKeyDictionary()
+_counters: Dict[str, int] = {"clients_created": 0, "requests": 0, "responses": 0, "errors": 0, "peak_in_flight": 0}
+_in_flight = 0
+_background_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def request_started() -> None:
+    """Count a Claude API call as in flight; pair with exactly one `request_finished`."""
+    global _in_flight
+    with _lock:
+        _counters["requests"] += 1
+        _in_flight += 1
+        _counters["peak_in_flight"] = max(_counters["peak_in_flight"], _in_flight)
+
+
+def request_finished(failed: bool = False) -> None:
+    """End a call counted by `request_started` (failed: raised or was cancelled)."""
+    global _in_flight
+    with _lock:
+        _counters["errors" if failed else "responses"] += 1
+        _in_flight -= 1
+
+
+def _build_client() -> AsyncAnthropic:
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=settings.http_max_connections,
+            max_keepalive_connections=settings.http_max_keepalive_connections,
+            keepalive_expiry=settings.http_keepalive_expiry,
+        ),
+        timeout=httpx.Timeout(settings.timeout_seconds, connect=settings.http_connect_timeout),
+        http2=settings.http2 and _http2_available(),
+    )
+    return AsyncAnthropic(
+        api_key=settings.claude_api_key,
+        http_client=http_client,
+        timeout=httpx.Timeout(settings.timeout_seconds, connect=settings.http_connect_timeout),
+        # Retries (429/529 backoff) are handled by rate_limiter, shared across callers
+        max_retries=0 if settings.rate_limit_enabled else 2,
+    )
+
+
+def get_async_client() -> AsyncAnthropic:
+    """Return the shared AsyncAnthropic client for the running event loop."""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        client = _clients.get(loop)
+        if client is None:
+            client = _build_client()
+            _clients[loop] = client
+            _counters["clients_created"] += 1
+        return client
+
+
+def run_sync(coro: Any) -> Any:
+    """
+    Run a coroutine on the process-wide background loop and block until it finishes.
+
+    Safe to call from many plain worker threads at once. Callers must not be on a running
+    event loop: the call blocks that loop until the coroutine is done (await the async
+    API instead). On the background loop itself it would deadlock, so it raises.
+
+    Raises:
+        RuntimeError: Called from the background loop
+    """
+    global _background_loop
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is not None and running is _background_loop:
+        raise RuntimeError("run_sync() called from the background loop; await the coroutine instead")
+    with _lock:
+        if _background_loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="anthropic-client-loop", daemon=True).start()
+            _background_loop = loop
+        loop = _background_loop
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def _pool_connections(client: AsyncAnthropic) -> Dict[str, int]:
+    """Best-effort connection counts from the underlying httpcore pool ({} if unavailable)."""
+    try:
+        # httpx -> httpcore internals: may change between versions or transports
+        pool = client._client._transport._pool
+        connections = list(pool.connections)
+        idle = sum(1 for c in connections if c.is_idle())
+    except Exception:
+        return {}
+    return {"connections": len(connections), "idle": idle, "active": len(connections) - idle}
+
+
+def pool_stats() -> Dict[str, Any]:
+    """Diagnostics: configured limits, request counters and live pool connections."""
+    with _lock:
+        clients = list(_clients.values())
+        counters = dict(_counters)
+        in_flight = _in_flight
+    return {
+        "limits": {
+            "max_connections": settings.http_max_connections,
+            "max_keepalive_connections": settings.http_max_keepalive_connections,
+            "keepalive_expiry": settings.http_keepalive_expiry,
+            "connect_timeout": settings.http_connect_timeout,
+            "read_timeout": settings.timeout_seconds,
+            "http2": settings.http2 and _http2_available(),
+        },
+        **counters,
+        "in_flight": in_flight,
+        "pools": [_pool_connections(c) for c in clients],
+    }
@@ -1,23 +1,31 @@
 """FastAPI REST API for invoice processing."""
 from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Request
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.middleware.cors import CORSMiddleware
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional
+import asyncio
 import tempfile
+import time
 import shutil
 import uuid
 from datetime import datetime
 import requests
 import json
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
 
+from admission import QueueFull, client_scope, get_admission
+from anthropic_client import pool_stats
+from rate_limiter import get_rate_limiter
 from invoice_processor import InvoiceProcessor
+from invoice_source import InvoiceSource
+from job_queue import JobManager
 from benchmark import InvoiceBenchmark
 from csv_exporter import CSVExporter
 from cost_analyzer import CostAnalyzer
 from models import ProcessingResult, BenchmarkResult
+from upload_stream import RejectedUpload, UploadError, UploadReader, upload_stats
 from config import settings
 
 app = FastAPI(
@@ -45,6 +53,105 @@ app.add_middleware(
 # Global processor instance
 processor = InvoiceProcessor()
 
+# Background batch jobs; created on startup (needs the running event loop)
+jobs: Optional[JobManager] = None
+
+# App-lifetime worker threads behind asyncio.to_thread (page renders, encoding, SQLite)
+worker_pool: Optional[ThreadPoolExecutor] = None
+
+
+@app.on_event("startup")
+async def start_worker_pool():
+    """Install one bounded thread pool as the event loop's default executor."""
+    global worker_pool
+    worker_pool = ThreadPoolExecutor(max_workers=settings.worker_threads or None, thread_name_prefix="invoice-worker")
+    asyncio.get_running_loop().set_default_executor(worker_pool)
+
+
+@app.on_event("startup")
+async def start_job_manager():
+    """Create the job manager and resume jobs a previous process left unfinished."""
+    global jobs
+    jobs = JobManager.from_settings(processor)
+    resumed = jobs.resume()
+    if resumed:
+        print(f"Resumed {len(resumed)} unfinished job(s)")
+
+
+def _admit(request: Request) -> str:
+    """Client id for fair queueing; 429 + Retry-After if the extraction queue is full.
+
+    Checked once per request, batches included: their files are only counted as they
+    arrive (see `_upload_reader` for the per-batch bound)."""
+    controller = get_admission()
+    if controller is not None:
+        try:
+            controller.check()
+        except QueueFull as e:
+            raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    return request.headers.get("x-client-id") or (request.client.host if request.client else "anonymous")
+
+
+# Upload endpoints read the multipart body themselves (upload_stream.py); these keep the
+# "file" / "files" fields in the OpenAPI docs
+UPLOAD_FILES_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"files": {"type": "array", "items": {"type": "string", "format": "binary"}}},
+                    "required": ["files"],
+                }
+            }
+        },
+    }
+}
+
+UPLOAD_FILE_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"],
+                }
+            }
+        },
+    }
+}
+
+
+def _upload_reader(request: Request, max_files: Optional[int] = None) -> UploadReader:
+    """Streaming reader for an upload. By default files past the extraction queue bound
+    are rejected individually (larger batches belong in /api/jobs)."""
+    if max_files is None:
+        controller = get_admission()
+        max_files = controller.max_queue if controller is not None else None
+    return UploadReader(request, allowed_extensions=('.pdf', '.jpg', '.jpeg', '.png'), max_files=max_files)
+
+
+async def _read_one(reader: UploadReader) -> InvoiceSource:
+    """Receive the single invoice of an upload; 400 (or 413 if too large) otherwise."""
+    try:
+        uploads = [upload async for upload in reader]
+    except UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(uploads) > 1:
+        raise HTTPException(status_code=400, detail="Send one file (several: /api/process/batch)")
+    if not uploads:
+        detail = "No file provided"
+        if reader.skipped:
+            detail = f"Only {', '.join(reader.allowed_extensions)} files are supported"
+        raise HTTPException(status_code=400, detail=detail)
+    upload = uploads[0]
+    if isinstance(upload, RejectedUpload):
+        raise HTTPException(status_code=413 if upload.too_large else 400, detail=f"{upload.filename}: {upload.error}")
+    return upload
+
 
 @app.get("/")
 async def root():
@@ -56,8 +163,13 @@ async def root():
         "endpoints": {
             "process_single": "/api/process",
             "process_batch": "/api/process/batch",
+            "create_job": "/api/jobs",
+            "job_status": "/api/jobs/{job_id}",
             "run_benchmark": "/api/benchmark",
             "download_csv": "/api/download/{file_type}/{filename}",
+            "process_stream": "/api/process/stream",
+            "process_batch_stream": "/api/process/batch/stream",
+            "diagnostics": "/api/diagnostics",
             "health": "/health"
         }
     }
@@ -73,120 +185,389 @@ async def health_check():
     }
 
 
-@app.post("/api/process", response_model=ProcessingResult)
-async def process_single_invoice(file: UploadFile = File(...)):
+@app.get("/api/diagnostics")
+async def diagnostics():
+    """Runtime diagnostics for tuning concurrency (HTTP pool, caches)."""
+    return {
+        "http_pool": pool_stats(),
+        "rate_limiter": get_rate_limiter().stats() if get_rate_limiter() is not None else None,
+        "extraction_cache": processor.cache.stats() if processor.cache is not None else None,
+        "structured_output": processor.parse_stats(),
+        "cascade": processor.cascade_stats() if settings.cascade_enabled else None,
+        "row_repair": processor.repair_stats() if settings.row_repair_enabled else None,
+        "vendor_profiles": processor.vendor_profiles.stats() if processor.vendor_profiles is not None else None,
+        "near_duplicates": processor.duplicates.stats() if processor.duplicates is not None else None,
+        "admission": get_admission().stats() if get_admission() is not None else None,
+        "uploads": upload_stats(),
+        "worker_pool": {
+            "max_workers": worker_pool._max_workers,
+            "threads": len(worker_pool._threads),
+            "queued": worker_pool._work_queue.qsize(),
+        } if worker_pool is not None else None,
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+@app.post("/api/process", response_model=ProcessingResult, openapi_extra=UPLOAD_FILE_BODY)
+async def process_single_invoice(request: Request, vendor: Optional[str] = None):
     """Process a single invoice file.
     
     Args:
-        file: Invoice file to process (PDF or image: jpg, jpeg, png)
+        request: multipart/form-data with the invoice as "file" (PDF or image: jpg,
+            jpeg, png); over MAX_FILE_SIZE_MB it is rejected (413) while it uploads
+        vendor: Optional supplier name (query parameter); selects the vendor's learned
+            layout for scans and photos
         
     Returns:
         Processing result with extracted data
     """
-    # Validate file type
-    allowed_extensions = ('.pdf', '.jpg', '.jpeg', '.png')
-    if not file.filename.lower().endswith(allowed_extensions):
-        raise HTTPException(status_code=400, detail=f"Only {', '.join(allowed_extensions)} files are supported")
-    
-    # Get file extension for temporary file
-    file_ext = Path(file.filename).suffix
-    
-    # Create temporary file
-    with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-        tmp_path = Path(tmp_file.name)
-        
-        # Save uploaded file
-        content = await file.read()
-        tmp_file.write(content)
+    client = _admit(request)
+    reader = _upload_reader(request, max_files=1)
     
     try:
-        # Process invoice
-        result = processor.process_invoice(tmp_path)
+        # Processed from memory (large uploads are spooled to disk)
+        source = await _read_one(reader)
+        # Process invoice (async path; does not block the event loop)
+        with client_scope(client):
+            result = await processor.aprocess_invoice(source, vendor_hint=vendor)
         return result
     
     finally:
-        # Clean up temporary file
-        tmp_path.unlink(missing_ok=True)
+        reader.close()
+
+
+def _format_event(event: dict, format: str) -> str:
+    """One streamed event as an NDJSON line or an SSE message."""
+    payload = json.dumps(event, ensure_ascii=False)
+    if format == "sse":
+        return f"event: {event['event']}\ndata: {payload}\n\n"
+    return payload + "\n"
+
+
+@app.post("/api/process/stream", openapi_extra=UPLOAD_FILE_BODY)
+async def process_single_invoice_stream(request: Request, format: str = "ndjson"):
+    """Process a single invoice and stream line items as Claude writes them.
+    
+    Args:
+        request: multipart/form-data with the invoice as "file" (PDF or image: jpg,
+            jpeg, png); over MAX_FILE_SIZE_MB it is rejected (413) while it uploads
+        format: "ndjson" (one JSON event per line) or "sse" (text/event-stream)
+        
+    Returns:
+        Stream of "item" events followed by one "result" event (ProcessingResult)
+    """
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'sse'")
+    client = _admit(request)
+    reader = _upload_reader(request, max_files=1)
+    try:
+        # Received in full before the response starts
+        source = await _read_one(reader)
+    except BaseException:
+        reader.close()
+        raise
+    
+    async def events():
+        try:
+            with client_scope(client):
+                async for event in processor.astream_invoice(source):
+                    yield _format_event(event, format)
+        finally:
+            reader.close()
+    
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(events(), media_type=media_type, headers={"Cache-Control": "no-cache"})
+
+
+async def _aprocess_uploads(
+    reader: UploadReader, on_result: Callable[[int, ProcessingResult], None]
+) -> List[ProcessingResult]:
+    """Process files while the upload is still arriving; results in upload order.
+
+    Rejected files (too large, too many) become failed results. Each file is released
+    (memory accounting, spooled copy) as soon as its result is in.
+    """
+    positions: List[int] = []  # processing index -> upload index
+    sources: List[Optional[InvoiceSource]] = []
+    rejected: Dict[int, ProcessingResult] = {}
+    
+    async def arrivals():
+        async for upload in reader:
+            idx = len(positions) + len(rejected)
+            if isinstance(upload, RejectedUpload):
+                rejected[idx] = ProcessingResult(filename=upload.filename, success=False, error=upload.error)
+                on_result(idx, rejected[idx])
+                continue
+            positions.append(idx)
+            sources.append(upload)
+            yield upload
+    
+    def done(i: int, result: ProcessingResult) -> None:
+        reader.release(sources[i])
+        sources[i] = None  # drop the bytes now, not when the whole batch is done
+        on_result(positions[i], result)
+    
+    results = await processor.aprocess_stream(arrivals(), on_result=done)
+    ordered = {**rejected, **{positions[i]: r for i, r in enumerate(results)}}
+    return [ordered[i] for i in range(len(ordered))]
 
 
-@app.post("/api/process/batch")
-async def process_batch_invoices(files: List[UploadFile] = File(...)):
+@app.post("/api/process/batch", openapi_extra=UPLOAD_FILES_BODY)
+async def process_batch_invoices(request: Request):
     """Process multiple invoice files in parallel.
     
+    Files are processed as soon as each one has been received; files over
+    MAX_FILE_SIZE_MB are rejected while they upload (reported as failed results).
+    
     Args:
-        files: List of invoice files to process (PDF or images: jpg, jpeg, png)
+        request: multipart/form-data with the invoice files as "files" (PDF or images:
+            jpg, jpeg, png)
         
     Returns:
-        List of processing results and CSV download links
+        List of processing results, CSV download links and upload stats
     """
-    if len(files) == 0:
+    client = _admit(request)
+    reader = _upload_reader(request)
+    
+    try:
+        # Process invoices concurrently on the event loop (async Anthropic client) while
+        # the rest of the upload arrives; with MICROBATCH_ENABLED, single-page
+        # photos/scans share Claude requests
+        with client_scope(client):
+            results = await _aprocess_uploads(reader, lambda i, r: None)
+    except UploadError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        reader.close()
+    if len(results) == 0:
         raise HTTPException(status_code=400, detail="No files provided")
     
-    results: List[ProcessingResult] = []
-    temp_files: List[Path] = []
+    # Export to CSV
+    output_path = Path(settings.output_dir)
+    csv_files = CSVExporter.export_all(results, output_path)
     
-    # Allowed file extensions
-    allowed_extensions = ('.pdf', '.jpg', '.jpeg', '.png')
+    # Calculate statistics
+    successful = sum(1 for r in results if r.success)
+    total_time = sum(r.processing_time for r in results)
     
-    try:
-        # Save all files first
-        for file in files:
-            if not file.filename.lower().endswith(allowed_extensions):
-                continue
-            
-            # Get file extension for temporary file
-            file_ext = Path(file.filename).suffix
-            
-            # Create temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-                tmp_path = Path(tmp_file.name)
-                temp_files.append(tmp_path)
-                
-                # Save uploaded file
-                content = await file.read()
-                tmp_file.write(content)
-            
-        # Process all invoices in parallel using ThreadPoolExecutor
-        loop = asyncio.get_event_loop()
-        with ThreadPoolExecutor(max_workers=min(len(temp_files), 10)) as executor:
-            # Create tasks for all files
-            tasks = [
-                loop.run_in_executor(executor, processor.process_invoice, tmp_path)
-                for tmp_path in temp_files
-            ]
-            # Wait for all tasks to complete
-            results = await asyncio.gather(*tasks)
+    # Calculate cost savings analysis (server-side)
+    cost_analysis = CostAnalyzer.calculate_savings_analysis(results)
+    master_list = CostAnalyzer.get_master_list(results)
+    
+    return {
+        "total_files": len(results),
+        "successful": successful,
+        "failed": len(results) - successful,
+        "total_time": total_time,
+        "microbatched": sum(1 for r in results if r.batch_size > 1),
+        "microbatch_fallbacks": sum(1 for r in results if r.microbatch_error),
+        "estimated_cost_usd": sum(r.estimated_cost_usd for r in results),
+        "upload": reader.stats(),
+        "results": [r.model_dump() for r in results],
+        "cost_analysis": cost_analysis,
+        "master_list": master_list,
+        "downloads": {
+            "items_csv": f"/api/download/items/{Path(csv_files['items_csv']).name}",
+            "summary_csv": f"/api/download/summary/{Path(csv_files['summary_csv']).name}"
+        }
+    }
+
+
+@app.post("/api/process/batch/stream", openapi_extra=UPLOAD_FILES_BODY)
+async def process_batch_invoices_stream(request: Request, format: str = "ndjson", progress_interval: float = 2.0):
+    """Process multiple invoice files and stream each result as soon as it is done.
+    
+    Args:
+        request: multipart/form-data with the invoice files as "files" (PDF or images:
+            jpg, jpeg, png); each file starts processing as soon as it has been received
+        format: "ndjson" (one JSON event per line) or "sse" (text/event-stream)
+        progress_interval: Seconds between "progress" events (running totals)
         
-        # Export to CSV
-        output_path = Path(settings.output_dir)
-        csv_files = CSVExporter.export_all(results, output_path)
+    Returns:
+        Stream of "result" events (upload index, filename, ProcessingResult) in completion
+        order, "progress" events every progress_interval seconds, and a final "done" event
+        with the totals, upload stats, cost analysis, master list and CSV download links.
+        The stream starts once the upload has been received; results of files finished
+        before that come first.
+    """
+    if format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'sse'")
+    client = _admit(request)
+    reader = _upload_reader(request)
+    start = time.perf_counter()
+    finished: asyncio.Queue = asyncio.Queue()
+    with client_scope(client):
+        # The task copies the context, so its extractions queue under this client
+        task = asyncio.ensure_future(
+            _aprocess_uploads(reader, on_result=lambda i, r: finished.put_nowait((i, r)))
+        )
+    task.add_done_callback(lambda _: finished.put_nowait(None))
+    
+    def cleanup() -> None:
+        # Client disconnects stop the remaining work
+        task.cancel()
+        reader.close()
+    
+    received = asyncio.ensure_future(reader.finished.wait())
+    try:
+        # StreamingResponse reads `receive` to notice disconnects, which would take the
+        # body away from the reader: respond once the upload is in (files are already
+        # being processed)
+        await asyncio.wait({received, task}, return_when=asyncio.FIRST_COMPLETED)
+    except BaseException:
+        cleanup()
+        raise
+    finally:
+        received.cancel()
+    if task.done() and not task.cancelled() and isinstance(task.exception(), UploadError):
+        cleanup()
+        raise HTTPException(status_code=400, detail=str(task.exception()))
+    
+    async def events():
+        processed = successful = items = 0
+        cost = 0.0
+        first_result: Optional[float] = None
+        last_progress = start
         
-        # Calculate statistics
-        successful = sum(1 for r in results if r.success)
-        total_time = sum(r.processing_time for r in results)
+        def progress_event() -> dict:
+            stats = reader.stats()
+            return {
+                "event": "progress",
+                "total_files": stats["files"],  # received so far, until upload_complete
+                "upload_complete": stats["complete"],
+                "processed": processed,
+                "successful": successful,
+                "failed": processed - successful,
+                "items": items,
+                "estimated_cost_usd": cost,
+                "elapsed": time.perf_counter() - start,
+            }
         
-        # Calculate cost savings analysis (server-side)
-        cost_analysis = CostAnalyzer.calculate_savings_analysis(results)
-        master_list = CostAnalyzer.get_master_list(results)
+        try:
+            yield _format_event({"event": "started"}, format)
+            while True:
+                try:
+                    entry = await asyncio.wait_for(finished.get(), timeout=progress_interval)
+                except asyncio.TimeoutError:
+                    last_progress = time.perf_counter()
+                    yield _format_event(progress_event(), format)
+                    continue
+                if entry is None:
+                    break  # every file is done (or processing failed; surfaces below)
+                idx, result = entry
+                processed += 1
+                successful += int(result.success)
+                items += len(result.invoice_data.items) if result.invoice_data is not None else 0
+                cost += result.estimated_cost_usd
+                if first_result is None:
+                    first_result = time.perf_counter() - start
+                yield _format_event(
+                    {"event": "result", "index": idx, "filename": result.filename, "result": result.model_dump()},
+                    format,
+                )
+                if time.perf_counter() - last_progress >= progress_interval:
+                    last_progress = time.perf_counter()
+                    yield _format_event(progress_event(), format)
+            
+            try:
+                results = await task
+            except Exception as e:
+                yield _format_event({"event": "error", "error": str(e)}, format)
+                return
+            
+            # CSV export and cost analysis only run once every result has been streamed
+            csv_files = await asyncio.to_thread(CSVExporter.export_all, results, Path(settings.output_dir))
+            done = progress_event()
+            done.update({
+                "event": "done",
+                "total_time": sum(r.processing_time for r in results),
+                "time_to_first_result": first_result,
+                "microbatched": sum(1 for r in results if r.batch_size > 1),
+                "microbatch_fallbacks": sum(1 for r in results if r.microbatch_error),
+                "upload": reader.stats(),
+                "cost_analysis": CostAnalyzer.calculate_savings_analysis(results),
+                "master_list": CostAnalyzer.get_master_list(results),
+                "downloads": {
+                    "items_csv": f"/api/download/items/{Path(csv_files['items_csv']).name}",
+                    "summary_csv": f"/api/download/summary/{Path(csv_files['summary_csv']).name}"
+                },
+            })
+            yield _format_event(done, format)
+        finally:
+            cleanup()
+    
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    # The background task covers a response that never starts its stream
+    return StreamingResponse(
+        events(), media_type=media_type, headers={"Cache-Control": "no-cache"}, background=BackgroundTask(cleanup)
+    )
+
+
+@app.post("/api/jobs", status_code=202, openapi_extra=UPLOAD_FILES_BODY)
+async def create_job(request: Request):
+    """Queue a batch of invoice files for background processing.
+    
+    Each file is written to the job's directory while it uploads (never held in
+    memory); files over MAX_FILE_SIZE_MB are dropped as their bytes arrive.
+    
+    Args:
+        request: multipart/form-data with the invoice files as "files" (PDF or images:
+            jpg, jpeg, png)
         
-        return {
-            "total_files": len(results),
-            "successful": successful,
-            "failed": len(results) - successful,
-            "total_time": total_time,
-            "results": [r.model_dump() for r in results],
-            "cost_analysis": cost_analysis,
-            "master_list": master_list,
-            "downloads": {
-                "items_csv": f"/api/download/items/{Path(csv_files['items_csv']).name}",
-                "summary_csv": f"/api/download/summary/{Path(csv_files['summary_csv']).name}"
-            }
-        }
+    Returns:
+        Job id, the URL to poll for progress and results, and the files that were not
+        accepted (name and reason)
+    """
+    _admit(request)
+    job_id, job_dir = jobs.new_job()
+    reader = UploadReader(request, allowed_extensions=('.pdf', '.jpg', '.jpeg', '.png'), destination=job_dir)
+    paths: List[Path] = []
+    rejected: List[dict] = []
     
+    try:
+        async for upload in reader:
+            if isinstance(upload, RejectedUpload):
+                rejected.append({"filename": upload.filename, "error": upload.error})
+            else:
+                paths.append(upload)
+        rejected += [{"filename": name, "error": "Unsupported file type"} for name in reader.skipped]
+        if not paths:
+            names = ", ".join(r["filename"] for r in rejected)
+            raise HTTPException(
+                status_code=400,
+                detail="No supported files provided" + (f" (rejected: {names})" if names else ""),
+            )
+        await jobs.submit(job_id, paths)
+    except UploadError as e:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        shutil.rmtree(job_dir, ignore_errors=True)
+        raise
     finally:
-        # Clean up temporary files
-        for tmp_path in temp_files:
-            tmp_path.unlink(missing_ok=True)
+        reader.close()
+    
+    return {
+        "job_id": job_id,
+        "status": "queued",
+        "total_files": len(paths),
+        "rejected": rejected,
+        "status_url": f"/api/jobs/{job_id}",
+    }
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str, include_results: bool = True):
+    """Job progress and results so far; cost analysis and CSV downloads once completed.
+    
+    Args:
+        job_id: Id returned by POST /api/jobs
+        include_results: Include the per-file ProcessingResults (partial while running)
+    """
+    status = await asyncio.to_thread(jobs.status, job_id, include_results)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
 
 
 @app.post("/api/benchmark")
@@ -1,7 +1,8 @@
 """Benchmarking utilities for invoice processing."""
 import time
+import statistics
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, List, Optional, Sequence
 import json
 
 from invoice_processor import InvoiceProcessor
@@ -72,6 +73,30 @@ class InvoiceBenchmark:
         print(f"Benchmark Complete!")
         print(f"Total: {len(results)} | Success: {successful} | Failed: {failed}")
         print(f"Total Time: {total_time:.2f}s | Average: {avg_time:.2f}s per file")
+        parse = self.processor.parse_stats()
+        mode_counts = parse[parse["mode"]]
+        print(f"Output mode: {parse['mode']} | Parse failures: {mode_counts['parse_failures']}/{mode_counts['replies']}")
+        if settings.cascade_enabled:
+            escalated = sum(1 for r in results if r.escalated)
+            cascaded = sum(1 for r in results if r.cascade_stages)
+            print(f"Cascade: {escalated}/{cascaded} escalated to {self.processor.model}")
+        if self.processor.vendor_profiles is not None:
+            vendors = self.processor.vendor_profiles.stats()
+            print(f"Vendor profiles: {vendors['hits']}/{vendors['invoices']} invoices matched "
+                  f"({vendors['local_pages']} pages parsed locally, ~{vendors['prompt_tokens_saved']} prompt tokens saved)")
+        if settings.row_repair_enabled:
+            repair = self.processor.repair_stats()
+            print(f"Row repair: {repair['repaired']}/{repair['located']} located rows fixed "
+                  f"({repair['failing']} failing)")
+        stage_stats = self.stage_stats(results)
+        token_stats = self.token_stats(results)
+        if stage_stats:
+            print(f"{'stage':<14}{'mean s':>9}{'p50 s':>9}{'p95 s':>9}{'share':>8}")
+            for stage, row in stage_stats.items():
+                print(f"{stage:<14}{row['mean']:>9.3f}{row['p50']:>9.3f}{row['p95']:>9.3f}{row['share']:>8.1%}")
+        print(f"Tokens: {token_stats['input_tokens']:.0f} in / {token_stats['output_tokens']:.0f} out "
+              f"(avg {token_stats['avg_input_tokens']:.0f} / {token_stats['avg_output_tokens']:.0f}) | "
+              f"Estimated cost: ${token_stats['estimated_cost_usd']:.4f}")
         
         # Create benchmark result
         benchmark_result = BenchmarkResult(
@@ -80,11 +105,125 @@ class InvoiceBenchmark:
             failed=failed,
             total_time=total_time,
             average_time=avg_time,
-            results=results
+            results=results,
+            stage_stats=stage_stats,
+            token_stats=token_stats,
         )
         
         return benchmark_result
     
+    @staticmethod
+    def stage_stats(results: Sequence[ProcessingResult]) -> Dict[str, Dict[str, float]]:
+        """Per-stage timing aggregates over invoices that were actually extracted
+        (cache and near-duplicate hits have no stages)."""
+        timed = [r.stage_timings for r in results if r.success and r.stage_timings]
+        if not timed:
+            return {}
+        stages = sorted({stage for timings in timed for stage in timings})
+        grand_total = sum(sum(timings.values()) for timings in timed) or 1.0
+        out: Dict[str, Dict[str, float]] = {}
+        for stage in stages:
+            values = sorted(timings.get(stage, 0.0) for timings in timed)
+            total = sum(values)
+            out[stage] = {
+                "mean": total / len(values),
+                "p50": statistics.median(values),
+                "p95": values[min(len(values) - 1, int(0.95 * len(values)))],
+                "total": total,
+                "share": total / grand_total,
+            }
+        return out
+
+    @staticmethod
+    def token_stats(results: Sequence[ProcessingResult]) -> Dict[str, float]:
+        """Token usage and estimated cost: totals and means per processed invoice."""
+        n = len(results) or 1
+        input_tokens = sum(r.input_tokens for r in results)
+        output_tokens = sum(r.output_tokens for r in results)
+        cost = sum(r.estimated_cost_usd for r in results)
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "estimated_cost_usd": cost,
+            "avg_input_tokens": input_tokens / n,
+            "avg_output_tokens": output_tokens / n,
+            "avg_cost_usd": cost / n,
+        }
+
+    def compare_output_modes(
+        self,
+        invoices_dir: Optional[Path] = None,
+        limit: Optional[int] = None,
+        modes: Sequence[str] = ("json", "compact"),
+    ) -> dict:
+        """Run the same invoices once per output mode and compare output tokens and latency.
+
+        The extraction cache, vendor profiles (short prompts, local text-layer parser) and
+        near-duplicate reuse are switched off for the run, so every mode makes the same
+        real Claude calls.
+        
+        Args:
+            invoices_dir: Directory containing invoice PDFs
+            limit: Optional limit on number of files to process
+            modes: STRUCTURED_OUTPUT_MODE values to compare
+            
+        Returns:
+            Per-mode summary plus the path of the exported JSON report
+        """
+        if invoices_dir is None:
+            invoices_dir = Path(settings.invoices_dir)
+        pdf_files = sorted(list(invoices_dir.glob("*.pdf")))
+        if limit:
+            pdf_files = pdf_files[:limit]
+
+        original = (
+            self.processor.output_mode,
+            self.processor.cache,
+            self.processor.vendor_profiles,
+            self.processor.duplicates,
+        )
+        self.processor.cache = self.processor.vendor_profiles = self.processor.duplicates = None
+        summary = {}
+        try:
+            for mode in modes:
+                self.processor.output_mode = mode
+                print(f"Output mode {mode}: {len(pdf_files)} files")
+                results = [self.processor.process_invoice(pdf_file) for pdf_file in pdf_files]
+                ok = [r for r in results if r.success]
+                summary[mode] = {
+                    "files": len(results),
+                    "successful": len(ok),
+                    "items": sum(len(r.invoice_data.items) for r in ok if r.invoice_data),
+                    "avg_output_tokens": statistics.mean(r.output_tokens for r in ok) if ok else 0.0,
+                    "avg_time": statistics.mean(r.processing_time for r in ok) if ok else 0.0,
+                    "median_time": statistics.median(r.processing_time for r in ok) if ok else 0.0,
+                    "avg_model_latency": statistics.mean(r.model_latency for r in ok) if ok else 0.0,
+                }
+        finally:
+            (
+                self.processor.output_mode,
+                self.processor.cache,
+                self.processor.vendor_profiles,
+                self.processor.duplicates,
+            ) = original
+
+        print("-" * 80)
+        print(f"{'mode':<10}{'ok':>6}{'items':>8}{'out tokens':>12}{'avg s':>9}{'median s':>10}")
+        for mode, row in summary.items():
+            print(
+                f"{mode:<10}{row['successful']:>6}{row['items']:>8}{row['avg_output_tokens']:>12.0f}"
+                f"{row['avg_time']:>9.2f}{row['median_time']:>10.2f}"
+            )
+
+        from datetime import datetime
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        json_file = self.output_path / f"output_mode_comparison_{timestamp}.json"
+        with open(json_file, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        print(f"✓ Comparison JSON: {json_file}")
+
+        return {"modes": summary, "json_results": str(json_file)}
+
     def export_results(self, benchmark_result: BenchmarkResult) -> dict:
         """Export benchmark results to CSV and JSON.
         
@@ -164,10 +303,23 @@ def main():
         default=None,
         help="Limit number of files to process"
     )
+    parser.add_argument(
+        "--compare-output-modes",
+        type=str,
+        default=None,
+        help="Comma-separated output modes to compare instead of a normal run (e.g. json,compact)"
+    )
     args = parser.parse_args()
     
     # Run benchmark
     benchmark = InvoiceBenchmark()
+    if args.compare_output_modes:
+        benchmark.compare_output_modes(
+            invoices_dir=Path(args.invoices_dir),
+            limit=args.limit,
+            modes=[m.strip() for m in args.compare_output_modes.split(",") if m.strip()],
+        )
+        return
     results = benchmark.run_and_export(
         invoices_dir=Path(args.invoices_dir),
         limit=args.limit
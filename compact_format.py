@@ -0,0 +1,125 @@
+"""Compact wire format for Claude's JSON replies (STRUCTURED_OUTPUT_MODE=compact).
+
+Output tokens dominate generation time, and the regular format repeats every key
+("item_number", "unit_price", "llm_confidence", ...) on every line item. In compact mode
+Claude writes one header with the column order and then one array per item:
+
+    {"m":{"invoice_number":"INV-1","currency":"AED"},
+     "c":["item_number","description","quantity","unit_price","total","unit","llm_confidence"],
+     "i":[[1,"Tomato",2,3.5,7,"kg",9.5],[2,"Onion",1,2,2]]}
+
+Null metadata is omitted, trailing nulls in a row may be dropped, and the reply is a
+single line. The expand_* functions turn replies back into the regular shapes, so the
+rest of the pipeline never sees the compact form.
+"""
+from typing import Any, Dict, List, Optional, Sequence
+
+INVOICE_META_FIELDS = [
+    "invoice_number", "invoice_date", "vendor_name", "customer_name", "currency",
+    "subtotal", "tax", "total_amount",
+]
+INVOICE_ITEM_COLUMNS = [
+    "item_number", "description", "quantity", "unit_price", "total", "unit", "llm_confidence",
+]
+CLEANED_ITEM_COLUMNS = ["description", "unit", "quantity", "unit_price", "total", "llm_confidence"]
+CLEANED_BATCH_COLUMNS = ["id"] + CLEANED_ITEM_COLUMNS
+
+
+def _columns_json(columns: Sequence[str]) -> str:
+    return "[" + ",".join(f'"{c}"' for c in columns) + "]"
+
+
+def invoice_output_spec() -> str:
+    """Replacement for the JSON structure block of the extraction prompt."""
+    return f"""Return ONLY a single-line compact JSON object (no pretty printing, no extra spaces):
+{{"m":{{...}},"c":{_columns_json(INVOICE_ITEM_COLUMNS)},"i":[[...],[...]]}}
+- "m": invoice metadata with keys {", ".join(INVOICE_META_FIELDS)}; OMIT keys whose value is null
+- "c": the item column order, exactly as shown
+- "i": one array per line item, values in "c" order; use null for a missing value and drop trailing nulls
+- description and unit are strings; item_number is an integer; quantity, unit_price, total and llm_confidence (0 to 10) are numbers"""
+
+
+def cleaned_item_output_spec() -> str:
+    """Output block for the single DocAI line-item cleaning prompt."""
+    return f"""Return ONLY one compact single-line JSON value:
+1) Cleaned item: an array in this column order {_columns_json(CLEANED_ITEM_COLUMNS)}
+   (total = NET total before VAT; llm_confidence 0..10; null for missing values, trailing nulls may be dropped)
+2) Skip: null"""
+
+
+def cleaned_items_batch_output_spec() -> str:
+    """Output block for the batched DocAI line-item cleaning prompt."""
+    return f"""Clean EACH item independently. Return ONLY a single-line compact JSON object:
+{{"c":{_columns_json(CLEANED_BATCH_COLUMNS)},"r":[["r0","cleaned description","kg",1.5,2.0,3.0,9.5],["r1"]]}}
+- one array per input id, values in "c" order (copy the id back unchanged)
+- total = NET total (before VAT); llm_confidence 0..10; null for missing values, trailing nulls may be dropped
+- a skipped item is just its id: ["<id>"]"""
+
+
+def cleaned_items_output_spec() -> str:
+    """Output block for the whole-invoice DocAI cleaning prompt."""
+    return f"""Your job: return ONLY a single-line compact JSON object:
+{{"c":{_columns_json(CLEANED_ITEM_COLUMNS)},"i":[[...],[...]]}}
+- one array per kept item, values in "c" order (total = NET total before VAT; llm_confidence 0..10)
+- null for missing values, trailing nulls may be dropped; skipped items are omitted"""
+
+
+def _rows(data: Any, key: str, default_columns: List[str]) -> List[Dict[str, Any]]:
+    if not isinstance(data, dict):
+        raise ValueError("Compact reply is not a JSON object")
+    columns = data.get("c") or default_columns
+    if not isinstance(columns, list) or not all(isinstance(c, str) for c in columns):
+        raise ValueError("Compact reply has an invalid column header")
+    rows = data.get(key) or []
+    if not isinstance(rows, list):
+        raise ValueError(f"Compact reply field {key!r} is not an array")
+    expanded = []
+    for row in rows:
+        if isinstance(row, dict):  # model fell back to a regular object
+            expanded.append(row)
+            continue
+        if not isinstance(row, list) or len(row) > len(columns):
+            raise ValueError(f"Compact row does not match the header: {row!r}")
+        expanded.append({col: (row[i] if i < len(row) else None) for i, col in enumerate(columns)})
+    return expanded
+
+
+def expand_invoice(data: Any) -> Dict[str, Any]:
+    """Compact extraction reply -> the regular InvoiceData dict."""
+    if isinstance(data, dict) and "items" in data and "i" not in data:
+        return data
+    items = _rows(data, "i", INVOICE_ITEM_COLUMNS)
+    meta = data.get("m") or {}
+    if not isinstance(meta, dict):
+        raise ValueError("Compact reply field 'm' is not an object")
+    return {**{field: meta.get(field) for field in INVOICE_META_FIELDS}, "items": items}
+
+
+def expand_cleaned_item(data: Any) -> Optional[Dict[str, Any]]:
+    """Compact single-item cleaning reply -> {"skip": true} or the cleaned-item dict."""
+    if data is None:
+        return {"skip": True}
+    if isinstance(data, dict):
+        return data
+    if not isinstance(data, list) or len(data) > len(CLEANED_ITEM_COLUMNS):
+        raise ValueError(f"Compact item does not match the header: {data!r}")
+    return {col: (data[i] if i < len(data) else None) for i, col in enumerate(CLEANED_ITEM_COLUMNS)}
+
+
+def expand_cleaned_items_batch(data: Any) -> Dict[str, Any]:
+    """Compact batch cleaning reply -> {"results": [...]} with skip=true for id-only rows."""
+    if isinstance(data, dict) and "results" in data:
+        return data
+    results = []
+    for row in _rows(data, "r", CLEANED_BATCH_COLUMNS):
+        if all(row.get(col) is None for col in CLEANED_ITEM_COLUMNS) and "skip" not in row:
+            row = {"id": row.get("id"), "skip": True}
+        results.append(row)
+    return {"results": results}
+
+
+def expand_cleaned_items(data: Any) -> Dict[str, Any]:
+    """Compact whole-invoice cleaning reply -> {"items": [...]}."""
+    if isinstance(data, dict) and "items" in data:
+        return data
+    return {"items": _rows(data, "i", CLEANED_ITEM_COLUMNS)}
@@ -36,8 +36,126 @@ class Settings(BaseSettings):
     
     # Processing Settings
     max_file_size_mb: int = 10
-    timeout_seconds: int = 60
+    upload_spool_threshold_mb: int = 5  # API uploads above this go to a temp file, not memory
+    upload_request_memory_mb: int = 64  # batch uploads held in memory per request; the rest spools
+    timeout_seconds: int = 60  # Anthropic read timeout
+
+    # Shared Anthropic HTTP connection pool (one per event loop, process-wide)
+    http_max_connections: int = 100  # size to the max number of in-flight Claude calls
+    http_max_keepalive_connections: int = 50
+    http_keepalive_expiry: float = 60.0
+    http_connect_timeout: float = 10.0
+    http2: bool = False  # requires the h2 package (pip install httpx[http2])
+
+    # Claude rate limiting (set from your Anthropic console tier) and retry policy
+    rate_limit_enabled: bool = True
+    rate_limit_rpm: int = 1000
+    rate_limit_input_tpm: int = 450000
+    rate_limit_output_tpm: int = 90000
+    rate_limit_max_retries: int = 6
+    rate_limit_backoff_base: float = 1.0  # seconds; doubled per attempt, jittered
+    rate_limit_backoff_max: float = 60.0
+
+    # Extraction result cache (content-addressed: input bytes + model + prompt version)
+    cache_enabled: bool = True
+    cache_path: str = "cache/extraction_cache.sqlite3"
+    cache_memory_items: int = 256  # in-memory LRU tier size
+    cache_max_mb: int = 512  # on-disk size budget before LRU eviction
+    cache_ttl_hours: int = 24 * 30  # 0 = never expire
     
+    # Image preprocessing before vision calls (Claude bills ~width*height/750 tokens per image)
+    image_preprocess_enabled: bool = False  # opt-in: compare accuracy on your invoices first
+    image_max_long_edge: int = 1568  # px; 0 = no limit
+    image_max_tokens: int = 1600  # per-image token budget; 0 = no limit
+    image_grayscale: bool = False
+    image_format: str = "jpeg"  # jpeg | webp | png
+    image_quality: int = 85
+    pdf_max_dpi: int = 300  # upper bound; pages are rendered straight at the target size
+    pdf_max_pages: int = 5  # PDF pages extracted in parallel and merged into one invoice
+
+    # Born-digital PDFs: send the PyMuPDF text layer instead of a rendered image
+    text_layer_enabled: bool = True
+    text_layer_min_words: int = 30  # fewer words than this -> treat page as a scan
+
+    # Extraction output budget: max_tokens grows with the expected item count; replies cut
+    # off at max_tokens are continued instead of re-run
+    extraction_max_tokens: int = 4096  # when the item count is unknown (scans/photos)
+    extraction_tokens_per_item: int = 80
+    extraction_max_tokens_cap: int = 16384
+    extraction_max_continuations: int = 2
+
+    # How Claude returns structured data: "json" (JSON in the reply text), "tool"
+    # (forced tool call with a schema derived from the pydantic models) or "compact"
+    # (header + per-item arrays, see compact_format.py; fewer output tokens)
+    structured_output_mode: str = "json"
+
+    # Hybrid mode: run Google DocAI alongside Claude vision and reconcile the rows locally;
+    # only rows the two disagree on go back to Claude (needs the DocAI settings above)
+    hybrid_docai_enabled: bool = False
+
+    # Model cascade: extract with a fast model first, escalate to claude_model on weak results
+    cascade_enabled: bool = False
+    cascade_fast_model: str = "claude-haiku-4-5-20251001"
+    cascade_max_invalid_ratio: float = 0.2  # share of items where qty * unit_price != total
+    cascade_max_low_confidence_share: float = 0.2
+    cascade_low_confidence: float = 8.5  # items below this llm_confidence count as low
+
+    # Vendor layout memory: repeat suppliers get a short vendor-specific prompt; with the
+    # local parser on, digital PDFs are parsed locally once that parse has matched Claude's
+    # extraction N times in a row
+    vendor_profiles_enabled: bool = True
+    vendor_profiles_path: str = "cache/vendor_profiles.sqlite3"
+    vendor_local_parser_enabled: bool = False  # opt-in: replaces Claude for trusted layouts
+    vendor_local_parser_min_matches: int = 2
+
+    # Micro-batching: several single-page photos/scans per Claude request (batch paths only)
+    microbatch_enabled: bool = False
+    microbatch_max_images: int = 4
+    microbatch_max_input_tokens: int = 12000  # images + prompt, estimated
+    microbatch_output_tokens_per_image: int = 1500
+
+    # Claude pricing for cost estimates (USD per million tokens)
+    claude_input_usd_per_mtok: float = 3.0
+    claude_output_usd_per_mtok: float = 15.0
+
+    # Near-duplicate reuse: recompressed, resized or re-photographed copies of an invoice
+    # reuse the earlier extraction (perceptual hashes + a pixel-level check, near_duplicates.py)
+    dedup_enabled: bool = True
+    dedup_path: str = "cache/near_duplicates.sqlite3"
+    dedup_max_entries: int = 5000
+    dedup_phash_max_distance: int = 10  # of 64 bits; hash filter for candidates
+    dedup_dhash_max_distance: int = 20  # of 64 bits
+    dedup_detail_max_diff: float = 1.8  # pixel-level check every candidate must pass; lower = stricter
+
+    # Row-level repair: rows failing qty * unit_price = total are located (text layer or
+    # DocAI boxes), cropped at a higher resolution and re-read in one small call
+    row_repair_enabled: bool = True
+    row_repair_max_rows: int = 8  # more failing rows than this -> leave the invoice as is
+    row_repair_dpi: int = 400  # crop resolution (crops are still capped at image_max_long_edge)
+
+    # DocAI line-item cleaning: items packed per Claude call (bounded by both budgets)
+    docai_clean_batch_max_input_tokens: int = 6000
+    docai_clean_batch_max_items: int = 40
+    docai_clean_output_tokens_per_item: int = 120
+    # Local rule-based pre-cleaner; rows below this rule confidence still go to Claude
+    docai_precleaner_enabled: bool = True
+    docai_precleaner_min_confidence: float = 9.0
+
+    # Admission control (admission.py): extractions in flight at once across all requests,
+    # jobs and scripts; waiting invoices are served round-robin per client and the API
+    # answers 429 + Retry-After while extraction_max_queue invoices are already waiting
+    admission_enabled: bool = True
+    extraction_max_in_flight: int = 16
+    extraction_max_queue: int = 200
+    # API worker threads for rendering/encoding (asyncio.to_thread); 0 = min(32, CPUs + 4)
+    worker_threads: int = 0
+
+    # Background batch jobs (POST /api/jobs); SQLite-backed, resumed after a restart
+    jobs_db_path: str = "cache/jobs.sqlite3"
+    jobs_dir: str = "cache/jobs"  # uploaded files of unfinished jobs
+    jobs_max_concurrent: int = 2  # jobs running at once; later jobs wait as "queued"
+    jobs_chunk_size: int = 4  # files per processing call; results are saved per chunk
+
     # Demo Mode - multiplies occurrences by random 13-23 for demo purposes
     demo: bool = False
 
@@ -102,8 +102,15 @@ class CSVExporter:
                 'success': result.success,
                 'processing_time': result.processing_time,
                 'model_used': result.model_used,
-                'error': result.error if result.error else ''
+                'error': result.error if result.error else '',
+                'route': result.route,
+                'cache_hit': result.cache_hit,
+                'input_tokens': result.input_tokens,
+                'output_tokens': result.output_tokens,
+                'estimated_cost_usd': result.estimated_cost_usd,
             }
+            # One column per stage (seconds); stages an invoice never ran stay empty
+            row.update({f'stage_{stage}': seconds for stage, seconds in result.stage_timings.items()})
             
             if result.success and result.invoice_data:
                 invoice = result.invoice_data
@@ -120,6 +127,8 @@ class CSVExporter:
             rows.append(row)
         
         df = pd.DataFrame(rows)
+        stage_columns = sorted(c for c in df.columns if c.startswith('stage_'))
+        df = df[[c for c in df.columns if not c.startswith('stage_')] + stage_columns]
         
         # Generate filename with timestamp
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
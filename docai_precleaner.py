@@ -0,0 +1,271 @@
+"""Deterministic local cleaner for Google DocAI line items.
+
+Implements the arithmetic from helper/tasks.md / DOCAI_LINE_ITEM_RULES without an LLM:
+- qty × unit_price ≈ total (net)
+- total / 1.05 ≈ qty × unit_price (total is VAT-inclusive gross)
+- infer a missing qty or unit_price from the other two
+- ignore leading row numbers / item codes, drop barcode lines, lowercase units
+
+Rows are only resolved locally when exactly one consistent reading exists; everything
+else is reported as unresolved so the caller can send it to Claude.
+"""
+import hashlib
+import re
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from models import InvoiceItem
+
+VAT_RATE = 0.05
+
+KNOWN_UNITS = {
+    "kg", "g", "gm", "gms", "gram", "grams", "ltr", "l", "lt", "ml",
+    "pc", "pcs", "piece", "pieces", "ea", "each", "unit", "units",
+    "box", "ctn", "carton", "pkt", "pack", "bag", "btl", "bottle",
+    "dz", "doz", "dozen", "tray", "bunch", "tin", "can", "jar", "roll",
+}
+
+# "1,234.50" is one number (_to_float drops the group separators); digits right after
+# "<digit>," are the tail of a malformed group, not a number of their own
+_NUMBER_RE = re.compile(r"(?<![\w.])(?<!\d,)(?:\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?)(?![\w])")
+_BARCODE_LINE_RE = re.compile(r"^\d{6,}$")
+_TRAILING_UNIT_RE = re.compile(r"\s*-\s*([A-Za-z]+)\s*$")
+
+
+@dataclass
+class PreCleanResult:
+    """Outcome of cleaning one DocAI line item locally."""
+    status: str  # "resolved" | "skip" | "unresolved"
+    rule: str
+    item: Optional[InvoiceItem] = None
+
+
+def _to_float(value: Any) -> Optional[float]:
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().replace(",", "")
+    # DocAI reports packed quantities like "0/6" -> 6
+    if "/" in text:
+        text = text.split("/")[-1]
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _close(a: float, b: float, abs_tol: float, rel_tol: float = 0.001) -> bool:
+    return abs(a - b) <= max(abs_tol, rel_tol * abs(b))
+
+
+def _is_net(product: float, total: float) -> bool:
+    # Printed totals are rounded to 2-3 decimals
+    return _close(product, total, abs_tol=0.011)
+
+
+def _is_gross(net: float, total: float) -> bool:
+    return _close(net * (1 + VAT_RATE), total, abs_tol=0.021)
+
+
+def _round_money(value: float) -> float:
+    return round(value, 3)
+
+
+class DocAIPreCleaner:
+    """Rule-based DocAI line-item cleaner with per-run rule-hit counters (thread-safe)."""
+
+    def __init__(self, min_confidence: float = 9.0):
+        self.min_confidence = min_confidence
+        self._lock = threading.Lock()
+        self._rule_hits: Dict[str, int] = {}
+        self._counts = {"total": 0, "resolved": 0, "skipped": 0, "unresolved": 0}
+
+    def fingerprint(self) -> str:
+        """Stable hash of the rules (this module's source) and the confidence threshold."""
+        rules = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:16]
+        return f"{rules}:{self.min_confidence}"
+
+    # ---------- description / unit ----------
+
+    def clean_description(self, docai_item: Dict[str, Any]) -> Tuple[str, Optional[str]]:
+        """Return (cleaned description, unit found in the description or None)."""
+        raw_desc = docai_item.get("description") or docai_item.get("description_raw") or ""
+        unit: Optional[str] = None
+        lines: List[str] = []
+        for line in str(raw_desc).splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if _BARCODE_LINE_RE.match(line):
+                continue
+            if line.lower() in KNOWN_UNITS:
+                unit = unit or line.lower()
+                continue
+            m = _TRAILING_UNIT_RE.search(line)
+            if m and m.group(1).lower() in KNOWN_UNITS:
+                unit = unit or m.group(1).lower()
+                line = line[: m.start()].strip()
+            if line:
+                lines.append(line)
+        return "\n".join(lines), unit
+
+    def detect_unit(self, docai_item: Dict[str, Any], desc_unit: Optional[str]) -> Optional[str]:
+        unit = docai_item.get("unit")
+        if isinstance(unit, str) and unit.strip():
+            return unit.strip().lower()
+        if desc_unit:
+            return desc_unit
+        for word in re.findall(r"[A-Za-z]+", docai_item.get("raw_text") or ""):
+            if word.lower() in {"kg", "pcs", "pc", "ltr", "ctn", "box", "pkt", "btl"}:
+                return word.lower()
+        return None
+
+    # ---------- numbers ----------
+
+    def numeric_tokens(self, docai_item: Dict[str, Any]) -> List[float]:
+        """
+        Numbers from raw_text in reading order, excluding the description text
+        and the leading row numbers / item codes.
+        """
+        raw_text = docai_item.get("raw_text") or ""
+        desc_raw = docai_item.get("description_raw") or docai_item.get("description") or ""
+        if desc_raw and desc_raw in raw_text:
+            raw_text = raw_text.replace(desc_raw, " ", 1)
+        # Leading integers before the first letter are row numbers / item codes
+        m = re.match(r"^[\d\s]*(?=[A-Za-z])", raw_text)
+        if m:
+            raw_text = raw_text[m.end():]
+        tokens: List[float] = []
+        for tok in _NUMBER_RE.findall(raw_text):
+            value = _to_float(tok)
+            if value is not None:
+                tokens.append(value)
+        return tokens
+
+    def _token_solutions(
+        self, tokens: List[float], docai_qty: Optional[float]
+    ) -> List[Tuple[float, float, float, str]]:
+        """
+        Find (qty, unit_price, net_total, rule) readings consistent with the printed numbers.
+        Order constraint: qty before unit_price before totals (invoice column order).
+        """
+        solutions: List[Tuple[float, float, float, str]] = []
+        qty_candidates: List[Tuple[int, float]] = []
+        if docai_qty is not None and docai_qty > 0:
+            qty_candidates.append((-1, docai_qty))
+        qty_candidates.extend((i, v) for i, v in enumerate(tokens) if v > 0)
+
+        for qi, q in qty_candidates:
+            for pi in range(qi + 1, len(tokens)):
+                p = tokens[pi]
+                if p <= 0:
+                    continue
+                net = q * p
+                after = tokens[pi + 1:]
+                has_net = any(_is_net(net, t) for t in after)
+                has_gross = any(_is_gross(net, t) for t in after)
+                if has_net and has_gross:
+                    solutions.append((q, p, net, "tokens_net_and_gross"))
+                elif has_net:
+                    solutions.append((q, p, net, "tokens_net"))
+                elif has_gross:
+                    solutions.append((q, p, net, "tokens_gross"))
+        return solutions
+
+    def _resolve_numbers(
+        self, docai_item: Dict[str, Any]
+    ) -> Optional[Tuple[float, float, float, str, float]]:
+        """Return (qty, unit_price, net_total, rule, confidence) or None if ambiguous."""
+        q = _to_float(docai_item.get("quantity"))
+        p = _to_float(docai_item.get("unit_price"))
+        t = _to_float(docai_item.get("total"))
+
+        # 1) DocAI fields are already consistent
+        if q and p and t:
+            if _is_net(q * p, t):
+                return q, p, t, "fields_net", 9.5
+            if _is_gross(q * p, t):
+                return q, p, q * p, "fields_gross", 9.0
+
+        # 2) Search raw_text numbers for a unique qty × price = net (± 5% VAT) reading
+        tokens = self.numeric_tokens(docai_item)
+        solutions = self._token_solutions(tokens, q)
+        distinct = {(round(sq, 3), round(sp, 3), round(sn, 2)) for sq, sp, sn, _ in solutions}
+        if len(distinct) == 1:
+            sq, sp, sn, rule = solutions[0]
+            # Prefer the strongest evidence among equivalent readings
+            rules = {r for _, _, _, r in solutions}
+            for preferred in ("tokens_net_and_gross", "tokens_net", "tokens_gross"):
+                if preferred in rules:
+                    rule = preferred
+                    break
+            confidence = 9.5 if rule == "tokens_net_and_gross" else 9.0
+            return sq, sp, sn, rule, confidence
+        if len(distinct) > 1:
+            return None
+
+        # 3) Infer the missing field; trust it only if raw_text prints the inferred value
+        if q and t and not p:
+            if any(_is_net(t / q, tok) for tok in tokens):
+                return q, t / q, t, "infer_price", 9.0
+            net = t / (1 + VAT_RATE)
+            if any(_is_net(net / q, tok) for tok in tokens):
+                return q, net / q, net, "infer_price_gross", 8.5
+        if p and t and not q:
+            if any(_is_net(t / p, tok) for tok in tokens):
+                return t / p, p, t, "infer_qty", 9.0
+            net = t / (1 + VAT_RATE)
+            if any(_is_net(net / p, tok) for tok in tokens):
+                return net / p, p, net, "infer_qty_gross", 8.5
+        return None
+
+    # ---------- public API ----------
+
+    def clean(self, docai_item: Dict[str, Any]) -> PreCleanResult:
+        """Clean one DocAI line item; unresolved rows should be sent to the LLM."""
+        desc, desc_unit = self.clean_description(docai_item)
+        if not desc:
+            return self._record(PreCleanResult(status="skip", rule="no_description"))
+
+        resolved = self._resolve_numbers(docai_item)
+        if resolved is None:
+            return self._record(PreCleanResult(status="unresolved", rule="ambiguous"))
+
+        q, p, net, rule, confidence = resolved
+        if confidence < self.min_confidence:
+            return self._record(PreCleanResult(status="unresolved", rule=f"{rule}_low_confidence"))
+
+        item = InvoiceItem(
+            item_number=None,
+            description=desc,
+            quantity=_round_money(q),
+            unit_price=_round_money(p),
+            total=_round_money(net),
+            unit=self.detect_unit(docai_item, desc_unit),
+            llm_confidence=confidence,
+        )
+        return self._record(PreCleanResult(status="resolved", rule=rule, item=item))
+
+    def _record(self, result: PreCleanResult) -> PreCleanResult:
+        with self._lock:
+            self._counts["total"] += 1
+            key = {"resolved": "resolved", "skip": "skipped"}.get(result.status, "unresolved")
+            self._counts[key] += 1
+            self._rule_hits[result.rule] = self._rule_hits.get(result.rule, 0) + 1
+        return result
+
+    def report(self) -> Dict[str, Any]:
+        """Rule-hit ratio for this run (items handled locally vs sent to the LLM)."""
+        with self._lock:
+            counts = dict(self._counts)
+            rule_hits = dict(sorted(self._rule_hits.items(), key=lambda kv: kv[1], reverse=True))
+        total = counts["total"]
+        local = counts["resolved"] + counts["skipped"]
+        return {
+            **counts,
+            "local_ratio": round(local / total, 3) if total else 0.0,
+            "rule_hits": rule_hits,
+        }
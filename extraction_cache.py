@@ -0,0 +1,177 @@
+"""Content-addressed cache for invoice extraction results.
+
+Two tiers:
+- in-memory LRU (hot re-uploads inside one process)
+- on-disk SQLite (survives restarts; shared by the API, benchmark and helper scripts)
+
+Keys are SHA-256 over the input bytes plus every parameter that changes the model output
+(model name, prompt hash, ...), so editing the prompt or switching models invalidates
+old entries automatically.
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from config import settings
+
+
+def make_cache_key(content: bytes, *parts: str) -> str:
+    """Build a cache key from the input bytes and any output-affecting parameters."""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    h.update(content)
+    return h.hexdigest()
+
+
+def text_fingerprint(text: str) -> str:
+    """Short stable hash of a prompt (used as the prompt version)."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class ExtractionCache:
+    """Two-tier (memory LRU + SQLite) cache of serialized extraction results."""
+
+    def __init__(
+        self,
+        db_path: Path,
+        memory_items: int = 256,
+        max_bytes: int = 512 * 1024 * 1024,
+        ttl_seconds: Optional[float] = None,
+    ):
+        self.db_path = Path(db_path)
+        self.memory_items = memory_items
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = {
+            "hits": 0,
+            "misses": 0,
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "expired": 0,
+            "evictions": 0,
+        }
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS extraction_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_extraction_cache_accessed ON extraction_cache(accessed_at)"
+        )
+        self._conn.commit()
+
+    @classmethod
+    def from_settings(cls) -> "ExtractionCache":
+        ttl_hours = settings.cache_ttl_hours
+        return cls(
+            db_path=Path(settings.cache_path),
+            memory_items=settings.cache_memory_items,
+            max_bytes=settings.cache_max_mb * 1024 * 1024,
+            ttl_seconds=ttl_hours * 3600 if ttl_hours > 0 else None,
+        )
+
+    def _expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and (now - created_at) > self.ttl_seconds
+
+    def _remember(self, key: str, value: str, created_at: float) -> None:
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached value for `key`, or None on miss/expiry."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    self._stats["hits"] += 1
+                    self._stats["memory_hits"] += 1
+                    return value
+                self._memory.pop(key, None)
+
+            row = self._conn.execute(
+                "SELECT value, created_at FROM extraction_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+
+            value, created_at = row
+            if self._expired(created_at, now):
+                self._conn.execute("DELETE FROM extraction_cache WHERE key = ?", (key,))
+                self._conn.commit()
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE extraction_cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+            self._remember(key, value, created_at)
+            self._stats["hits"] += 1
+            self._stats["disk_hits"] += 1
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        """Store `value` under `key` and evict least-recently-used rows over the size budget."""
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._remember(key, value, now)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extraction_cache (key, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._evict_locked()
+            self._conn.commit()
+
+    def _evict_locked(self) -> None:
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM extraction_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM extraction_cache ORDER BY accessed_at ASC"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM extraction_cache WHERE key = ?", (key,))
+            self._memory.pop(key, None)
+            total -= size
+            self._stats["evictions"] += 1
+
+    def stats(self) -> Dict[str, int]:
+        """Snapshot of hit/miss counters since this cache was created."""
+        with self._lock:
+            return dict(self._stats)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM extraction_cache")
+            self._conn.commit()
@@ -78,11 +78,12 @@ def main() -> None:
         _write_json(out_dir / f"{base}_docai_raw.json", raw_doc)
         _write_json(out_dir / f"{base}_docai_summary.json", summary)
 
+        candidates = [
+            gi for gi in (summary.get("line_items") or [])
+            if gi.get("description") or gi.get("description_raw")
+        ]
         cleaned_items: List[Dict[str, Any]] = []
-        for gi in (summary.get("line_items") or []):
-            if not (gi.get("description") or gi.get("description_raw")):
-                continue
-            cleaned = processor.clean_item_from_docai_line_item(gi)
+        for gi, cleaned in zip(candidates, processor.clean_items_from_docai_line_items(candidates)):
             if cleaned is None:
                 continue
             cleaned_items.append(
@@ -100,6 +101,11 @@ def main() -> None:
         _write_json(out_dir / f"{base}_cleaned.json", {"items": cleaned_items})
         print(f"✅ cleaned items: {len(cleaned_items)}")
 
+    if processor.precleaner is not None:
+        report = processor.precleaner.report()
+        print(f"\n🧮 Local pre-cleaner: {report['local_ratio'] * 100:.1f}% of items resolved without Claude")
+        print(json.dumps(report, indent=2))
+
 
 if __name__ == "__main__":
     main()
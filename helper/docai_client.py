@@ -115,6 +115,31 @@ def extract_invoice_summary(document_dict: Dict[str, Any]) -> Dict[str, Any]:
     return {**top, "line_items": line_items}
 
 
+def line_item_boxes(document_dict: Dict[str, Any]) -> List[Optional[Dict[str, Any]]]:
+    """
+    Page and bounding box of every line_item entity, aligned with
+    extract_invoice_summary()["line_items"].
+
+    Each entry is {"page": 0-based page index, "box": [x0, y0, x1, y1]} in normalized
+    (0..1) page coordinates, or None when DocAI returned no page anchor for the row.
+    """
+    boxes: List[Optional[Dict[str, Any]]] = []
+    for ent in document_dict.get("entities") or []:
+        etype = (ent.get("type_") or ent.get("type") or "").lower()
+        if etype != "line_item":
+            continue
+        refs = (ent.get("page_anchor") or {}).get("page_refs") or []
+        verts = ((refs[0].get("bounding_poly") or {}).get("normalized_vertices") or []) if refs else []
+        if not verts:
+            boxes.append(None)
+            continue
+        # Proto JSON omits zero coordinates and renders int64 page numbers as strings
+        xs = [float(v.get("x", 0.0)) for v in verts]
+        ys = [float(v.get("y", 0.0)) for v in verts]
+        boxes.append({"page": int(refs[0].get("page", 0)), "box": [min(xs), min(ys), max(xs), max(ys)]})
+    return boxes
+
+
 def process_document_bytes(
     *,
     project_id: str,
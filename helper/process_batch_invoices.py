@@ -13,6 +13,7 @@ import csv
 # Add parent directory to path to import modules
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+from config import settings
 from invoice_processor import InvoiceProcessor
 from models import ProcessingResult
 
@@ -20,6 +21,9 @@ from models import ProcessingResult
 INVOICES_DIR = Path(__file__).parent / "invoices/8576/input"
 OUTPUT_DIR = Path(__file__).parent / "invoices/8576/output"
 MAX_INVOICES = 100
+# Invoices handed to the processor at once when micro-batching is enabled
+# (it packs them into requests of up to MICROBATCH_MAX_IMAGES images)
+CHUNK_SIZE = 16
 
 
 def ensure_output_directory():
@@ -123,36 +127,48 @@ def process_invoices():
     # Initialize processor
     processor = InvoiceProcessor()
     
-    # Process each invoice
+    # Process each invoice (in chunks that share Claude requests with micro-batching)
     successful = 0
     failed = 0
+    total_cost = 0.0
+    chunk_size = CHUNK_SIZE if settings.microbatch_enabled else 1
     
-    for idx, invoice_path in enumerate(to_process, 1):
-        print(f"\n[{idx}/{len(to_process)}] Processing: {invoice_path.name}")
-        
+    for chunk_start in range(0, len(to_process), chunk_size):
+        chunk = to_process[chunk_start:chunk_start + chunk_size]
         try:
-            # Process invoice
-            result = processor.process_invoice(invoice_path)
+            if len(chunk) > 1:
+                results = processor.process_invoices(chunk)
+            else:
+                results = [processor.process_invoice(chunk[0])]
+        except Exception as e:
+            print(f"\n   ❌ Error: {str(e)}")
+            failed += len(chunk)
+            continue
+        
+        for idx, (invoice_path, result) in enumerate(zip(chunk, results), chunk_start + 1):
+            print(f"\n[{idx}/{len(to_process)}] Processed: {invoice_path.name}")
             
             # Get output CSV path
             output_csv = get_output_csv_path(invoice_path)
             
             # Write to CSV
             write_invoice_csv(result, output_csv)
+            total_cost += result.estimated_cost_usd
             
             if result.success:
                 items_count = len(result.invoice_data.items) if result.invoice_data else 0
                 print(f"   ✅ Success! Extracted {items_count} items ({result.processing_time:.2f}s)")
+                if result.batch_size > 1:
+                    print(
+                        f"   📦 Micro-batch of {result.batch_size}: "
+                        f"{result.amortized_time:.2f}s, ${result.estimated_cost_usd:.4f} per invoice (amortized)"
+                    )
                 print(f"   📄 CSV: {output_csv.name}")
                 successful += 1
             else:
                 print(f"   ❌ Failed: {result.error}")
                 print(f"   📄 CSV: {output_csv.name} (error logged)")
                 failed += 1
-                
-        except Exception as e:
-            print(f"   ❌ Error: {str(e)}")
-            failed += 1
     
     # Summary
     print("\n" + "=" * 60)
@@ -161,6 +177,8 @@ def process_invoices():
     print(f"Total Processed: {len(to_process)}")
     print(f"✅ Successful: {successful}")
     print(f"❌ Failed: {failed}")
+    print(f"💰 Estimated Claude cost: ${total_cost:.4f}"
+          + (f" (${total_cost / len(to_process):.4f} per invoice)" if to_process else ""))
     print(f"📁 Output Directory: {OUTPUT_DIR}")
     print("=" * 60)
 
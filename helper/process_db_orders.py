@@ -12,6 +12,7 @@ This script:
 7. Supports parallel processing for faster execution
 """
 
+import json
 import os
 import sys
 import psycopg2
@@ -34,6 +35,8 @@ from invoice_processor import InvoiceProcessor
 from models import InvoiceData, InvoiceItem
 from config import settings
 from docai_client import process_document_bytes, guess_mime_from_name
+from near_duplicates import Fingerprint, fingerprint_bytes
+from rate_limiter import get_rate_limiter
 
 # Load environment variables
 load_dotenv()
@@ -151,7 +154,7 @@ def insert_invoice_items(conn, order_id: int, items: List[InvoiceItem], llm_mode
             item.unit or '',
             float(item.unit_price) if item.unit_price else None,
             float(item.total) if item.total else None,
-            llm_model,
+            getattr(item, "__llm__", None) or llm_model,
             float(getattr(item, "llm_confidence", None)) if getattr(item, "llm_confidence", None) is not None else None,
             Json(google_json) if google_json is not None else None,
         ))
@@ -288,6 +291,11 @@ def process_single_order(
         return (order_id, 0, "No invoice images found")
     
     all_items: List[InvoiceItem] = []
+    # Near-duplicates: skipped inside the order (the same invoice attached twice), reused
+    # across orders (the same S3 image or a recompressed copy attached to another order)
+    duplicates = processor.duplicates
+    duplicate_params = processor.docai_clean_params()
+    order_fingerprints: List[Tuple[int, Fingerprint]] = []
     
     try:
         # Process each invoice
@@ -302,6 +310,24 @@ def process_single_order(
             file_bytes, extension = result
             print(f"      📎 File type: {extension.upper()}")
 
+            fingerprint = fingerprint_bytes(file_bytes, f".{extension}") if duplicates is not None else None
+            if fingerprint is not None:
+                earlier = next((j for j, fp in order_fingerprints if duplicates.same(fingerprint, fp)), None)
+                if earlier is not None:
+                    print(f"      ⏭️  Near-duplicate of invoice {earlier} in this order, skipped")
+                    continue
+                order_fingerprints.append((idx, fingerprint))
+                match = duplicates.find(fingerprint, duplicate_params)
+                if match is not None:
+                    for entry in json.loads(match.value):
+                        item = InvoiceItem(**entry["item"])
+                        setattr(item, "__google_json__", entry["google_json"])
+                        if entry.get("llm"):
+                            setattr(item, "__llm__", entry["llm"])
+                        all_items.append(item)
+                    print(f"      ♻️  Near-duplicate of {match.filename[:60]}: reused its cleaned items")
+                    continue
+
             # 1) Scan invoice with Google Document AI
             print(f"      🔎 Scanning with Google Document AI...")
             mime_type = guess_mime_from_name(f"invoice.{extension}")
@@ -319,19 +345,27 @@ def process_single_order(
                 print(f"      ⚠️  No DocAI line_items found for invoice {idx}")
                 continue
 
-            # 2) Clean each DocAI line_item using Claude (text-only)
-            print(f"      🧹 Cleaning {len(docai_items)} DocAI items with {processor.model}...")
+            # 2) Clean DocAI line_items using Claude (text-only, batched per invoice)
+            candidates = [gi for gi in docai_items if gi.get("description") or gi.get("description_raw")]
+            print(f"      🧹 Cleaning {len(candidates)} DocAI items with {processor.model}...")
             cleaned_count = 0
-            for gi in docai_items:
-                if not (gi.get("description") or gi.get("description_raw")):
-                    continue
-                cleaned = processor.clean_item_from_docai_line_item(gi)
+            cleaned_items = processor.clean_items_from_docai_line_items(candidates)
+            reusable: List[Dict[str, Any]] = []
+            for gi, cleaned in zip(candidates, cleaned_items):
                 if cleaned is None:
                     continue
                 # Attach google_json for DB insertion (not part of Pydantic model)
                 setattr(cleaned, "__google_json__", gi)
                 all_items.append(cleaned)
+                # model_dump() drops the __llm__ provenance tag (e.g. "local-rules"); keep it
+                reusable.append({
+                    "item": cleaned.model_dump(),
+                    "google_json": gi,
+                    "llm": getattr(cleaned, "__llm__", None),
+                })
                 cleaned_count += 1
+            if fingerprint is not None and reusable:
+                duplicates.add(fingerprint, duplicate_params, url, json.dumps(reusable, default=str))
 
             print(f"      ✅ Cleaned {cleaned_count} items from invoice {idx}")
         
@@ -459,6 +493,21 @@ def main():
     print(f"   📦 Total Items: {results['total_items']} items")
     print(f"   ⏱️  Duration: {duration}")
     print(f"   ⚡ Rate: {len(orders) / duration.total_seconds():.2f} orders/sec")
+
+    limiter = get_rate_limiter()
+    if limiter is not None:
+        stats = limiter.stats()
+        print(f"\n🚦 Claude rate limiter:")
+        print(f"   Calls: {stats['calls']} | Throttled: {stats['throttled_calls']} | Retries: {stats['retries']} (429: {stats['rate_limited']}, 529: {stats['overloaded']})")
+        print(f"   Avg queue wait: {stats['avg_queue_wait']:.2f}s | Avg model latency: {stats['avg_model_latency']:.2f}s")
+
+    if processor.precleaner is not None:
+        report = processor.precleaner.report()
+        print(f"\n🧮 Local pre-cleaner:")
+        print(f"   Items: {report['total']} | Resolved: {report['resolved']} | Skipped: {report['skipped']} | Sent to LLM: {report['unresolved']}")
+        print(f"   Rule-hit ratio: {report['local_ratio'] * 100:.1f}%")
+        for rule, hits in report['rule_hits'].items():
+            print(f"   - {rule}: {hits}")
     
     if results['errors']:
         print(f"\n❌ Failed Orders:")
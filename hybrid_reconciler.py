@@ -0,0 +1,141 @@
+"""Local reconciliation of Claude vision items with Google DocAI line items.
+
+Hybrid mode runs DocAI and Claude on the same file at the same time, then compares the
+two readings row by row without another model call:
+- rows are matched greedily by description similarity (plus a bonus for equal totals)
+- DocAI rows are normalized with DocAIPreCleaner (qty × price = total, 5% VAT rules)
+- a row is settled locally when both readings agree, or when only one of them is
+  arithmetically consistent
+- everything else is "disputed" and left for one batched Claude adjudication call
+"""
+import re
+from dataclasses import dataclass, field
+from difflib import SequenceMatcher
+from typing import Any, Dict, List, Optional, Tuple
+
+from docai_precleaner import DocAIPreCleaner, PreCleanResult
+from models import InvoiceItem
+
+MATCH_THRESHOLD = 0.55
+AGREED_CONFIDENCE = 9.5
+
+
+@dataclass
+class RowDecision:
+    """Outcome for one reconciled row."""
+    status: str  # "agreed" | "claude" | "docai" | "disputed"
+    item: Optional[InvoiceItem] = None
+    claude_item: Optional[InvoiceItem] = None
+    docai_row: Optional[Dict[str, Any]] = None
+
+
+@dataclass
+class Reconciliation:
+    rows: List[RowDecision] = field(default_factory=list)
+
+    @property
+    def disputed(self) -> List[RowDecision]:
+        return [r for r in self.rows if r.status == "disputed"]
+
+    def stats(self) -> Dict[str, int]:
+        counts = {"agreed": 0, "claude": 0, "docai": 0, "disputed": 0}
+        for row in self.rows:
+            counts[row.status] += 1
+        return counts
+
+
+def _close(a: Optional[float], b: Optional[float]) -> bool:
+    if a is None or b is None:
+        return a is None and b is None
+    return abs(a - b) <= max(0.011, 0.001 * abs(b))
+
+
+def _consistent(item: InvoiceItem) -> bool:
+    """qty × unit_price = total (net) holds for this item."""
+    if item.quantity is None or item.unit_price is None or item.total is None:
+        return False
+    return _close(item.quantity * item.unit_price, item.total)
+
+
+def _same_numbers(a: InvoiceItem, b: InvoiceItem) -> bool:
+    return _close(a.quantity, b.quantity) and _close(a.unit_price, b.unit_price) and _close(a.total, b.total)
+
+
+def _norm_text(text: str) -> str:
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+def _match_score(claude_item: InvoiceItem, docai_desc: str, docai_item: Optional[InvoiceItem]) -> float:
+    score = SequenceMatcher(None, _norm_text(claude_item.description), _norm_text(docai_desc)).ratio()
+    if docai_item is not None and claude_item.total is not None and _close(claude_item.total, docai_item.total):
+        score += 0.3
+    return score
+
+
+def _with_confidence(item: InvoiceItem, confidence: float) -> InvoiceItem:
+    return item.model_copy(update={"llm_confidence": max(item.llm_confidence or 0.0, confidence)})
+
+
+def _decide(claude_item: InvoiceItem, docai_row: Dict[str, Any], pre: PreCleanResult) -> RowDecision:
+    docai_item = pre.item if pre.status == "resolved" else None
+    claude_ok = _consistent(claude_item)
+    if docai_item is not None and _same_numbers(claude_item, docai_item):
+        return RowDecision("agreed", _with_confidence(claude_item, AGREED_CONFIDENCE), claude_item, docai_row)
+    if claude_ok and docai_item is None:
+        return RowDecision("claude", claude_item, claude_item, docai_row)
+    if docai_item is not None and not claude_ok:
+        fixed = claude_item.model_copy(update={
+            "quantity": docai_item.quantity,
+            "unit_price": docai_item.unit_price,
+            "total": docai_item.total,
+            "unit": claude_item.unit or docai_item.unit,
+            "llm_confidence": docai_item.llm_confidence,
+        })
+        return RowDecision("docai", fixed, claude_item, docai_row)
+    return RowDecision("disputed", None, claude_item, docai_row)
+
+
+def reconcile(
+    claude_items: List[InvoiceItem],
+    docai_rows: List[Dict[str, Any]],
+    precleaner: DocAIPreCleaner,
+) -> Reconciliation:
+    """Match and compare both readings; rows keep Claude's order, DocAI-only rows go last."""
+    cleaned: List[Tuple[str, PreCleanResult]] = []
+    for row in docai_rows:
+        desc, _ = precleaner.clean_description(row)
+        cleaned.append((desc, precleaner.clean(row)))
+
+    candidates: List[Tuple[float, int, int]] = []
+    for ci, claude_item in enumerate(claude_items):
+        for di, (desc, pre) in enumerate(cleaned):
+            if not desc:
+                continue
+            score = _match_score(claude_item, desc, pre.item)
+            if score >= MATCH_THRESHOLD:
+                candidates.append((score, ci, di))
+    candidates.sort(reverse=True)
+
+    pairs: Dict[int, int] = {}
+    used_docai = set()
+    for _, ci, di in candidates:
+        if ci in pairs or di in used_docai:
+            continue
+        pairs[ci] = di
+        used_docai.add(di)
+
+    result = Reconciliation()
+    for ci, claude_item in enumerate(claude_items):
+        di = pairs.get(ci)
+        if di is not None:
+            result.rows.append(_decide(claude_item, docai_rows[di], cleaned[di][1]))
+        elif _consistent(claude_item):
+            result.rows.append(RowDecision("claude", claude_item, claude_item, None))
+        else:
+            result.rows.append(RowDecision("disputed", None, claude_item, None))
+
+    for di, (_, pre) in enumerate(cleaned):
+        # A consistent DocAI row Claude did not return: missed or skipped on purpose
+        if di not in used_docai and pre.status == "resolved":
+            result.rows.append(RowDecision("disputed", None, None, docai_rows[di]))
+    return result
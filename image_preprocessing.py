@@ -0,0 +1,182 @@
+"""Adaptive image preprocessing for Claude vision calls.
+
+Vision cost and upload size scale with pixel count (Claude bills roughly
+width × height / 750 tokens per image). Invoices stay legible well below 300 DPI, so we:
+- render PDFs straight at the target resolution (no 300 DPI render + downscale)
+- downscale photos to a max long edge / token budget
+- optionally convert to grayscale
+- re-encode as JPEG/WebP at a tunable quality
+"""
+import hashlib
+import math
+import time
+from dataclasses import asdict, dataclass
+from io import BytesIO
+from typing import Any, Dict, Optional, Tuple
+
+import fitz  # PyMuPDF
+
+from config import settings
+
+PIXELS_PER_TOKEN = 750
+
+_FORMAT_MIME = {
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "png": "image/png",
+}
+
+
+@dataclass(frozen=True)
+class ImagePreprocessConfig:
+    """Knobs for the latency/accuracy trade-off (see config.Settings.image_*)."""
+    max_long_edge: int = 1568
+    max_tokens: int = 1600
+    grayscale: bool = False
+    format: str = "jpeg"
+    quality: int = 85
+    pdf_max_dpi: int = 300
+
+    @classmethod
+    def from_settings(cls) -> "ImagePreprocessConfig":
+        fmt = settings.image_format.lower()
+        if fmt == "jpg":
+            fmt = "jpeg"
+        if fmt not in _FORMAT_MIME:
+            raise ValueError(f"Unsupported image_format: {settings.image_format}")
+        return cls(
+            max_long_edge=settings.image_max_long_edge,
+            max_tokens=settings.image_max_tokens,
+            grayscale=settings.image_grayscale,
+            format=fmt,
+            quality=settings.image_quality,
+            pdf_max_dpi=settings.pdf_max_dpi,
+        )
+
+    @property
+    def mime_type(self) -> str:
+        return _FORMAT_MIME[self.format]
+
+    def fingerprint(self) -> str:
+        """Stable hash of the settings (part of the extraction cache key)."""
+        return hashlib.sha256(repr(sorted(asdict(self).items())).encode("utf-8")).hexdigest()[:16]
+
+
+def target_scale(width: float, height: float, cfg: ImagePreprocessConfig) -> float:
+    """Scale factor (<= 1) that satisfies both the long-edge and token budgets."""
+    if width <= 0 or height <= 0:
+        return 1.0
+    scale = 1.0
+    if cfg.max_long_edge > 0:
+        scale = min(scale, cfg.max_long_edge / max(width, height))
+    if cfg.max_tokens > 0:
+        max_pixels = cfg.max_tokens * PIXELS_PER_TOKEN
+        scale = min(scale, math.sqrt(max_pixels / (width * height)))
+    return scale
+
+
+def _encode_pil(img: Any, cfg: ImagePreprocessConfig) -> bytes:
+    buf = BytesIO()
+    if cfg.format == "jpeg":
+        if img.mode not in ("L", "RGB"):
+            img = img.convert("RGB")
+        img.save(buf, format="JPEG", quality=cfg.quality, optimize=True)
+    elif cfg.format == "webp":
+        img.save(buf, format="WEBP", quality=cfg.quality, method=4)
+    else:
+        img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+
+def preprocess_image_bytes(
+    image_bytes: bytes,
+    cfg: ImagePreprocessConfig,
+    crop: Optional[Tuple[float, float, float, float]] = None,
+) -> Tuple[bytes, str, Dict[str, Any]]:
+    """Resize / grayscale / re-encode an uploaded photo or scan.
+
+    Args:
+        crop: optional (x0, y0, x1, y1) region in page-relative 0..1 coordinates,
+            cut from the full-resolution image before resizing
+
+    Returns:
+        (image_bytes, mime_type, stats)
+    """
+    from PIL import Image, ImageOps
+
+    t0 = time.perf_counter()
+    img = Image.open(BytesIO(image_bytes))
+    # Phone photos carry their rotation in EXIF; apply it before resizing
+    img = ImageOps.exif_transpose(img)
+    if crop is not None:
+        w, h = img.size
+        x0, y0, x1, y1 = crop
+        img = img.crop((round(x0 * w), round(y0 * h), max(round(x1 * w), 1), max(round(y1 * h), 1)))
+    width, height = img.size
+    if cfg.grayscale:
+        img = img.convert("L")
+    scale = target_scale(width, height, cfg)
+    if scale < 1.0:
+        img = img.resize(
+            (max(1, round(width * scale)), max(1, round(height * scale))),
+            Image.LANCZOS,
+        )
+    t1 = time.perf_counter()
+    out = _encode_pil(img, cfg)
+    t2 = time.perf_counter()
+
+    stats = {
+        "source": "image",
+        "bytes_before": len(image_bytes),
+        "bytes_after": len(out),
+        "width": img.size[0],
+        "height": img.size[1],
+        "render_time": t1 - t0,
+        "encode_time": t2 - t1,
+    }
+    return out, cfg.mime_type, stats
+
+
+def render_pdf_page(
+    page: Any,
+    cfg: ImagePreprocessConfig,
+    clip: Optional[Any] = None,
+) -> Tuple[bytes, str, Dict[str, Any]]:
+    """Render one PyMuPDF page directly at the target resolution and encode it.
+
+    Args:
+        clip: optional fitz.Rect (page coordinates); only that region is rendered and
+            the size budgets apply to the region
+
+    Returns:
+        (image_bytes, mime_type, stats)
+    """
+    t0 = time.perf_counter()
+    max_zoom = cfg.pdf_max_dpi / 72
+    rect = clip if clip is not None else page.rect
+    zoom = max_zoom * target_scale(rect.width * max_zoom, rect.height * max_zoom, cfg)
+    colorspace = fitz.csGRAY if cfg.grayscale else fitz.csRGB
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), colorspace=colorspace, alpha=False, clip=clip)
+    t1 = time.perf_counter()
+
+    if cfg.format == "jpeg":
+        out = pix.tobytes("jpeg", jpg_quality=cfg.quality)
+    elif cfg.format == "png":
+        out = pix.tobytes("png")
+    else:
+        from PIL import Image
+
+        mode = "L" if pix.n == 1 else "RGB"
+        out = _encode_pil(Image.frombytes(mode, (pix.width, pix.height), pix.samples), cfg)
+    t2 = time.perf_counter()
+
+    stats = {
+        "source": "pdf",
+        "dpi": round(zoom * 72, 1),
+        "bytes_after": len(out),
+        "width": pix.width,
+        "height": pix.height,
+        "render_time": t1 - t0,
+        "encode_time": t2 - t1,
+    }
+    return out, cfg.mime_type, stats
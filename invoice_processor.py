@@ -1,27 +1,180 @@
 """Invoice processing using Anthropic Claude (Vision)."""
+import asyncio
 import base64
+import contextvars
+import dataclasses
 import time
 import json
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict, Any
+from typing import Any, AsyncIterator, BinaryIO, Callable, Dict, List, Optional, Sequence, Tuple, Union
 import statistics
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
 from io import BytesIO
 import re
 import fitz  # PyMuPDF
 
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
 
+from admission import Slot, acquire_slot, extraction_slot
+from anthropic_client import get_async_client, request_finished, request_started, run_sync
+from compact_format import (
+    INVOICE_ITEM_COLUMNS,
+    cleaned_item_output_spec,
+    cleaned_items_batch_output_spec,
+    cleaned_items_output_spec,
+    expand_cleaned_item,
+    expand_cleaned_items,
+    expand_cleaned_items_batch,
+    expand_invoice,
+    invoice_output_spec,
+)
 from config import settings
+from docai_precleaner import DocAIPreCleaner
+from extraction_cache import ExtractionCache, make_cache_key, text_fingerprint
+from hybrid_reconciler import reconcile
+from image_preprocessing import ImagePreprocessConfig, preprocess_image_bytes, render_pdf_page
+from invoice_source import InMemoryInvoice, InvoiceSource, open_pdf
 from models import InvoiceData, ProcessingResult, InvoiceItem
+from near_duplicates import DuplicateIndex, DuplicateMatch, Fingerprint, fingerprint_bytes
+from rate_limiter import get_rate_limiter
+from row_repair import RowRegion, failing_rows, is_consistent, locate_in_docai, locate_in_text_layer, scale_fix
+from streaming_json import IncrementalItemParser
+from structured_output import (
+    OUTPUT_MODES,
+    cleaned_item_tool,
+    cleaned_items_batch_tool,
+    cleaned_items_tool,
+    invoice_batch_tool,
+    invoice_tool,
+    tool_input,
+)
+from vendor_profiles import VendorProfile, VendorProfileStore, parse_text_layer
+
+# Per-invoice accumulator for Claude call timings. aprocess_invoice sets a fresh dict;
+# tasks spawned with asyncio.gather inherit the context and add to the same dict.
+_call_metrics: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "invoice_call_metrics", default=None
+)
+_stage_lock = threading.Lock()
+
+# Micro-batching: (file, page input, page stats, cache key, the invoice's own metrics)
+_PreparedInvoice = Tuple[InvoiceSource, Dict[str, Any], Dict[str, Any], Optional[str], Dict[str, float]]
+
+
+def _add_stage_time(stage: str, seconds: float) -> None:
+    """Add to the current invoice's per-stage timings ("stage_<name>" in `_call_metrics`).
+
+    Safe from worker threads: asyncio.to_thread copies the context, so concurrent page
+    renders all add to the same invoice dict.
+    """
+    metrics = _call_metrics.get()
+    if metrics is not None:
+        key = f"stage_{stage}"
+        with _stage_lock:
+            metrics[key] = metrics.get(key, 0.0) + seconds
+
+
+# JSON reply structure shared by the generic and vendor-specific extraction prompts
+INVOICE_JSON_STRUCTURE = """{
+  "invoice_number": "string or null",
+  "invoice_date": "string or null",
+  "vendor_name": "string or null",
+  "customer_name": "string or null",
+  "currency": "string or null",
+  "items": [
+    {
+      "item_number": number or null,
+      "description": "string",
+      "quantity": number or null,
+      "unit_price": number or null,
+      "total": number or null,
+      "unit": "string or null",
+      "llm_confidence": number (0 to 10)
+    }
+  ],
+  "subtotal": number or null,
+  "tax": number or null,
+  "total_amount": number or null
+}
+"""
+
+# Cleaning rules shared by the single-item and batched DocAI line-item prompts
+# (see helper/tasks.md for the worked examples they were derived from).
+DOCAI_LINE_ITEM_RULES = """- If there is no real product description, return {\"skip\": true}.
+- Use raw_text to recover correct numbers.
+- IMPORTANT: raw_text may start with row numbers / item codes (e.g. \"7 1093 ...\", \"10 1107 ...\", \"20 1504 ...\").
+  These leading integers are NOT quantities. Prefer quantity values that appear near the unit (KG) and often have decimals (e.g. 0.100, 1.000).
+- VAT: try to detect 5% VAT:
+  - If (qty * unit_price) ~= total => total is net.
+  - Else if (qty * unit_price)*1.05 ~= total => total is gross; set total = qty * unit_price (net).
+  - Else if total/1.05 ~= qty*unit_price => treat total as gross; set total = qty*unit_price (net).
+  - If unit_price seems to be VAT amount (small) but raw_text contains another plausible unit price that makes math work, use it.
+- If raw_text contains BOTH net and gross totals (common pattern: \"... net vat gross\"), always output total = net (before VAT).
+- Infer missing:
+  - If qty and total exist: unit_price = total/qty (total must be net).
+  - If unit_price and total exist: quantity = total/unit_price (total must be net).
+- Normalize unit to lowercase if present (Kg -> kg).
+- Output numeric types, not strings.
+- Prefer to keep description without embedded barcode lines (remove pure numeric barcode lines).
+- Prefer to clean description by removing trailing unit markers like \"- KG\" and standalone \"KG\" lines (unit goes to the unit field).
+"""
 
 
 class InvoiceProcessor:
     """Processes invoices using Anthropic Claude vision models."""
     
     def __init__(self):
-        """Initialize the processor with Anthropic client."""
-        self.client = Anthropic(api_key=settings.claude_api_key)
+        """Initialize the processor.
+
+        Anthropic clients and their connection pools are process-wide (see
+        anthropic_client); the sync API runs the async implementation on the shared
+        background loop.
+        """
         self.model = settings.claude_model
+        self.output_mode = settings.structured_output_mode.lower()
+        if self.output_mode not in OUTPUT_MODES:
+            raise ValueError(f"Unsupported structured_output_mode: {settings.structured_output_mode}")
+        # Replies per output mode and how many failed to parse/validate
+        self._parse_counts: Dict[str, Dict[str, int]] = {
+            mode: {"replies": 0, "parse_failures": 0} for mode in OUTPUT_MODES
+        }
+        self.cache: Optional[ExtractionCache] = (
+            ExtractionCache.from_settings() if settings.cache_enabled else None
+        )
+        # Running (count, total seconds) per extraction route, for text-layer savings
+        self._route_latency: Dict[str, Tuple[int, float]] = {}
+        self.image_config: Optional[ImagePreprocessConfig] = (
+            ImagePreprocessConfig.from_settings() if settings.image_preprocess_enabled else None
+        )
+        # Cascade outcomes in this process: invoices judged after the fast stage / escalated
+        self._cascade_counts: Dict[str, int] = {"invoices": 0, "escalated": 0}
+        # Row repair outcomes in this process: failing rows, rows located on the page, fixed
+        self._repair_counts: Dict[str, int] = {"invoices": 0, "failing": 0, "located": 0, "repaired": 0}
+        self._stats_lock = threading.Lock()
+        self.vendor_profiles: Optional[VendorProfileStore] = (
+            VendorProfileStore.from_settings() if settings.vendor_profiles_enabled else None
+        )
+        self.duplicates: Optional[DuplicateIndex] = (
+            DuplicateIndex.from_settings() if settings.dedup_enabled else None
+        )
+        # Recent input fingerprints, keyed by (path, size, mtime): batch grouping, the
+        # index lookup and the index write all fingerprint the same file
+        self._fingerprints: "OrderedDict[Tuple[str, int, int], Optional[Fingerprint]]" = OrderedDict()
+        self.precleaner: Optional[DocAIPreCleaner] = (
+            DocAIPreCleaner(min_confidence=settings.docai_precleaner_min_confidence)
+            if settings.docai_precleaner_enabled
+            else None
+        )
+
+    def _async_client(self) -> AsyncAnthropic:
+        """Return the shared AsyncAnthropic client bound to the running event loop."""
+        return get_async_client()
+
+    def _run_sync(self, coro: Any) -> Any:
+        """Run a coroutine on the shared background loop and block until it finishes."""
+        return run_sync(coro)
     
     def pdf_to_images(self, pdf_path: Path, max_pages: int = 5) -> List[bytes]:
         """Convert PDF pages to images.
@@ -55,11 +208,22 @@ class InvoiceProcessor:
         Returns:
             Base64 encoded string
         """
-        return base64.b64encode(image_bytes).decode('utf-8')
+        start = time.perf_counter()
+        encoded = base64.b64encode(image_bytes).decode('utf-8')
+        _add_stage_time("base64", time.perf_counter() - start)
+        return encoded
     
+    def _with_output_spec(self, prompt: str, start: str, end: str, spec: str) -> str:
+        """In compact output mode, swap the prompt's JSON structure block (start..end) for `spec`."""
+        if self.output_mode != "compact":
+            return prompt
+        i = prompt.index(start)
+        j = prompt.index(end, i)
+        return prompt[:i] + spec + "\n\n" + prompt[j:]
+
     def create_extraction_prompt(self) -> str:
         """Create the prompt for invoice data extraction."""
-        return """You are an expert invoice data extractor. Analyze this invoice image and extract ALL items in a structured format.
+        prompt = """You are an expert invoice data extractor. Analyze this invoice image and extract ALL items in a structured format.
 
 Extract the following information:
 1. Invoice metadata (number, date, vendor, customer, currency)
@@ -74,28 +238,7 @@ Extract the following information:
 3. Financial totals (subtotal, tax, total amount)
 
 Return ONLY a valid JSON object with this exact structure:
-{
-  "invoice_number": "string or null",
-  "invoice_date": "string or null",
-  "vendor_name": "string or null",
-  "customer_name": "string or null",
-  "currency": "string or null",
-  "items": [
-    {
-      "item_number": number or null,
-      "description": "string",
-      "quantity": number or null,
-      "unit_price": number or null,
-      "total": number or null,
-      "unit": "string or null",
-      "llm_confidence": number (0 to 10)
-    }
-  ],
-  "subtotal": number or null,
-  "tax": number or null,
-  "total_amount": number or null
-}
-
+""" + INVOICE_JSON_STRUCTURE + """
 CRITICAL VALIDATION RULES:
 - For each item, VERIFY that: quantity × unit_price = total (net amount)
 - The "total" field should be the NET AMOUNT or AMOUNT BEFORE TAX (NOT the gross total with VAT)
@@ -124,126 +267,569 @@ Important:
 - Ensure all numbers are numeric types (not strings)
 - ALWAYS validate: quantity × unit_price = total
 - Return ONLY valid JSON, no additional text"""
+        return self._with_output_spec(
+            prompt,
+            "Return ONLY a valid JSON object with this exact structure:",
+            "CRITICAL VALIDATION RULES:",
+            invoice_output_spec(),
+        )
     
-    def process_with_claude(self, image_bytes: bytes, mime_type: str) -> InvoiceData:
-        """Process invoice using Anthropic Claude Vision.
-        
-        Args:
-            image_bytes: Image bytes of the invoice
-            mime_type: MIME type for the image (image/png, image/jpeg, ...)
-            
-        Returns:
-            Extracted invoice data
+    def create_vendor_extraction_prompt(self, profile: VendorProfile) -> str:
         """
-        base64_image = self.encode_image_base64(image_bytes)
-        
-        message = self.client.messages.create(
-            model=self.model,
-            max_tokens=4096,
-            temperature=0,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image",
-                            "source": {
-                                "type": "base64",
-                                "media_type": mime_type,
-                                "data": base64_image,
-                            },
-                        },
-                        {"type": "text", "text": self.create_extraction_prompt()},
-                    ],
-                }
-            ],
+        Short extraction prompt for a repeat vendor whose table layout is known (see
+        vendor_profiles): the learned column mapping replaces the generic column-detection rules.
+        """
+        columns = profile.columns
+        fields = profile.column_fields
+        layout = [
+            f"- Line-item table columns, left to right: {' | '.join(columns)}",
+            f"- description = \"{columns[fields['description']]}\", quantity = \"{columns[fields['quantity']]}\", "
+            f"unit_price = \"{columns[fields['unit_price']]}\", total = \"{columns[fields['total']]}\"",
+        ]
+        if "unit" in fields:
+            layout.append(f"- unit = \"{columns[fields['unit']]}\"")
+        ignored = [c for i, c in enumerate(columns) if i not in fields.values()]
+        if ignored:
+            layout.append(f"- Ignore the other columns ({', '.join(ignored)}); never use them for total")
+        if profile.vat_convention == "gross":
+            rate = f" ({profile.vat_rate:.0%})" if profile.vat_rate else ""
+            layout.append(f"- The printed line totals INCLUDE VAT{rate}: return total = quantity × unit_price (net)")
+        if profile.units:
+            layout.append(f"- Usual units: {', '.join(profile.units[:8])}")
+        if profile.currency:
+            layout.append(f"- Currency: {profile.currency}")
+        prompt = f"""You are an expert invoice data extractor. Analyze this invoice image from {profile.vendor_name} and extract the metadata, ALL line items and the totals.
+
+Known layout for this vendor (learned from earlier invoices):
+{chr(10).join(layout)}
+
+Return ONLY a valid JSON object with this exact structure:
+{INVOICE_JSON_STRUCTURE}
+Rules:
+- total is the NET amount (before VAT); VERIFY quantity × unit_price = total for each item
+- Preserve decimals exactly as printed; keep descriptions exactly as they appear
+- llm_confidence 0..10; below 8.5 if you cannot read all values of a row
+- Use null for missing values; numbers as numeric types
+- Return ONLY valid JSON, no additional text"""
+        return self._with_output_spec(
+            prompt,
+            "Return ONLY a valid JSON object with this exact structure:",
+            "Rules:",
+            invoice_output_spec(),
         )
 
-        # Join all returned text blocks (Claude returns content blocks)
-        result_text = "".join(
+    def create_batch_extraction_prompt(self, keys: List[str]) -> str:
+        """
+        Micro-batch prompt: several separate invoice images in one request, each preceded
+        by its key. Per-invoice rules and structure are those of the regular prompt.
+        """
+        return f"""This request contains {len(keys)} SEPARATE invoices ({", ".join(keys)}); each image is preceded by its key.
+Extract every invoice independently and never move line items between invoices.
+
+The instructions below describe ONE invoice. Apply them to each image, then return ONLY one JSON object:
+{{"invoices": [{{"key": "{keys[0]}", ...that invoice's fields...}}, ...]}}
+with exactly one entry per key, in the same order.
+
+{self.create_extraction_prompt()}"""
+
+    def _build_vision_messages(
+        self, base64_image: str, mime_type: str, prompt: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Build the Messages API payload for a single invoice image."""
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "image",
+                        "source": {
+                            "type": "base64",
+                            "media_type": mime_type,
+                            "data": base64_image,
+                        },
+                    },
+                    {"type": "text", "text": prompt or self.create_extraction_prompt()},
+                ],
+            }
+        ]
+
+    @staticmethod
+    def _response_text(message: Any, strip: bool = True) -> str:
+        """Join all returned text blocks (Claude returns content blocks)."""
+        text = "".join(
             block.text for block in message.content if getattr(block, "type", None) == "text"
-        ).strip()
-        
-        # Extract JSON from response
-        json_str = result_text.strip()
+        )
+        return text.strip() if strip else text
+
+    @staticmethod
+    def _strip_code_fences(text: str) -> str:
+        json_str = text.strip()
         if json_str.startswith("```json"):
             json_str = json_str[7:]
         if json_str.startswith("```"):
             json_str = json_str[3:]
         if json_str.endswith("```"):
             json_str = json_str[:-3]
-        json_str = json_str.strip()
-        
-        # Parse and validate
-        data = json.loads(json_str)
-        return InvoiceData(**data)
+        return json_str.strip()
+
+    @staticmethod
+    def _extract_first_json(text: str) -> str:
+        """Find first JSON object/array and return that slice."""
+        start = None
+        opening = None
+        for i, ch in enumerate(text):
+            if ch == "{" or ch == "[":
+                start = i
+                opening = ch
+                break
+        if start is None or opening is None:
+            return text
+
+        closing = "}" if opening == "{" else "]"
+        depth = 0
+        in_str = False
+        esc = False
+        for j in range(start, len(text)):
+            c = text[j]
+            if in_str:
+                if esc:
+                    esc = False
+                    continue
+                if c == "\\":
+                    esc = True
+                    continue
+                if c == "\"":
+                    in_str = False
+                continue
+
+            if c == "\"":
+                in_str = True
+                continue
+            if c == opening:
+                depth += 1
+            elif c == closing:
+                depth -= 1
+                if depth == 0:
+                    return text[start : j + 1]
+        return text[start:]
+
+    def _estimate_input_tokens(self, messages: List[Dict[str, Any]]) -> int:
+        """Rough input size for rate limiting (exact usage is settled after the call)."""
+        tokens = 0
+        for msg in messages:
+            for block in msg.get("content") or []:
+                if block.get("type") == "text":
+                    tokens += self._estimate_tokens(block.get("text") or "")
+                elif block.get("type") == "image":
+                    tokens += settings.image_max_tokens if self.image_config is not None else 1600
+        return tokens
 
-    def _call_claude_json(self, prompt: str, max_tokens: int = 4096) -> Any:
+    async def _acreate_message(
+        self,
+        messages: List[Dict[str, Any]],
+        max_tokens: int,
+        model: Optional[str] = None,
+        tool: Optional[Dict[str, Any]] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> Any:
         """
-        Call Claude with a text-only prompt and return parsed JSON.
+        Single entry point for Claude calls: shared rate limiter, 429/529-aware retries,
+        and per-invoice queue-wait vs model-latency accounting.
+        `model` overrides self.model (used by the cascade's fast stage); `tool` forces
+        Claude to answer through that tool (structured output mode). With `on_delta` the
+        reply is streamed and every text / tool-input chunk is passed to it as it arrives;
+        the assembled message is returned either way.
         """
-        message = self.client.messages.create(
-            model=self.model,
-            max_tokens=max_tokens,
-            temperature=0,
-            messages=[{"role": "user", "content": [{"type": "text", "text": prompt}]}],
+        extra: Dict[str, Any] = {}
+        if tool is not None:
+            extra = {"tools": [tool], "tool_choice": {"type": "tool", "name": tool["name"]}}
+        if on_delta is not None:
+            extra["stream"] = True
+
+        async def make_request():
+            # In flight until the reply is complete: a streamed reply ends after
+            # _aconsume_stream below
+            request_started()
+            try:
+                response = await self._async_client().messages.create(
+                    model=model or self.model,
+                    max_tokens=max_tokens,
+                    temperature=0,
+                    messages=messages,
+                    **extra,
+                )
+            except BaseException:
+                request_finished(failed=True)
+                raise
+            if on_delta is None:
+                request_finished()
+            return response
+
+        reserved_input = self._estimate_input_tokens(messages) + (
+            self._estimate_tokens(json.dumps(tool)) if tool is not None else 0
         )
+        # Reserve a typical reply, not max_tokens; settled with real usage afterwards
+        reserved_output = max(256, max_tokens // 4)
+        limiter = get_rate_limiter()
+        if limiter is None:
+            t0 = time.monotonic()
+            message = await make_request()
+            timing = {"queue_wait": 0.0, "model_latency": time.monotonic() - t0, "retries": 0}
+        else:
+            message, timing = await limiter.call(
+                make_request,
+                input_tokens=reserved_input,
+                output_tokens=reserved_output,
+            )
 
-        result_text = "".join(
-            block.text for block in message.content if getattr(block, "type", None) == "text"
-        ).strip()
+        if on_delta is not None:
+            t0 = time.monotonic()
+            failed = True
+            try:
+                message = await self._aconsume_stream(message, on_delta)
+                failed = False
+            finally:
+                request_finished(failed)
+            timing["model_latency"] += time.monotonic() - t0
+            if limiter is not None:
+                # limiter.call only saw the stream handle, not the final usage
+                limiter.settle(
+                    reserved_input,
+                    reserved_output,
+                    message.usage.input_tokens,
+                    message.usage.output_tokens,
+                )
 
-        json_str = result_text.strip()
-        if json_str.startswith("```json"):
-            json_str = json_str[7:]
-        if json_str.startswith("```"):
-            json_str = json_str[3:]
-        if json_str.endswith("```"):
-            json_str = json_str[:-3]
-        json_str = json_str.strip()
-
-        def _extract_first_json(text: str) -> str:
-            # Find first JSON object/array and return that slice.
-            start = None
-            opening = None
-            for i, ch in enumerate(text):
-                if ch == "{" or ch == "[":
-                    start = i
-                    opening = ch
+        metrics = _call_metrics.get()
+        if metrics is not None:
+            metrics["queue_wait"] = metrics.get("queue_wait", 0.0) + timing["queue_wait"]
+            metrics["model_latency"] = metrics.get("model_latency", 0.0) + timing["model_latency"]
+            metrics["retries"] = metrics.get("retries", 0) + timing["retries"]
+            metrics["calls"] = metrics.get("calls", 0) + 1
+            usage = getattr(message, "usage", None)
+            if usage is not None:
+                metrics["input_tokens"] = metrics.get("input_tokens", 0) + (getattr(usage, "input_tokens", 0) or 0)
+                metrics["output_tokens"] = metrics.get("output_tokens", 0) + (getattr(usage, "output_tokens", 0) or 0)
+        return message
+
+    @staticmethod
+    async def _aconsume_stream(stream: Any, on_delta: Callable[[str], None]) -> Any:
+        """
+        Read a raw Messages event stream, forwarding text / tool-input deltas, and
+        assemble a message-like object (content, stop_reason, usage) from it.
+        """
+        blocks: List[Dict[str, Any]] = []
+        stop_reason = None
+        input_tokens = output_tokens = 0
+        try:
+            async for event in stream:
+                if event.type == "message_start":
+                    input_tokens = getattr(event.message.usage, "input_tokens", 0) or 0
+                elif event.type == "content_block_start":
+                    block = event.content_block
+                    blocks.append({"type": block.type, "name": getattr(block, "name", None), "parts": []})
+                elif event.type == "content_block_delta" and blocks:
+                    delta = event.delta
+                    chunk = getattr(delta, "text", None) if delta.type == "text_delta" else (
+                        getattr(delta, "partial_json", None) if delta.type == "input_json_delta" else None
+                    )
+                    if chunk:
+                        blocks[-1]["parts"].append(chunk)
+                        on_delta(chunk)
+                elif event.type == "message_delta":
+                    stop_reason = getattr(event.delta, "stop_reason", None) or stop_reason
+                    output_tokens = getattr(event.usage, "output_tokens", 0) or output_tokens
+        finally:
+            await stream.close()
+
+        content = []
+        for block in blocks:
+            raw = "".join(block["parts"])
+            if block["type"] == "tool_use":
+                try:
+                    tool_args = json.loads(raw or "{}")
+                except ValueError:
+                    tool_args = None  # truncated tool input; tool_input() reports it
+                content.append(SimpleNamespace(type="tool_use", name=block["name"], input=tool_args))
+            elif block["type"] == "text":
+                content.append(SimpleNamespace(type="text", text=raw))
+        return SimpleNamespace(
+            content=content,
+            stop_reason=stop_reason,
+            usage=SimpleNamespace(input_tokens=input_tokens, output_tokens=output_tokens),
+        )
+
+    def _record_parse(self, mode: str, failed: bool) -> None:
+        with self._stats_lock:
+            self._parse_counts[mode]["replies"] += 1
+            self._parse_counts[mode]["parse_failures"] += 1 if failed else 0
+
+    def parse_stats(self) -> Dict[str, Any]:
+        """Parse-failure rate per output mode (json vs tool) for this process."""
+        with self._stats_lock:
+            counts = {mode: dict(c) for mode, c in self._parse_counts.items()}
+        for c in counts.values():
+            c["failure_rate"] = c["parse_failures"] / c["replies"] if c["replies"] else 0.0
+        return {"mode": self.output_mode, **counts}
+
+    def _tool_for(self, factory: Any) -> Optional[Dict[str, Any]]:
+        """Tool definition to force in "tool" output mode, None in "json" mode."""
+        return factory() if self.output_mode == "tool" else None
+
+    async def _acomplete(
+        self,
+        messages: List[Dict[str, Any]],
+        max_tokens: int,
+        model: Optional[str] = None,
+        tool: Optional[Dict[str, Any]] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> Tuple[Any, str]:
+        """
+        `_acreate_message` that recovers from `stop_reason == "max_tokens"`.
+
+        JSON mode: the partial reply is sent back as an assistant prefill and Claude
+        continues where it stopped (nothing already generated is paid for twice).
+        Tool mode: tool input cannot be resumed, so the call is repeated with a doubled
+        max_tokens (up to settings.extraction_max_tokens_cap); that repeat is not streamed.
+
+        Returns:
+            (last message, full reply text; "" in tool mode)
+        """
+        message = await self._acreate_message(
+            messages, max_tokens=max_tokens, model=model, tool=tool, on_delta=on_delta
+        )
+        text = self._response_text(message) if tool is None else ""
+        continuations = 0
+        extra_latency = 0.0
+        while (
+            getattr(message, "stop_reason", None) == "max_tokens"
+            and continuations < settings.extraction_max_continuations
+        ):
+            start = time.perf_counter()
+            if tool is None:
+                # Prefill must not end with whitespace
+                text = text.rstrip()
+                message = await self._acreate_message(
+                    messages + [{"role": "assistant", "content": [{"type": "text", "text": text}]}],
+                    max_tokens=max_tokens,
+                    model=model,
+                    on_delta=on_delta,
+                )
+                # Keep leading whitespace: the continuation may resume inside a JSON string
+                text += self._response_text(message, strip=False)
+            else:
+                if max_tokens >= settings.extraction_max_tokens_cap:
                     break
-            if start is None or opening is None:
-                return text
-
-            closing = "}" if opening == "{" else "]"
-            depth = 0
-            in_str = False
-            esc = False
-            for j in range(start, len(text)):
-                c = text[j]
-                if in_str:
-                    if esc:
-                        esc = False
-                        continue
-                    if c == "\\":
-                        esc = True
-                        continue
-                    if c == "\"":
-                        in_str = False
-                    continue
+                max_tokens = min(settings.extraction_max_tokens_cap, max_tokens * 2)
+                message = await self._acreate_message(messages, max_tokens=max_tokens, model=model, tool=tool)
+            continuations += 1
+            extra_latency += time.perf_counter() - start
 
-                if c == "\"":
-                    in_str = True
-                    continue
-                if c == opening:
-                    depth += 1
-                elif c == closing:
-                    depth -= 1
-                    if depth == 0:
-                        return text[start : j + 1]
-            return text[start:]
+        metrics = _call_metrics.get()
+        if metrics is not None and continuations:
+            metrics["continuations"] = metrics.get("continuations", 0) + continuations
+            metrics["continuation_latency"] = metrics.get("continuation_latency", 0.0) + extra_latency
+        return message, text
+
+    def _extraction_max_tokens(self, expected_items: Optional[int]) -> int:
+        """Output budget for an extraction, sized from the expected number of line items."""
+        if expected_items is None:
+            return settings.extraction_max_tokens
+        return min(
+            settings.extraction_max_tokens_cap,
+            max(1024, 512 + settings.extraction_tokens_per_item * expected_items),
+        )
+
+    @staticmethod
+    def _expected_rows(page_text: str) -> int:
+        """Text-layer rows that look like line items (at least two numbers on the row)."""
+        return sum(1 for line in page_text.splitlines() if len(re.findall(r"\d+(?:[.,]\d+)?", line)) >= 2)
+
+    async def _aextract_invoice(
+        self,
+        messages: List[Dict[str, Any]],
+        model: Optional[str] = None,
+        expected_items: Optional[int] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> InvoiceData:
+        """Send an extraction request and parse the reply (JSON text or tool input) into InvoiceData."""
+        tool = self._tool_for(invoice_tool)
+        message, text = await self._acomplete(
+            messages,
+            max_tokens=self._extraction_max_tokens(expected_items),
+            model=model,
+            tool=tool,
+            on_delta=on_delta,
+        )
+
+        # Parse and validate
+        parse_start = time.perf_counter()
+        try:
+            if tool is not None:
+                data = tool_input(message, tool["name"])
+            else:
+                data = json.loads(self._strip_code_fences(text))
+                if self.output_mode == "compact":
+                    data = expand_invoice(data)
+            invoice = InvoiceData(**data)
+        except (TypeError, ValueError):
+            self._record_parse(self.output_mode, failed=True)
+            raise
+        finally:
+            _add_stage_time("parse", time.perf_counter() - parse_start)
+        self._record_parse(self.output_mode, failed=False)
+        return invoice
+
+    async def _aextract_invoice_batch(
+        self, messages: List[Dict[str, Any]], keys: List[str], max_tokens: int
+    ) -> Dict[str, InvoiceData]:
+        """
+        Send a micro-batched extraction request and split the reply per key.
+
+        Raises ValueError if the reply as a whole does not parse; keys whose entry is
+        missing or invalid are simply absent from the returned mapping.
+        """
+        tool = self._tool_for(invoice_batch_tool)
+        message, text = await self._acomplete(messages, max_tokens=max_tokens, tool=tool)
+        parse_start = time.perf_counter()
+        try:
+            if tool is not None:
+                data = tool_input(message, tool["name"])
+            else:
+                data = json.loads(self._strip_code_fences(text))
+            entries = data.get("invoices") if isinstance(data, dict) else None
+            if not isinstance(entries, list):
+                raise ValueError("Batch reply has no invoices array")
+        except (TypeError, ValueError):
+            self._record_parse(self.output_mode, failed=True)
+            raise
+        self._record_parse(self.output_mode, failed=False)
+
+        invoices: Dict[str, InvoiceData] = {}
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            key = str(entry.pop("key", ""))
+            if key not in keys or key in invoices:
+                continue
+            try:
+                if tool is None and self.output_mode == "compact":
+                    entry = expand_invoice(entry)
+                invoices[key] = InvoiceData(**entry)
+            except (TypeError, ValueError):
+                continue  # this invoice falls back to its own request
+        _add_stage_time("parse", time.perf_counter() - parse_start)
+        return invoices
+
+    async def aprocess_with_claude(
+        self,
+        image_bytes: bytes,
+        mime_type: str,
+        model: Optional[str] = None,
+        expected_items: Optional[int] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+        prompt: Optional[str] = None,
+    ) -> InvoiceData:
+        """Process invoice using Anthropic Claude Vision (async).
+        
+        Args:
+            image_bytes: Image bytes of the invoice
+            mime_type: MIME type for the image (image/png, image/jpeg, ...)
+            model: Claude model override (defaults to settings.claude_model)
+            expected_items: Expected line items, if known (sizes max_tokens)
+            on_delta: Stream the reply and pass each text chunk to this callback
+            prompt: Extraction prompt override (vendor-specific prompt)
+            
+        Returns:
+            Extracted invoice data
+        """
+        # base64 of a multi-megabyte scan is CPU work; keep it off the event loop
+        base64_image = await asyncio.to_thread(self.encode_image_base64, image_bytes)
+        return await self._aextract_invoice(
+            self._build_vision_messages(base64_image, mime_type, prompt),
+            model=model,
+            expected_items=expected_items,
+            on_delta=on_delta,
+        )
+
+    def create_text_extraction_prompt(self, page_text: str, prompt: Optional[str] = None) -> str:
+        """Extraction prompt for born-digital PDFs: same rules, text layer instead of an image."""
+        prompt = (prompt or self.create_extraction_prompt()).replace(
+            "Analyze this invoice image",
+            "Analyze this invoice text (taken from the PDF text layer: one line per visual row, "
+            "columns separated by \" | \")",
+            1,
+        )
+        return f"{prompt}\n\nInvoice text:\n{page_text}"
+
+    async def aprocess_text_with_claude(
+        self,
+        page_text: str,
+        model: Optional[str] = None,
+        expected_items: Optional[int] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+        prompt: Optional[str] = None,
+    ) -> InvoiceData:
+        """Process a digital PDF page from its text layer (no vision tokens)."""
+        return await self._aextract_invoice(
+            [{"role": "user", "content": [{"type": "text", "text": self.create_text_extraction_prompt(page_text, prompt)}]}],
+            model=model,
+            expected_items=expected_items if expected_items is not None else self._expected_rows(page_text),
+            on_delta=on_delta,
+        )
+
+    def process_with_claude(self, image_bytes: bytes, mime_type: str) -> InvoiceData:
+        """Sync wrapper around `aprocess_with_claude`."""
+        return self._run_sync(self.aprocess_with_claude(image_bytes, mime_type))
+
+    async def _acall_claude_json(
+        self,
+        prompt: str,
+        max_tokens: int = 4096,
+        tool: Optional[Dict[str, Any]] = None,
+        expand: Optional[Callable[[Any], Any]] = None,
+        content: Optional[List[Dict[str, Any]]] = None,
+    ) -> Any:
+        """
+        Call Claude with a text prompt and return parsed JSON.
+        With a `tool` (structured output mode) the tool-call arguments are returned instead;
+        in compact output mode `expand` turns the compact reply back into the regular shape.
+        `content` blocks (e.g. labelled image crops) are sent after the prompt.
+        """
+        message, text = await self._acomplete(
+            [{"role": "user", "content": [{"type": "text", "text": prompt}, *(content or [])]}],
+            max_tokens=max_tokens,
+            tool=tool,
+        )
+
+        compact = tool is None and self.output_mode == "compact" and expand is not None
+        mode = "tool" if tool is not None else "compact" if compact else "json"
+        try:
+            if tool is not None:
+                data = tool_input(message, tool["name"])
+            else:
+                json_str = self._strip_code_fences(text)
+                snippet = self._extract_first_json(json_str)
+                data = json.loads(snippet)
+                if compact:
+                    data = expand(data)
+        except ValueError:
+            self._record_parse(mode, failed=True)
+            raise
+        self._record_parse(mode, failed=False)
+        return data
 
-        snippet = _extract_first_json(json_str)
-        return json.loads(snippet)
+    def _call_claude_json(
+        self,
+        prompt: str,
+        max_tokens: int = 4096,
+        tool: Optional[Dict[str, Any]] = None,
+        expand: Optional[Callable[[Any], Any]] = None,
+    ) -> Any:
+        """Sync wrapper around `_acall_claude_json`."""
+        return self._run_sync(
+            self._acall_claude_json(prompt=prompt, max_tokens=max_tokens, tool=tool, expand=expand)
+        )
 
     def create_docai_clean_prompt(self, invoice_summary: Dict[str, Any]) -> str:
         """
@@ -256,7 +842,7 @@ Important:
         - Use raw_text heavily to recover correct numbers when DocAI picked VAT amount or wrong column.
         """
         # Keep the prompt deterministic and short; the model gets the structured JSON.
-        return f"""You are an expert invoice line-item cleaner.
+        prompt = f"""You are an expert invoice line-item cleaner.
 
 Input is a JSON object produced from Google Document AI INVOICE_PROCESSOR. It contains:
 - invoice metadata (invoice_number, invoice_date, vendor_name, customer_name, currency, total_amount)
@@ -299,19 +885,29 @@ Cleaning rules (VERY IMPORTANT):
 Input JSON:
 {json.dumps(invoice_summary, ensure_ascii=False)}
 """
+        return self._with_output_spec(
+            prompt,
+            "Your job: return ONLY",
+            "Cleaning rules (VERY IMPORTANT):",
+            cleaned_items_output_spec(),
+        )
+
+    @staticmethod
+    def _raw_numbers_tail(docai_item: Dict[str, Any]) -> List[str]:
+        raw_text = (docai_item.get("raw_text") or "").strip()
+        # Numeric tokens from raw_text help spot "net/vat/gross" patterns and ignore row numbers.
+        # We keep tail only to avoid huge prompts.
+        raw_numbers = [m.group(0) for m in re.finditer(r"(?<![\\w/])\\d+(?:\\.\\d+)?", raw_text)]
+        return raw_numbers[-10:]
 
     def create_docai_line_item_clean_prompt(self, docai_item: Dict[str, Any]) -> str:
         """
         Clean a single DocAI line_item dict into one cleaned item (or skip).
         This is used when we want to store google_json per DB row.
         """
-        raw_text = (docai_item.get("raw_text") or "").strip()
-        # Numeric tokens from raw_text help spot "net/vat/gross" patterns and ignore row numbers.
-        # We keep tail only to avoid huge prompts.
-        raw_numbers = [m.group(0) for m in re.finditer(r"(?<![\\w/])\\d+(?:\\.\\d+)?", raw_text)]
-        raw_numbers_tail = raw_numbers[-10:]
+        raw_numbers_tail = self._raw_numbers_tail(docai_item)
 
-        return f"""You are an expert invoice line-item cleaner.
+        prompt = f"""You are an expert invoice line-item cleaner.
 
 Input is ONE line item extracted by Google Document AI INVOICE_PROCESSOR with:
 - raw_text
@@ -334,71 +930,346 @@ Return ONLY a valid JSON object with one of these shapes:
 {{ "skip": true }}
 
 Rules:
-- If there is no real product description, return {{\"skip\": true}}.
-- Use raw_text to recover correct numbers.
-- IMPORTANT: raw_text may start with row numbers / item codes (e.g. \"7 1093 ...\", \"10 1107 ...\", \"20 1504 ...\").
-  These leading integers are NOT quantities. Prefer quantity values that appear near the unit (KG) and often have decimals (e.g. 0.100, 1.000).
-- VAT: try to detect 5% VAT:
-  - If (qty * unit_price) ~= total => total is net.
-  - Else if (qty * unit_price)*1.05 ~= total => total is gross; set total = qty * unit_price (net).
-  - Else if total/1.05 ~= qty*unit_price => treat total as gross; set total = qty*unit_price (net).
-  - If unit_price seems to be VAT amount (small) but raw_text contains another plausible unit price that makes math work, use it.
-- If raw_text contains BOTH net and gross totals (common pattern: \"... net vat gross\"), always output total = net (before VAT).
-- Infer missing:
-  - If qty and total exist: unit_price = total/qty (total must be net).
-  - If unit_price and total exist: quantity = total/unit_price (total must be net).
-- Normalize unit to lowercase if present (Kg -> kg).
-- Output numeric types, not strings.
-- Prefer to keep description without embedded barcode lines (remove pure numeric barcode lines).
-- Prefer to clean description by removing trailing unit markers like \"- KG\" and standalone \"KG\" lines (unit goes to the unit field).
-
+{DOCAI_LINE_ITEM_RULES}
 Helpful extracted info from raw_text:
 - raw_numbers_tail: {json.dumps(raw_numbers_tail, ensure_ascii=False)}
 
 Input JSON:
 {json.dumps(docai_item, ensure_ascii=False)}
 """
-
-    def clean_item_from_docai_line_item(self, docai_item: Dict[str, Any]) -> Optional[InvoiceItem]:
-        prompt = self.create_docai_line_item_clean_prompt(docai_item)
-        data = self._call_claude_json(prompt=prompt, max_tokens=1200)
-        if not isinstance(data, dict):
-            return None
-        if data.get("skip") is True:
-            return None
-        desc = (data.get("description") or "").strip()
-        if not desc:
-            return None
-        unit = data.get("unit")
-        if isinstance(unit, str):
-            unit = unit.strip() or None
-        return InvoiceItem(
-            item_number=None,
-            description=desc,
-            quantity=float(data["quantity"]) if data.get("quantity") is not None else None,
-            unit_price=float(data["unit_price"]) if data.get("unit_price") is not None else None,
-            total=float(data["total"]) if data.get("total") is not None else None,
-            unit=unit,
-            llm_confidence=float(data["llm_confidence"]) if data.get("llm_confidence") is not None else None,
+        return self._with_output_spec(
+            prompt,
+            "Return ONLY a valid JSON object with one of these shapes:",
+            "Rules:\n",
+            cleaned_item_output_spec(),
         )
 
-    def clean_items_from_docai_summary(self, invoice_summary: Dict[str, Any]) -> List[InvoiceItem]:
+    def create_docai_line_items_batch_clean_prompt(self, batch: List[Tuple[str, Dict[str, Any]]]) -> str:
         """
-        Convert DocAI invoice summary into cleaned InvoiceItem list using Claude (text-only).
+        Clean several DocAI line_items in one request.
+        Each item carries a stable id so results can be mapped back per DB row.
         """
-        prompt = self.create_docai_clean_prompt(invoice_summary)
-        data = self._call_claude_json(prompt=prompt, max_tokens=4096)
-        raw_items = (data or {}).get("items") or []
+        payload = [
+            {"id": item_id, "raw_numbers_tail": self._raw_numbers_tail(item), "item": item}
+            for item_id, item in batch
+        ]
 
-        cleaned: List[InvoiceItem] = []
-        for it in raw_items:
-            desc = (it.get("description") or "").strip()
-            if not desc:
-                continue
-            cleaned.append(
-                InvoiceItem(
-                    item_number=None,
-                    description=desc,
+        prompt = f"""You are an expert invoice line-item cleaner.
+
+Input is a JSON array of line items extracted by Google Document AI INVOICE_PROCESSOR.
+Each element has:
+- id (stable identifier, copy it back unchanged)
+- raw_numbers_tail (numeric tokens from raw_text)
+- item: raw_text, description/unit/quantity/unit_price/total (may be wrong), *_raw and *_confidence fields
+
+Clean EACH item independently. Return ONLY a valid JSON object with this structure:
+{{
+  "results": [
+    {{
+      "id": "same id as input",
+      "description": "string (cleaned)",
+      "unit": "string or null",
+      "quantity": number or null,
+      "unit_price": number or null,
+      "total": number or null,  // NET total (before VAT)
+      "llm_confidence": number  // 0..10
+    }},
+    {{ "id": "same id as input", "skip": true }}
+  ]
+}}
+
+Return exactly one result per input id, in the same order.
+
+Rules (apply per item):
+{DOCAI_LINE_ITEM_RULES}
+Input JSON:
+{json.dumps(payload, ensure_ascii=False)}
+"""
+        return self._with_output_spec(
+            prompt,
+            "Clean EACH item independently.",
+            "Return exactly one result per input id",
+            cleaned_items_batch_output_spec(),
+        )
+
+    def create_reconcile_prompt(self, rows: List[Tuple[str, Dict[str, Any]]]) -> str:
+        """
+        Adjudicate rows where the Claude vision reading and the DocAI reading disagree
+        (hybrid mode). Each row carries either or both readings plus a stable id.
+        """
+        return self._with_output_spec(
+            f"""You are an expert invoice line-item reviewer.
+
+The same invoice was read twice: by a vision model looking at the page image ("vision")
+and by Google Document AI OCR ("docai": raw_text is the OCR text of the row, the other
+fields are DocAI's guesses and may be wrong). The two readings of each row below disagree,
+or only one reader found the row.
+
+Resolve EACH row independently. Return ONLY a valid JSON object with this structure:
+{{
+  "results": [
+    {{
+      "id": "same id as input",
+      "description": "string (cleaned)",
+      "unit": "string or null",
+      "quantity": number or null,
+      "unit_price": number or null,
+      "total": number or null,  // NET total (before VAT)
+      "llm_confidence": number  // 0..10
+    }},
+    {{ "id": "same id as input", "skip": true }}
+  ]
+}}
+
+Return exactly one result per input id, in the same order.
+
+Rules (apply per row):
+- Prefer the reading whose numbers satisfy quantity × unit_price = total (net), using raw_text to confirm them.
+- If only docai found the row and it is not a real product line (headers, totals, VAT, barcodes), skip it.
+{DOCAI_LINE_ITEM_RULES}
+Input JSON:
+{json.dumps([{"id": row_id, **row} for row_id, row in rows], ensure_ascii=False)}
+""",
+            "Resolve EACH row independently.",
+            "Return exactly one result per input id",
+            cleaned_items_batch_output_spec(),
+        )
+
+    def create_row_repair_prompt(self, rows: List[Tuple[str, Dict[str, Any]]]) -> str:
+        """
+        Re-read line items that failed quantity × unit_price = total from cropped,
+        higher-resolution images of just those rows (row repair pass).
+        """
+        return self._with_output_spec(
+            f"""You are an expert invoice line-item reader.
+
+The line items below were extracted from an invoice, but their numbers do not satisfy
+quantity × unit_price = total. Each row id is followed by a high-resolution crop of that
+row, preceded by a crop of the table header when it was found. "current" is the earlier
+reading; "pdf_text" (when present) is the PDF's own text for the row.
+
+Re-read EACH row independently. Return ONLY a valid JSON object with this structure:
+{{
+  "results": [
+    {{
+      "id": "same id as input",
+      "description": "string (exact text from the crop)",
+      "unit": "string or null",
+      "quantity": number or null,
+      "unit_price": number or null,
+      "total": number or null,  // NET total (before VAT)
+      "llm_confidence": number  // 0..10
+    }},
+    {{ "id": "same id as input", "skip": true }}
+  ]
+}}
+
+Return exactly one result per input id, in the same order.
+
+Rules (apply per row):
+- Read the numbers from the crop; use the header crop to tell the quantity, unit price and total columns apart.
+- Check that quantity × unit_price = total; if the printed total includes VAT, return the net total.
+- Skip a row only if the crop does not show a product line at all.
+- Lower llm_confidence when the crop is unreadable or the numbers still do not add up.
+
+Input JSON:
+{json.dumps([{"id": row_id, **row} for row_id, row in rows], ensure_ascii=False)}
+""",
+            "Re-read EACH row independently.",
+            "Return exactly one result per input id",
+            cleaned_items_batch_output_spec(),
+        )
+
+    @staticmethod
+    def _item_from_clean_result(data: Dict[str, Any]) -> Optional[InvoiceItem]:
+        """Build an InvoiceItem from one cleaned-item JSON object (None = skip)."""
+        if data.get("skip") is True:
+            return None
+        desc = (data.get("description") or "").strip()
+        if not desc:
+            return None
+        unit = data.get("unit")
+        if isinstance(unit, str):
+            unit = unit.strip() or None
+        return InvoiceItem(
+            item_number=None,
+            description=desc,
+            quantity=float(data["quantity"]) if data.get("quantity") is not None else None,
+            unit_price=float(data["unit_price"]) if data.get("unit_price") is not None else None,
+            total=float(data["total"]) if data.get("total") is not None else None,
+            unit=unit,
+            llm_confidence=float(data["llm_confidence"]) if data.get("llm_confidence") is not None else None,
+        )
+
+    async def aclean_item_from_docai_line_item(self, docai_item: Dict[str, Any]) -> Optional[InvoiceItem]:
+        prompt = self.create_docai_line_item_clean_prompt(docai_item)
+        data = await self._acall_claude_json(
+            prompt=prompt,
+            max_tokens=1200,
+            tool=self._tool_for(cleaned_item_tool),
+            expand=expand_cleaned_item,
+        )
+        if not isinstance(data, dict):
+            return None
+        return self._item_from_clean_result(data)
+
+    def clean_item_from_docai_line_item(self, docai_item: Dict[str, Any]) -> Optional[InvoiceItem]:
+        return self._run_sync(self.aclean_item_from_docai_line_item(docai_item))
+
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        # JSON-heavy text averages roughly 3 characters per token.
+        return len(text) // 3 + 1
+
+    def _split_docai_batches(
+        self, indexed_items: List[Tuple[int, Dict[str, Any]]], max_input_tokens: int, max_items: int
+    ) -> List[List[Tuple[str, Dict[str, Any]]]]:
+        """Greedily pack (id, item) pairs into batches under the token and item budgets."""
+        batches: List[List[Tuple[str, Dict[str, Any]]]] = []
+        current: List[Tuple[str, Dict[str, Any]]] = []
+        current_tokens = 0
+        for idx, item in indexed_items:
+            item_tokens = self._estimate_tokens(json.dumps(item, ensure_ascii=False))
+            if current and (current_tokens + item_tokens > max_input_tokens or len(current) >= max_items):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append((f"r{idx}", item))
+            current_tokens += item_tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    async def _aclean_docai_batch(
+        self, batch: List[Tuple[str, Dict[str, Any]]]
+    ) -> Dict[str, Optional[InvoiceItem]]:
+        """
+        Clean one batch; returns {id: item-or-None} for ids whose result parsed.
+        Ids missing from the returned mapping need a per-item fallback.
+        """
+        prompt = self.create_docai_line_items_batch_clean_prompt(batch)
+        max_tokens = min(8192, 256 + settings.docai_clean_output_tokens_per_item * len(batch))
+        try:
+            data = await self._acall_claude_json(
+                prompt=prompt,
+                max_tokens=max_tokens,
+                tool=self._tool_for(cleaned_items_batch_tool),
+                expand=expand_cleaned_items_batch,
+            )
+        except ValueError:
+            # Whole batch response was not valid JSON -> every item falls back.
+            # API errors propagate so callers keep their all-or-nothing semantics.
+            return {}
+
+        raw_results = data.get("results") if isinstance(data, dict) else data
+        if not isinstance(raw_results, list):
+            return {}
+
+        known_ids = {item_id for item_id, _ in batch}
+        parsed: Dict[str, Optional[InvoiceItem]] = {}
+        for res in raw_results:
+            if not isinstance(res, dict):
+                continue
+            item_id = str(res.get("id") or "")
+            if item_id not in known_ids or item_id in parsed:
+                continue
+            try:
+                parsed[item_id] = self._item_from_clean_result(res)
+            except (TypeError, ValueError):
+                # Unparseable numbers/confidence -> leave for per-item fallback
+                continue
+        return parsed
+
+    async def aclean_items_from_docai_line_items(
+        self,
+        docai_items: List[Dict[str, Any]],
+        max_input_tokens: Optional[int] = None,
+        max_items: Optional[int] = None,
+    ) -> List[Optional[InvoiceItem]]:
+        """
+        Batched version of `clean_item_from_docai_line_item`.
+
+        Rows the local rule-based pre-cleaner resolves with high confidence never reach
+        Claude (such items are tagged with `__llm__ = "local-rules"`). The rest are packed
+        into as few Claude calls as the token budget allows (batches run concurrently)
+        and mapped back by stable id. Only items whose batch result is missing or failed
+        to parse are retried with a per-item call.
+
+        Returns:
+            List aligned with `docai_items`: cleaned InvoiceItem, or None for skipped items
+        """
+        if not docai_items:
+            return []
+
+        ids = [f"r{idx}" for idx in range(len(docai_items))]
+        merged: Dict[str, Optional[InvoiceItem]] = {}
+
+        pending: List[Tuple[int, Dict[str, Any]]] = []
+        for idx, item in enumerate(docai_items):
+            if self.precleaner is not None:
+                pre = self.precleaner.clean(item)
+                if pre.status != "unresolved":
+                    if pre.item is not None:
+                        setattr(pre.item, "__llm__", "local-rules")
+                    merged[ids[idx]] = pre.item
+                    continue
+            pending.append((idx, item))
+
+        if pending:
+            batches = self._split_docai_batches(
+                pending,
+                max_input_tokens=max_input_tokens or settings.docai_clean_batch_max_input_tokens,
+                max_items=max_items or settings.docai_clean_batch_max_items,
+            )
+            batch_results = await asyncio.gather(*(self._aclean_docai_batch(b) for b in batches))
+            for res in batch_results:
+                merged.update(res)
+
+        missing = [idx for idx, item_id in enumerate(ids) if item_id not in merged]
+        if missing:
+            fallbacks = await asyncio.gather(
+                *(self.aclean_item_from_docai_line_item(docai_items[idx]) for idx in missing)
+            )
+            for idx, res in zip(missing, fallbacks):
+                merged[ids[idx]] = res
+
+        return [merged[item_id] for item_id in ids]
+
+    def clean_items_from_docai_line_items(
+        self,
+        docai_items: List[Dict[str, Any]],
+        max_input_tokens: Optional[int] = None,
+        max_items: Optional[int] = None,
+    ) -> List[Optional[InvoiceItem]]:
+        """Sync wrapper around `aclean_items_from_docai_line_items`."""
+        return self._run_sync(
+            self.aclean_items_from_docai_line_items(
+                docai_items, max_input_tokens=max_input_tokens, max_items=max_items
+            )
+        )
+
+    def clean_items_from_docai_summary(self, invoice_summary: Dict[str, Any]) -> List[InvoiceItem]:
+        """
+        Convert DocAI invoice summary into cleaned InvoiceItem list using Claude (text-only).
+        """
+        prompt = self.create_docai_clean_prompt(invoice_summary)
+        data = self._call_claude_json(
+            prompt=prompt,
+            max_tokens=4096,
+            tool=self._tool_for(cleaned_items_tool),
+            expand=expand_cleaned_items,
+        )
+        raw_items = (data or {}).get("items") or []
+
+        cleaned: List[InvoiceItem] = []
+        for it in raw_items:
+            desc = (it.get("description") or "").strip()
+            if not desc:
+                continue
+            cleaned.append(
+                InvoiceItem(
+                    item_number=None,
+                    description=desc,
                     quantity=float(it["quantity"]) if it.get("quantity") is not None else None,
                     unit_price=float(it["unit_price"]) if it.get("unit_price") is not None else None,
                     total=float(it["total"]) if it.get("total") is not None else None,
@@ -445,16 +1316,7 @@ Input JSON:
                 # 1) Decimal scale fix: try scaling qty or price by 10/100 ONLY when math doesn't match.
                 if abs((q * p) - t) > 0.01:
                     # 2) Decimal scale fix: try scaling qty or price by 10/100
-                    candidates: List[Tuple[float, float]] = []
-                    scales = [0.1, 0.01, 10.0, 100.0]
-                    for s in scales:
-                        candidates.append((float(q) * s, float(p)))  # scale qty
-                        candidates.append((float(q), float(p) * s))  # scale price
-                    best = None
-                    for q2, p2 in candidates:
-                        if abs((q2 * p2) - float(t)) <= 0.01:
-                            best = (q2, p2)
-                            break
+                    best = scale_fix(float(q), float(p), float(t))
                     if best is not None:
                         q2, p2 = best
                         it.quantity = float(q2)
@@ -518,42 +1380,923 @@ Input JSON:
         except Exception:
             return fallback
     
-    def process_invoice(self, file_path: Path) -> ProcessingResult:
-        """Process a single invoice file (PDF or image).
+    def _page_count(self, file_path: InvoiceSource) -> int:
+        """Number of pages to extract: PDF pages capped by settings.pdf_max_pages, else 1."""
+        if file_path.suffix.lower() != '.pdf':
+            return 1
+        doc = open_pdf(file_path)
+        try:
+            return min(len(doc), max(1, settings.pdf_max_pages))
+        finally:
+            doc.close()
+
+    def _load_images(self, file_path: InvoiceSource, page_index: int = 0) -> Tuple[List[Tuple[bytes, str]], Dict[str, Any]]:
+        """Read/render one page of the invoice file into (image_bytes, mime_type) pairs.
+
+        CPU/disk bound (PDF render, resize, re-encode, PIL mime sniffing); async callers
+        run it in a thread. Each call opens its own PyMuPDF document, so pages can be
+        rendered concurrently. Raises ValueError for unsupported file types.
+
+        Returns:
+            (images, image_stats) where image_stats holds bytes before/after and
+            render/encode timings when preprocessing is enabled
+        """
+        file_ext = file_path.suffix.lower()
+
+        if file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
+            # Read image file directly
+            image_bytes = file_path.read_bytes()
+            if self.image_config is not None:
+                try:
+                    out, mime_type, stats = preprocess_image_bytes(image_bytes, self.image_config)
+                    self._add_image_stage_times(stats)
+                    return [(out, mime_type)], stats
+                except Exception:
+                    # Unreadable by PIL: send the original bytes as before
+                    pass
+            fallback_mime = self._mime_for_suffix(file_ext)
+            start = time.perf_counter()
+            mime_type = self._detect_mime_from_bytes(image_bytes, fallback_mime)
+            _add_stage_time("mime_detect", time.perf_counter() - start)
+            return [(image_bytes, mime_type)], {"bytes_before": len(image_bytes), "bytes_after": len(image_bytes)}
+        if file_ext == '.pdf':
+            doc = open_pdf(file_path)
+            try:
+                if page_index >= len(doc):
+                    return [], {}
+                page = doc[page_index]
+                if self.image_config is None:
+                    # Render page to image at 300 DPI (legacy behaviour)
+                    start = time.perf_counter()
+                    pix = page.get_pixmap(matrix=fitz.Matrix(300/72, 300/72))
+                    png = pix.tobytes("png")
+                    _add_stage_time("render", time.perf_counter() - start)
+                    return [(png, "image/png")], {}
+                out, mime_type, stats = render_pdf_page(page, self.image_config)
+                self._add_image_stage_times(stats)
+            finally:
+                doc.close()
+            stats["page"] = page_index + 1
+            stats["bytes_before"] = file_path.stat().st_size
+            return [(out, mime_type)], stats
+        raise ValueError(f"Unsupported file type: {file_ext}")
+
+    @staticmethod
+    def _add_image_stage_times(stats: Dict[str, Any]) -> None:
+        """PyMuPDF render / PIL decode+resize ("render") and image re-encode ("image_encode")."""
+        _add_stage_time("render", stats.get("render_time", 0.0))
+        _add_stage_time("image_encode", stats.get("encode_time", 0.0))
+
+    def _pdf_text_layer(self, file_path: InvoiceSource, page_index: int) -> Optional[str]:
+        """
+        Compact row/column text for a born-digital PDF page, or None if the page has
+        no usable text layer (scans, image-only PDFs).
+
+        Words are grouped into visual rows by vertical position; wide horizontal gaps
+        become " | " column separators so the line-items table keeps its shape.
+        """
+        doc = open_pdf(file_path)
+        try:
+            if page_index >= len(doc):
+                return None
+            words = doc[page_index].get_text("words")
+        finally:
+            doc.close()
+
+        if len(words) < settings.text_layer_min_words:
+            return None
+        text = "".join(w[4] for w in words)
+        if not text or sum(ch.isalnum() for ch in text) / len(text) < 0.5:
+            return None
+
+        heights = sorted(w[3] - w[1] for w in words)
+        line_height = heights[len(heights) // 2] or 1.0
+
+        rows: List[List[Tuple[float, float, float, str]]] = []
+        row_mids: List[float] = []
+        for x0, y0, x1, y1, word, *_ in sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+            mid = (y0 + y1) / 2
+            if row_mids and abs(mid - row_mids[-1]) <= line_height * 0.5:
+                rows[-1].append((x0, x1, mid, word))
+            else:
+                rows.append([(x0, x1, mid, word)])
+                row_mids.append(mid)
+
+        lines: List[str] = []
+        for row in rows:
+            row.sort(key=lambda w: w[0])
+            parts = [row[0][3]]
+            for prev, cur in zip(row, row[1:]):
+                gap = cur[0] - prev[1]
+                parts.append(" | " if gap > line_height * 1.5 else " ")
+                parts.append(cur[3])
+            lines.append("".join(parts))
+        return "\n".join(lines)
+
+    @staticmethod
+    def _item_key(item: InvoiceItem) -> Tuple[Any, ...]:
+        return (
+            " ".join((item.description or "").lower().split()),
+            item.quantity,
+            item.unit_price,
+            item.total,
+        )
+
+    def _merge_page_results(self, pages: List[InvoiceData]) -> InvoiceData:
+        """
+        Merge per-page extractions into one invoice.
+        - header fields: first page that has them
+        - totals: last page that has them (totals are printed at the end)
+        - items: page order; rows repeated across a page break (carried-over rows)
+          are dropped when they match one of the previous page's trailing rows
+        """
+        if len(pages) == 1:
+            return pages[0]
+
+        merged = InvoiceData()
+        for field in ("invoice_number", "invoice_date", "vendor_name", "customer_name", "currency"):
+            setattr(merged, field, next((getattr(p, field) for p in pages if getattr(p, field)), None))
+        for field in ("subtotal", "tax", "total_amount"):
+            setattr(
+                merged,
+                field,
+                next((getattr(p, field) for p in reversed(pages) if getattr(p, field) is not None), None),
+            )
+
+        items: List[InvoiceItem] = []
+        prev_tail: List[Tuple[Any, ...]] = []
+        for page in pages:
+            page_items = list(page.items or [])
+            start = 0
+            while start < len(page_items) and self._item_key(page_items[start]) in prev_tail:
+                start += 1
+            items.extend(page_items[start:])
+            if page_items:
+                prev_tail = [self._item_key(it) for it in page_items[-3:]]
+        merged.items = items
+        return merged
+
+    @staticmethod
+    def _merge_image_stats(page_stats: List[Dict[str, Any]]) -> Dict[str, Any]:
+        if not page_stats:
+            return {}
+        if len(page_stats) == 1:
+            return page_stats[0]
+        merged: Dict[str, Any] = {"pages": len(page_stats)}
+        for key in ("bytes_after", "render_time", "encode_time"):
+            values = [s[key] for s in page_stats if key in s]
+            if values:
+                merged[key] = sum(values)
+        if page_stats and "bytes_before" in page_stats[0]:
+            merged["bytes_before"] = page_stats[0]["bytes_before"]
+        merged["page_stats"] = page_stats
+        return merged
+
+    async def _aprepare_page(
+        self, file_path: InvoiceSource, page_index: int, vendor_hint: Optional[str] = None
+    ) -> Tuple[Optional[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Load the model input for one page: the text layer for born-digital PDF pages,
+        otherwise a rendered (preprocessed) image. A matching vendor profile (by caller
+        hint, layout fingerprint or vendor name in the text) is attached as "vendor".
+
+        Returns:
+            (page input or None, page stats incl. "route")
+        """
+        page_input: Optional[Dict[str, Any]] = None
+        if settings.text_layer_enabled and file_path.suffix.lower() == '.pdf':
+            start = time.perf_counter()
+            page_text = await asyncio.to_thread(self._pdf_text_layer, file_path, page_index)
+            _add_stage_time("text_layer", time.perf_counter() - start)
+            if page_text:
+                page_input, stats = {"text": page_text}, {"route": "text", "text_chars": len(page_text)}
+
+        if page_input is None:
+            images, image_stats = await asyncio.to_thread(self._load_images, file_path, page_index)
+            if not images:
+                return None, image_stats
+            image_bytes, mime_type = images[0]
+            page_input, stats = {"image": image_bytes, "mime_type": mime_type}, {**image_stats, "route": "vision"}
+
+        if self.vendor_profiles is not None:
+            profile, match = self.vendor_profiles.lookup(page_input.get("text"), vendor_hint)
+            if profile is not None:
+                page_input["vendor"] = profile
+                stats["vendor"] = profile.vendor_key
+                stats["vendor_match"] = match
+        return page_input, stats
+
+    async def _aextract_prepared(
+        self,
+        page_input: Dict[str, Any],
+        model: Optional[str] = None,
+        expected_items: Optional[int] = None,
+        on_delta: Optional[Callable[[str], None]] = None,
+    ) -> InvoiceData:
+        """
+        Run one prepared page (see `_aprepare_page`) through Claude.
+
+        Pages of a known vendor layout use the short vendor prompt; digital PDF pages are
+        parsed locally instead (no Claude call) once the vendor's local parser is trusted.
+        """
+        prompt: Optional[str] = None
+        profile: Optional[VendorProfile] = page_input.get("vendor")
+        if profile is not None and self.vendor_profiles is not None:
+            if "text" in page_input and self.vendor_profiles.local_trusted(profile):
+                local = await asyncio.to_thread(parse_text_layer, profile, page_input["text"])
+                if local is not None:
+                    page_input["parsed_locally"] = True  # the cascade leaves this page alone
+                    generic = self.create_text_extraction_prompt(page_input["text"])
+                    self._add_vendor_metrics(local_pages=1, tokens_saved=self._estimate_tokens(generic))
+                    return local
+            if profile.has_layout:
+                prompt = self.create_vendor_extraction_prompt(profile)
+                saved = self._estimate_tokens(self.create_extraction_prompt()) - self._estimate_tokens(prompt)
+                self._add_vendor_metrics(local_pages=0, tokens_saved=max(0, saved))
+
+        if "text" in page_input:
+            return await self.aprocess_text_with_claude(
+                page_input["text"], model=model, expected_items=expected_items, on_delta=on_delta, prompt=prompt
+            )
+        return await self.aprocess_with_claude(
+            page_input["image"],
+            page_input["mime_type"],
+            model=model,
+            expected_items=expected_items,
+            on_delta=on_delta,
+            prompt=prompt,
+        )
+
+    @staticmethod
+    def _add_vendor_metrics(local_pages: int, tokens_saved: int) -> None:
+        metrics = _call_metrics.get()
+        if metrics is not None:
+            metrics["vendor_local_pages"] = metrics.get("vendor_local_pages", 0) + local_pages
+            metrics["prompt_tokens_saved"] = metrics.get("prompt_tokens_saved", 0) + tokens_saved
+
+    async def _aextract_page(
+        self,
+        file_path: InvoiceSource,
+        page_index: int,
+        model: Optional[str] = None,
+        tolerate_parse_errors: bool = False,
+        vendor_hint: Optional[str] = None,
+    ) -> Tuple[Optional[InvoiceData], Dict[str, Any], Optional[Dict[str, Any]]]:
+        """
+        Extract one page. Born-digital PDF pages go through the text layer; everything
+        else is rendered and sent to vision. Page renders overlap other pages' extraction.
+
+        Args:
+            tolerate_parse_errors: Return no data (and "parse_error" in the stats) instead of
+                raising when the reply is not valid invoice JSON; the cascade escalates those.
+            vendor_hint: Supplier name known to the caller (selects a vendor profile for scans)
+
+        Returns:
+            (invoice data or None, page stats incl. "route" and "latency", page input for re-use)
+        """
+        start = time.perf_counter()
+        page_input, stats = await self._aprepare_page(file_path, page_index, vendor_hint)
+        if page_input is None:
+            return None, stats, None
+        try:
+            data: Optional[InvoiceData] = await self._aextract_prepared(page_input, model=model)
+        except ValueError as e:  # json.JSONDecodeError / pydantic ValidationError
+            if not tolerate_parse_errors:
+                raise
+            data = None
+            stats["parse_error"] = str(e)[:200]
+        latency = time.perf_counter() - start
+        self._record_route_latency(stats["route"], latency)
+        stats["latency"] = latency
+        return data, stats, page_input
+
+    def _record_route_latency(self, route: str, latency: float) -> None:
+        with self._stats_lock:
+            count, total = self._route_latency.get(route, (0, 0.0))
+            self._route_latency[route] = (count + 1, total + latency)
+
+    def _route_summary(self, page_stats: List[Dict[str, Any]]) -> Tuple[str, Dict[str, Any]]:
+        """
+        Overall route for an invoice and text-layer savings.
+        Time saved is estimated against the running average vision latency per page.
+        """
+        routes = [s.get("route") for s in page_stats if s.get("route")]
+        text_pages = [s for s in page_stats if s.get("route") == "text"]
+        if routes and all(r == "text" for r in routes):
+            route = "text"
+        elif text_pages:
+            route = "mixed"
+        else:
+            route = "vision"
+
+        stats: Dict[str, Any] = {
+            "pages_text": len(text_pages),
+            "pages_vision": sum(1 for r in routes if r == "vision"),
+        }
+        if text_pages:
+            stats["text_chars"] = sum(s.get("text_chars", 0) for s in text_pages)
+            with self._stats_lock:
+                vision_count, vision_total = self._route_latency.get("vision", (0, 0.0))
+            if vision_count:
+                avg_vision = vision_total / vision_count
+                stats["estimated_time_saved"] = sum(
+                    max(0.0, avg_vision - s["latency"]) for s in text_pages
+                )
+        return route, stats
+
+    def _cascade_scores(self, invoice_data: InvoiceData) -> Dict[str, float]:
+        """Quality signals of a fast-stage result (before normalization drops weak items)."""
+        items = invoice_data.items or []
+        low = sum(
+            1 for it in items
+            if it.llm_confidence is None or it.llm_confidence < settings.cascade_low_confidence
+        )
+        return {
+            "invalid_ratio": self._invalid_ratio(invoice_data),
+            "low_confidence_share": low / len(items) if items else 1.0,
+        }
+
+    def _should_escalate(self, scores: Dict[str, float]) -> bool:
+        return (
+            scores["invalid_ratio"] > settings.cascade_max_invalid_ratio
+            or scores["low_confidence_share"] > settings.cascade_max_low_confidence_share
+        )
+
+    def _record_cascade(self, escalated: bool) -> None:
+        with self._stats_lock:
+            self._cascade_counts["invoices"] += 1
+            self._cascade_counts["escalated"] += 1 if escalated else 0
+
+    def cascade_stats(self) -> Dict[str, Any]:
+        """Escalation counters for this process (diagnostics / benchmark summaries)."""
+        with self._stats_lock:
+            counts = dict(self._cascade_counts)
+        return {
+            **counts,
+            "escalation_rate": counts["escalated"] / counts["invoices"] if counts["invoices"] else 0.0,
+            "fast_model": settings.cascade_fast_model,
+            "main_model": self.model,
+        }
+
+    async def _acascade(
+        self,
+        fast_pages: List[Optional[InvoiceData]],
+        page_inputs: List[Dict[str, Any]],
+        fast_latency: float,
+        parse_errors: int,
+    ) -> Tuple[InvoiceData, str, List[Dict[str, Any]]]:
+        """
+        Judge the fast-model extraction and re-run every page with the main model when
+        the invalid ratio / low-confidence share crosses the configured thresholds
+        (or a page did not parse). Page inputs are re-used, so nothing is rendered twice,
+        and the fast stage's item counts size the main model's max_tokens.
+
+        Returns:
+            (merged invoice data, model that produced it, per-stage stats)
+        """
+        fast_model = settings.cascade_fast_model
+        parsed_pages = [page for page in fast_pages if page is not None]
+        fast_data = self._merge_page_results(parsed_pages) if parsed_pages else InvoiceData()
+        # Pages from the local vendor parser have no model confidence to judge and would
+        # parse the same way again; only the pages Claude read are scored and re-run
+        claude_pages = [
+            page for page, page_input in zip(fast_pages, page_inputs)
+            if page is not None and not page_input.get("parsed_locally")
+        ]
+        scores = self._cascade_scores(self._merge_page_results(claude_pages) if claude_pages else fast_data)
+        local_only = bool(parsed_pages) and not claude_pages
+        escalate = parse_errors > 0 or (not local_only and self._should_escalate(scores))
+        self._record_cascade(escalate)
+        stages: List[Dict[str, Any]] = [{
+            "model": fast_model,
+            "latency": fast_latency,
+            **scores,
+            "parse_errors": parse_errors,
+            "accepted": not escalate,
+        }]
+        if not escalate:
+            return fast_data, fast_model, stages
+
+        start = time.perf_counter()
+
+        async def rerun(page_input: Dict[str, Any], fast_page: Optional[InvoiceData]) -> InvoiceData:
+            if page_input.get("parsed_locally") and fast_page is not None:
+                return fast_page
+            return await self._aextract_prepared(
+                page_input,
+                model=self.model,
+                expected_items=len(fast_page.items) if fast_page is not None else None,
+            )
+
+        pages = await asyncio.gather(
+            *(rerun(page_input, fast_page) for page_input, fast_page in zip(page_inputs, fast_pages))
+        )
+        data = self._merge_page_results(list(pages))
+        stages.append({
+            "model": self.model,
+            "latency": time.perf_counter() - start,
+            **self._cascade_scores(data),
+            "accepted": True,
+        })
+        return data, self.model, stages
+
+    def _docai_summary(self, file_path: InvoiceSource) -> Dict[str, Any]:
+        """Run Google DocAI on the file (blocking; call via asyncio.to_thread)."""
+        if not settings.google_cloud_project or not settings.docai_processor_id:
+            raise ValueError("DocAI is not configured (GOOGLE_CLOUD_PROJECT / DOCAI_PROCESSOR_ID)")
+        from helper.docai_client import guess_mime_from_name, line_item_boxes, process_document_bytes
+
+        document, summary = process_document_bytes(
+            project_id=settings.google_cloud_project,
+            location=settings.docai_location,
+            processor_id=settings.docai_processor_id,
+            processor_version_id=settings.docai_processor_version_id,
+            content=file_path.read_bytes(),
+            mime_type=guess_mime_from_name(file_path.name),
+        )
+        # Kept beside line_items (not inside them) so cleaning prompts stay unchanged
+        summary["line_item_boxes"] = line_item_boxes(document)
+        return summary
+
+    async def _areconcile_with_docai(
+        self, invoice_data: InvoiceData, docai_summary: Dict[str, Any]
+    ) -> Tuple[InvoiceData, Dict[str, Any]]:
+        """
+        Reconcile Claude's items with DocAI's line items locally (see hybrid_reconciler);
+        only disputed rows go to Claude, in one batched text-only call.
+
+        Returns:
+            (reconciled invoice data, hybrid stats)
+        """
+        precleaner = self.precleaner or DocAIPreCleaner(settings.docai_precleaner_min_confidence)
+        outcome = reconcile(list(invoice_data.items or []), docai_summary.get("line_items") or [], precleaner)
+        stats: Dict[str, Any] = {**outcome.stats(), "docai_rows": len(docai_summary.get("line_items") or [])}
+
+        disputed = outcome.disputed
+        adjudicated: Dict[str, Optional[InvoiceItem]] = {}
+        if disputed:
+            rows = []
+            for i, row in enumerate(disputed):
+                docai = None
+                if row.docai_row is not None:
+                    docai = {
+                        k: row.docai_row.get(k)
+                        for k in ("raw_text", "description", "unit", "quantity", "unit_price", "total")
+                    }
+                rows.append((f"d{i}", {
+                    "vision": row.claude_item.model_dump(exclude={"item_number"}) if row.claude_item else None,
+                    "docai": docai,
+                }))
+            start = time.perf_counter()
+            try:
+                data = await self._acall_claude_json(
+                    prompt=self.create_reconcile_prompt(rows),
+                    max_tokens=min(8192, 256 + settings.docai_clean_output_tokens_per_item * len(rows)),
+                    tool=self._tool_for(cleaned_items_batch_tool),
+                    expand=expand_cleaned_items_batch,
+                )
+                for res in (data.get("results") or []) if isinstance(data, dict) else []:
+                    if isinstance(res, dict) and str(res.get("id")) not in adjudicated:
+                        try:
+                            adjudicated[str(res.get("id"))] = self._item_from_clean_result(res)
+                        except (TypeError, ValueError):
+                            continue
+            except ValueError:
+                pass  # unparseable adjudication: fall back to Claude's own reading below
+            stats["adjudication_latency"] = time.perf_counter() - start
+            stats["adjudicated"] = len(adjudicated)
+
+        disputed_ids = {id(row): f"d{i}" for i, row in enumerate(disputed)}
+        items: List[InvoiceItem] = []
+        for row in outcome.rows:
+            if row.status != "disputed":
+                items.append(row.item)
+                continue
+            row_id = disputed_ids[id(row)]
+            if row_id in adjudicated:
+                if adjudicated[row_id] is not None:
+                    item = adjudicated[row_id]
+                    if row.claude_item is not None:
+                        item.item_number = row.claude_item.item_number
+                    items.append(item)
+            elif row.claude_item is not None:
+                items.append(row.claude_item)
+
+        reconciled = invoice_data.model_copy(update={"items": items})
+        for field in ("invoice_number", "invoice_date", "vendor_name", "customer_name", "currency"):
+            if not getattr(reconciled, field) and docai_summary.get(field):
+                setattr(reconciled, field, docai_summary[field])
+        return reconciled, stats
+
+    def _record_repair(self, stats: Dict[str, Any]) -> None:
+        with self._stats_lock:
+            self._repair_counts["invoices"] += 1
+            for key in ("failing", "located", "repaired"):
+                self._repair_counts[key] += stats.get(key, 0)
+
+    def repair_stats(self) -> Dict[str, Any]:
+        """Row repair counters for this process (diagnostics / benchmark summaries)."""
+        with self._stats_lock:
+            counts = dict(self._repair_counts)
+        return {
+            **counts,
+            "success_rate": counts["repaired"] / counts["located"] if counts["located"] else 0.0,
+        }
+
+    def _render_row_crops(self, file_path: InvoiceSource, regions: Dict[int, RowRegion]) -> Dict[int, List[Dict[str, Any]]]:
+        """
+        Image content blocks per located row: [header crop,] row crop. Blocking (render,
+        encode, base64); call via asyncio.to_thread.
+
+        PDF crops are rendered at row_repair_dpi; photos are cut from the original file
+        before any downscaling. Either way the crop is far sharper than the full-page image.
+        """
+        base = self.image_config or ImagePreprocessConfig(grayscale=False, format="png")
+        cfg = dataclasses.replace(base, max_tokens=0, pdf_max_dpi=settings.row_repair_dpi)
+
+        def block(image_bytes: bytes, mime_type: str) -> Dict[str, Any]:
+            return {
+                "type": "image",
+                "source": {"type": "base64", "media_type": mime_type, "data": self.encode_image_base64(image_bytes)},
+            }
+
+        crops: Dict[int, List[Dict[str, Any]]] = {}
+        if file_path.suffix.lower() == ".pdf":
+            doc = open_pdf(file_path)
+            try:
+                for idx, region in regions.items():
+                    if region.page_index >= len(doc):
+                        continue
+                    page = doc[region.page_index]
+                    blocks = []
+                    for box in (region.header_box, region.box):
+                        if box is None:
+                            continue
+                        r = page.rect
+                        clip = fitz.Rect(
+                            r.x0 + box[0] * r.width, r.y0 + box[1] * r.height,
+                            r.x0 + box[2] * r.width, r.y0 + box[3] * r.height,
+                        )
+                        out, mime_type, _ = render_pdf_page(page, cfg, clip=clip)
+                        blocks.append(block(out, mime_type))
+                    crops[idx] = blocks
+            finally:
+                doc.close()
+        else:
+            image_bytes = file_path.read_bytes()
+            for idx, region in regions.items():
+                if region.page_index != 0:
+                    continue
+                out, mime_type, _ = preprocess_image_bytes(image_bytes, cfg, crop=region.box)
+                crops[idx] = [block(out, mime_type)]
+        return crops
+
+    async def _arepair_rows(
+        self,
+        file_path: InvoiceSource,
+        invoice_data: InvoiceData,
+        docai_summary: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[InvoiceData, Dict[str, Any]]:
+        """
+        Re-read only the items failing quantity × unit_price = total.
+
+        Rows are located via the PDF text layer or, failing that, DocAI bounding boxes
+        (hybrid mode); their crops go to Claude in one batched call. A re-read replaces
+        the item's numbers only when they now add up; otherwise the item is left for
+        the usual normalization.
+
+        Returns:
+            (invoice data, repair stats: failing / located / repaired / latency)
+        """
+        items = list(invoice_data.items or [])
+        failing = failing_rows(items)
+        stats: Dict[str, Any] = {"failing": len(failing)}
+        if not failing:
+            return invoice_data, stats
+        if len(failing) > settings.row_repair_max_rows:
+            # Too much of the page is wrong for a row-level fix
+            stats["skipped"] = "too_many_rows"
+            self._record_repair(stats)
+            return invoice_data, stats
+
+        start = time.perf_counter()
+        regions = await asyncio.to_thread(
+            locate_in_text_layer, file_path, items, failing, settings.pdf_max_pages
+        )
+        if docai_summary is not None:
+            remaining = [idx for idx in failing if idx not in regions]
+            regions.update(locate_in_docai(
+                docai_summary.get("line_items") or [],
+                docai_summary.get("line_item_boxes") or [],
+                items,
+                remaining,
+            ))
+        crops = await asyncio.to_thread(self._render_row_crops, file_path, regions) if regions else {}
+        stats["located"] = len(crops)
+        stats["sources"] = sorted({regions[idx].source for idx in crops})
+
+        repaired: Dict[int, InvoiceItem] = {}
+        if crops:
+            ids = {f"x{n}": idx for n, idx in enumerate(sorted(crops))}
+            rows, content = [], []
+            for row_id, idx in ids.items():
+                row = {"current": items[idx].model_dump(exclude={"item_number"})}
+                if regions[idx].text:
+                    row["pdf_text"] = regions[idx].text
+                rows.append((row_id, row))
+                content.append({"type": "text", "text": f"Row {row_id}:"})
+                content.extend(crops[idx])
+            try:
+                data = await self._acall_claude_json(
+                    prompt=self.create_row_repair_prompt(rows),
+                    max_tokens=256 + settings.docai_clean_output_tokens_per_item * len(rows),
+                    tool=self._tool_for(cleaned_items_batch_tool),
+                    expand=expand_cleaned_items_batch,
+                    content=content,
+                )
+                for res in (data.get("results") or []) if isinstance(data, dict) else []:
+                    idx = ids.get(str(res.get("id"))) if isinstance(res, dict) else None
+                    if idx is None or idx in repaired:
+                        continue
+                    try:
+                        item = self._item_from_clean_result(res)
+                    except (TypeError, ValueError):
+                        continue
+                    if item is not None and is_consistent(item):
+                        repaired[idx] = items[idx].model_copy(update={
+                            "quantity": item.quantity,
+                            "unit_price": item.unit_price,
+                            "total": item.total,
+                            "unit": item.unit or items[idx].unit,
+                            "llm_confidence": item.llm_confidence,
+                        })
+            except ValueError:
+                pass  # unparseable re-read: keep the original rows
+        stats["repaired"] = len(repaired)
+        stats["latency"] = time.perf_counter() - start
+        self._record_repair(stats)
+        if not repaired:
+            return invoice_data, stats
+        return invoice_data.model_copy(update={
+            "items": [repaired.get(i, it) for i, it in enumerate(items)]
+        }), stats
+
+    def _cache_key(self, content: bytes) -> str:
+        """Cache key for an input file; changes whenever the model or prompt changes."""
+        return make_cache_key(
+            content,
+            "invoice",
+            self.model,
+            text_fingerprint(self.create_extraction_prompt()),
+            self.image_config.fingerprint() if self.image_config is not None else "raw",
+            f"pages={settings.pdf_max_pages}",
+            f"text_layer={settings.text_layer_enabled}:{settings.text_layer_min_words}",
+            f"output={self.output_mode}",
+            f"hybrid={settings.hybrid_docai_enabled}",
+            f"vendor_profiles={settings.vendor_profiles_enabled}:{settings.vendor_local_parser_enabled}",
+            f"row_repair={settings.row_repair_enabled}:{settings.row_repair_max_rows}:{settings.row_repair_dpi}",
+            (
+                f"cascade={settings.cascade_fast_model}:{settings.cascade_max_invalid_ratio}:"
+                f"{settings.cascade_max_low_confidence_share}:{settings.cascade_low_confidence}"
+                if settings.cascade_enabled
+                else "cascade=off"
+            ),
+        )
+
+    def _cache_lookup(self, file_path: InvoiceSource) -> Tuple[str, Optional[InvoiceData]]:
+        """Hash the input file and return (cache_key, cached InvoiceData or None)."""
+        key = self._cache_key(file_path.read_bytes())
+        cached = self.cache.get(key)
+        if cached is None:
+            return key, None
+        return key, InvoiceData.model_validate_json(cached)
+
+    @staticmethod
+    def _metric_fields(metrics: Dict[str, float]) -> Dict[str, Any]:
+        """ProcessingResult fields from the per-invoice `_call_metrics` accumulator."""
+        return {
+            "queue_wait_time": metrics.get("queue_wait", 0.0),
+            "model_latency": metrics.get("model_latency", 0.0),
+            "api_retries": int(metrics.get("retries", 0)),
+            "input_tokens": int(metrics.get("input_tokens", 0)),
+            "output_tokens": int(metrics.get("output_tokens", 0)),
+            "continuations": int(metrics.get("continuations", 0)),
+            "continuation_latency": metrics.get("continuation_latency", 0.0),
+            "prompt_tokens_saved": int(metrics.get("prompt_tokens_saved", 0)),
+            "vendor_local_pages": int(metrics.get("vendor_local_pages", 0)),
+            "locally_parsed": metrics.get("vendor_local_pages", 0) > 0,
+            "estimated_cost_usd": (
+                metrics.get("input_tokens", 0) * settings.claude_input_usd_per_mtok
+                + metrics.get("output_tokens", 0) * settings.claude_output_usd_per_mtok
+            ) / 1_000_000,
+            "stage_timings": {
+                "queue_wait": metrics.get("queue_wait", 0.0),
+                "model": metrics.get("model_latency", 0.0),
+                **{key[len("stage_"):]: value for key, value in metrics.items() if key.startswith("stage_")},
+            },
+        }
+
+    def _cache_hit_result(
+        self, filename: str, cached: InvoiceData, start_time: float, route: str = "cache", **extra: Any
+    ) -> ProcessingResult:
+        return ProcessingResult(
+            filename=filename,
+            success=True,
+            invoice_data=cached,
+            processing_time=time.time() - start_time,
+            model_used=self.model,
+            cache_hit=True,
+            cache_stats=self.cache.stats() if self.cache is not None else {},
+            route=route,
+            **extra,
+        )
+
+    def _fingerprint(self, file_path: InvoiceSource) -> Optional[Fingerprint]:
+        """Perceptual fingerprint of an input file (memoized; blocking, run in a thread)."""
+        stat = file_path.stat()
+        key = (str(file_path), stat.st_size, stat.st_mtime_ns)
+        with self._stats_lock:
+            if key in self._fingerprints:
+                self._fingerprints.move_to_end(key)
+                return self._fingerprints[key]
+        fingerprint = fingerprint_bytes(
+            file_path.read_bytes(),
+            file_path.suffix,
+            max_pages=settings.pdf_max_pages,
+            text_min_words=settings.text_layer_min_words if settings.text_layer_enabled else None,
+        )
+        with self._stats_lock:
+            self._fingerprints[key] = fingerprint
+            while len(self._fingerprints) > 64:
+                self._fingerprints.popitem(last=False)
+        return fingerprint
+
+    def _duplicate_params(self) -> str:
+        """Everything but the input that shapes a result (a near-duplicate may only reuse
+        results produced under the same model, prompt and settings)."""
+        return self._cache_key(b"")
+
+    def docai_clean_params(self) -> str:
+        """Everything but the input that shapes DocAI line-item cleaning (model, prompts,
+        output mode, pre-cleaner rules, batching); reused cleaned items must match it."""
+        return make_cache_key(
+            b"",
+            "docai_clean",
+            self.model,
+            text_fingerprint(self.create_docai_line_items_batch_clean_prompt([])),
+            text_fingerprint(self.create_docai_line_item_clean_prompt({})),
+            f"output={self.output_mode}",
+            f"precleaner={self.precleaner.fingerprint() if self.precleaner is not None else 'off'}",
+            (
+                f"batch={settings.docai_clean_batch_max_input_tokens}:{settings.docai_clean_batch_max_items}:"
+                f"{settings.docai_clean_output_tokens_per_item}"
+            ),
+        )
+
+    def _duplicate_lookup(self, file_path: InvoiceSource) -> Optional[Tuple[InvoiceData, DuplicateMatch]]:
+        """Earlier extraction of a near-duplicate of this file (blocking; run in a thread)."""
+        fingerprint = self._fingerprint(file_path)
+        if fingerprint is None:
+            return None
+        match = self.duplicates.find(fingerprint, self._duplicate_params())
+        if match is None:
+            return None
+        return InvoiceData.model_validate_json(match.value), match
+
+    def _duplicate_result(
+        self, filename: str, data: InvoiceData, match: DuplicateMatch, start_time: float, **extra: Any
+    ) -> ProcessingResult:
+        return self._cache_hit_result(
+            filename,
+            data,
+            start_time,
+            route="duplicate",
+            duplicate_of=match.filename,
+            duplicate_distance=match.distance,
+            **extra,
+        )
+
+    def _remember_fingerprint(self, file_path: InvoiceSource, invoice_data: InvoiceData) -> None:
+        fingerprint = self._fingerprint(file_path)
+        if fingerprint is not None:
+            self.duplicates.add(
+                fingerprint, self._duplicate_params(), file_path.name, invoice_data.model_dump_json()
+            )
+
+    async def _afinalize(
+        self,
+        file_path: InvoiceSource,
+        invoice_data: InvoiceData,
+        page_stats: List[Dict[str, Any]],
+        page_inputs: List[Dict[str, Any]],
+        metrics: Dict[str, float],
+        cache_key: Optional[str],
+        docai_summary: Optional[Dict[str, Any]] = None,
+        remember: bool = True,
+    ) -> Tuple[InvoiceData, Dict[str, Any], Optional[str]]:
+        """
+        Shared tail of every extraction path: row repair, normalization, vendor profile
+        learning/counters, the cache write and the near-duplicate index write (skipped
+        with remember=False, for results that differ from what aprocess_invoice would
+        store under the same key).
+
+        Returns:
+            (final invoice data, repair stats, vendor profile key used or None)
+        """
+        repair_stats: Dict[str, Any] = {}
+        if settings.row_repair_enabled:
+            invoice_data, repair_stats = await self._arepair_rows(file_path, invoice_data, docai_summary)
+        normalize_start = time.perf_counter()
+        invoice_data = self._normalize_and_filter_items(invoice_data)
+        _add_stage_time("normalize", time.perf_counter() - normalize_start)
+
+        vendor_keys = [s["vendor"] for s in page_stats if s.get("vendor")]
+        if self.vendor_profiles is not None:
+            local_pages = int(metrics.get("vendor_local_pages", 0))
+            if not local_pages:
+                # Learn only from Claude's reading, never from the local parser's own output
+                await asyncio.to_thread(
+                    self.vendor_profiles.learn,
+                    invoice_data,
+                    [page_input["text"] for page_input in page_inputs if "text" in page_input],
+                )
+            self.vendor_profiles.record(
+                invoice_data.vendor_name,
+                vendor_keys[0] if vendor_keys else None,
+                local_pages,
+                int(metrics.get("prompt_tokens_saved", 0)),
+            )
+
+        if remember and self.cache is not None and cache_key is not None:
+            await asyncio.to_thread(self.cache.put, cache_key, invoice_data.model_dump_json())
+        if remember and self.duplicates is not None:
+            await asyncio.to_thread(self._remember_fingerprint, file_path, invoice_data)
+        return invoice_data, repair_stats, vendor_keys[0] if vendor_keys else None
+
+    async def aprocess_invoice(self, file_path: InvoiceSource, vendor_hint: Optional[str] = None) -> ProcessingResult:
+        """Process a single invoice file (PDF or image) without blocking the event loop.
         
         Args:
-            file_path: Path to the invoice file (PDF, JPG, JPEG, PNG)
+            file_path: Path to the invoice file (PDF, JPG, JPEG, PNG), or an
+                InMemoryInvoice for content that is already in memory (see `aprocess_bytes`)
+            vendor_hint: Supplier name, if the caller knows it (lets scans and photos use
+                the vendor's profile; digital PDFs are matched from their text layer)
             
         Returns:
             Processing result with extracted data
         """
         start_time = time.time()
         filename = file_path.name
+        metrics: Dict[str, float] = {}
+        metrics_token = _call_metrics.set(metrics)
+        slot: Optional[Slot] = None
         
         try:
-            # Check if file is an image or PDF
-            file_ext = file_path.suffix.lower()
-            
-            if file_ext in ['.jpg', '.jpeg', '.png', '.gif', '.webp']:
-                # Read image file directly
-                with open(file_path, 'rb') as f:
-                    image_bytes = f.read()
-                fallback_mime = self._mime_for_suffix(file_ext)
-                mime_type = self._detect_mime_from_bytes(image_bytes, fallback_mime)
-                images = [(image_bytes, mime_type)]
-            elif file_ext == '.pdf':
-            # Convert PDF to images
-                images = [(b, "image/png") for b in self.pdf_to_images(file_path, max_pages=1)]  # first page
-            else:
-                return ProcessingResult(
-                    filename=filename,
-                    success=False,
-                    error=f"Unsupported file type: {file_ext}",
-                    processing_time=time.time() - start_time,
-                    model_used=self.model
+            cache_key: Optional[str] = None
+            lookup_start = time.perf_counter()
+            if self.cache is not None:
+                cache_key, cached = await asyncio.to_thread(self._cache_lookup, file_path)
+                if cached is not None:
+                    return self._cache_hit_result(filename, cached, start_time)
+            if self.duplicates is not None:
+                duplicate = await asyncio.to_thread(self._duplicate_lookup, file_path)
+                if duplicate is not None:
+                    return self._duplicate_result(filename, *duplicate, start_time)
+            _add_stage_time("lookup", time.perf_counter() - lookup_start)
+
+            # Global in-flight limit (admission.py); hits above never wait for a slot
+            slot = await acquire_slot()
+            _add_stage_time("admission", slot.waited)
+
+            # Hybrid mode: DocAI runs while Claude extracts (latency ~ max of the two, not the sum)
+            docai_task: Optional["asyncio.Future[Dict[str, Any]]"] = None
+            docai_start = time.perf_counter()
+            if settings.hybrid_docai_enabled:
+                docai_task = asyncio.ensure_future(asyncio.to_thread(self._docai_summary, file_path))
+                # Early returns below must not leave an unretrieved exception behind
+                docai_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+            page_count = await asyncio.to_thread(self._page_count, file_path)
+            cascade = settings.cascade_enabled
+            first_model = settings.cascade_fast_model if cascade else self.model
+
+            # Render + extract every page concurrently (latency ~ slowest page, not the sum)
+            stage_start = time.perf_counter()
+            page_results = await asyncio.gather(
+                *(
+                    self._aextract_page(
+                        file_path, i, model=first_model, tolerate_parse_errors=cascade, vendor_hint=vendor_hint
+                    )
+                    for i in range(page_count)
                 )
+            )
+            pages = [data for data, _, _ in page_results if data is not None]
+            page_stats = [stats for _, stats, _ in page_results]
+            page_inputs = [page_input for _, _, page_input in page_results if page_input is not None]
+            route, route_stats = self._route_summary(page_stats)
+            image_stats = self._merge_image_stats([s for s in page_stats if s.get("route") != "text"])
             
-            if not images:
+            if not page_inputs:
                 return ProcessingResult(
                     filename=filename,
                     success=False,
@@ -562,10 +2305,34 @@ Input JSON:
                     model_used=self.model
                 )
             
-            # Process with Claude (with validation + normalization)
-            image_bytes, mime_type = images[0]
-            invoice_data = self.process_with_claude(image_bytes, mime_type)
-            invoice_data = self._normalize_and_filter_items(invoice_data)
+            # Merge pages (escalating to the main model if the fast stage looks weak),
+            # then validation + normalization
+            model_used = first_model
+            cascade_stages: List[Dict[str, Any]] = []
+            if cascade:
+                invoice_data, model_used, cascade_stages = await self._acascade(
+                    [data for data, _, page_input in page_results if page_input is not None],
+                    page_inputs,
+                    fast_latency=time.perf_counter() - stage_start,
+                    parse_errors=sum(1 for s in page_stats if "parse_error" in s),
+                )
+            else:
+                invoice_data = self._merge_page_results(pages)
+
+            hybrid_stats: Dict[str, Any] = {}
+            docai_summary: Optional[Dict[str, Any]] = None
+            if docai_task is not None:
+                try:
+                    docai_summary = await docai_task
+                    hybrid_stats["docai_latency"] = time.perf_counter() - docai_start
+                    invoice_data, reconcile_stats = await self._areconcile_with_docai(invoice_data, docai_summary)
+                    hybrid_stats.update(reconcile_stats)
+                except Exception as e:
+                    # DocAI is a second opinion; its failure must not fail the invoice
+                    hybrid_stats["error"] = str(e)
+            invoice_data, repair_stats, vendor_key = await self._afinalize(
+                file_path, invoice_data, page_stats, page_inputs, metrics, cache_key, docai_summary
+            )
             
             processing_time = time.time() - start_time
             
@@ -574,7 +2341,19 @@ Input JSON:
                 success=True,
                 invoice_data=invoice_data,
                 processing_time=processing_time,
-                model_used=self.model
+                model_used=model_used,
+                output_mode=self.output_mode,
+                cache_stats=self.cache.stats() if self.cache is not None else {},
+                image_stats=image_stats,
+                route=route,
+                route_stats=route_stats,
+                **self._metric_fields(metrics),
+                hybrid_stats=hybrid_stats,
+                repair_stats=repair_stats,
+                vendor_profile=vendor_key,
+                escalated=len(cascade_stages) > 1,
+                cascade_stages=cascade_stages,
+                escalation_rate=self.cascade_stats()["escalation_rate"] if cascade else None,
             )
             
         except Exception as e:
@@ -584,6 +2363,537 @@ Input JSON:
                 success=False,
                 error=str(e),
                 processing_time=processing_time,
-                model_used=self.model
+                model_used=self.model,
+                output_mode=self.output_mode,
+                **self._metric_fields(metrics),
+            )
+        finally:
+            if slot is not None:
+                slot.release()
+            _call_metrics.reset(metrics_token)
+
+    def process_invoice(self, file_path: InvoiceSource, vendor_hint: Optional[str] = None) -> ProcessingResult:
+        """Process a single invoice file (PDF or image).
+
+        Sync wrapper around `aprocess_invoice` for benchmark.py and the helper scripts.
+        
+        Args:
+            file_path: Path to the invoice file (PDF, JPG, JPEG, PNG)
+            vendor_hint: Supplier name, if known (see `aprocess_invoice`)
+            
+        Returns:
+            Processing result with extracted data
+        """
+        return self._run_sync(self.aprocess_invoice(file_path, vendor_hint))
+
+    async def aprocess_bytes(
+        self, content: Union[bytes, BinaryIO], filename: str, vendor_hint: Optional[str] = None
+    ) -> ProcessingResult:
+        """Process an invoice from bytes or a binary buffer, without a temporary file.
+
+        Args:
+            content: The file's bytes, or a readable binary buffer (e.g. BytesIO)
+            filename: Original file name; its suffix selects the PDF or image path
+            vendor_hint: Supplier name, if known (see `aprocess_invoice`)
+
+        Returns:
+            Processing result with extracted data
+        """
+        return await self.aprocess_invoice(InMemoryInvoice(filename, content), vendor_hint)
+
+    def process_bytes(
+        self, content: Union[bytes, BinaryIO], filename: str, vendor_hint: Optional[str] = None
+    ) -> ProcessingResult:
+        """Sync wrapper around `aprocess_bytes`."""
+        return self._run_sync(self.aprocess_bytes(content, filename, vendor_hint))
+
+    def _microbatch_eligible(self, file_path: InvoiceSource) -> bool:
+        """Single-page inputs (images, one-page PDFs); blocking, run in a thread."""
+        suffix = file_path.suffix.lower()
+        if suffix in ('.jpg', '.jpeg', '.png', '.gif', '.webp'):
+            return True
+        return suffix == '.pdf' and self._page_count(file_path) == 1
+
+    @staticmethod
+    def _image_tokens(stats: Dict[str, Any]) -> int:
+        if stats.get("width") and stats.get("height"):
+            return stats["width"] * stats["height"] // 750 + 1
+        return settings.image_max_tokens or 1600
+
+    async def _aprocess_microbatch(
+        self, batch: List[_PreparedInvoice], start_time: float
+    ) -> List[ProcessingResult]:
+        """
+        Extract several prepared single-page invoices with one Claude request.
+
+        The request's tokens and latency are split evenly across its invoices; invoices
+        the reply does not cover (or the whole batch, if the reply does not parse) are
+        re-run one by one with `aprocess_invoice`.
+        """
+        keys = [f"inv{i}" for i in range(len(batch))]
+        content: List[Dict[str, Any]] = []
+        for key, (_, page_input, _, _, own_metrics) in zip(keys, batch):
+            token = _call_metrics.set(own_metrics)
+            try:
+                base64_image = await asyncio.to_thread(self.encode_image_base64, page_input["image"])
+            finally:
+                _call_metrics.reset(token)
+            content.append({"type": "text", "text": f"Invoice {key}:"})
+            content.append({
+                "type": "image",
+                "source": {"type": "base64", "media_type": page_input["mime_type"], "data": base64_image},
+            })
+        content.append({"type": "text", "text": self.create_batch_extraction_prompt(keys)})
+
+        batch_metrics: Dict[str, float] = {}
+        metrics_token = _call_metrics.set(batch_metrics)
+        call_start = time.perf_counter()
+        try:
+            extracted = await self._aextract_invoice_batch(
+                [{"role": "user", "content": content}],
+                keys,
+                max_tokens=min(
+                    settings.extraction_max_tokens_cap,
+                    256 + settings.microbatch_output_tokens_per_image * len(batch),
+                ),
             )
+        except ValueError:
+            extracted = {}
+        finally:
+            _call_metrics.reset(metrics_token)
+        batch_latency = time.perf_counter() - call_start
+        self._record_route_latency("vision", batch_latency / len(batch))
+
+        async def finish(key: str, item: _PreparedInvoice) -> ProcessingResult:
+            file_path, page_input, stats, cache_key, own_metrics = item
+            if key not in extracted:
+                return await self.aprocess_invoice(file_path)
+            # This invoice's share of the batch call, plus its own work (render, encode,
+            # follow-up calls such as row repair)
+            metrics = {name: value / len(batch) for name, value in batch_metrics.items()}
+            for name, value in own_metrics.items():
+                metrics[name] = metrics.get(name, 0.0) + value
+            token = _call_metrics.set(metrics)
+            try:
+                stats["latency"] = batch_latency
+                invoice_data, repair_stats, vendor_key = await self._afinalize(
+                    file_path, extracted[key], [stats], [page_input], metrics, cache_key
+                )
+                route, route_stats = self._route_summary([stats])
+                return ProcessingResult(
+                    filename=file_path.name,
+                    success=True,
+                    invoice_data=invoice_data,
+                    processing_time=time.time() - start_time,
+                    model_used=self.model,
+                    output_mode=self.output_mode,
+                    cache_stats=self.cache.stats() if self.cache is not None else {},
+                    image_stats=self._merge_image_stats([stats]),
+                    route=route,
+                    route_stats=route_stats,
+                    **self._metric_fields(metrics),
+                    repair_stats=repair_stats,
+                    vendor_profile=vendor_key,
+                    batch_size=len(batch),
+                    amortized_time=batch_latency / len(batch),
+                )
+            except Exception as e:
+                return ProcessingResult(
+                    filename=file_path.name,
+                    success=False,
+                    error=str(e),
+                    processing_time=time.time() - start_time,
+                    model_used=self.model,
+                    output_mode=self.output_mode,
+                    **self._metric_fields(metrics),
+                    batch_size=len(batch),
+                )
+            finally:
+                _call_metrics.reset(token)
+
+        return list(await asyncio.gather(*(finish(key, item) for key, item in zip(keys, batch))))
+
+    async def aprocess_invoices(
+        self,
+        file_paths: Sequence[InvoiceSource],
+        on_result: Optional[Callable[[int, ProcessingResult], None]] = None,
+    ) -> List[ProcessingResult]:
+        """Process several invoices concurrently; results keep the input order.
+
+        Near-duplicates inside the batch (same invoice uploaded twice, recompressed or
+        re-photographed) are extracted once and the copies reuse that result. With
+        settings.microbatch_enabled, single-page photos/scans that miss the cache share
+        Claude requests (up to microbatch_max_images images within
+        microbatch_max_input_tokens); everything else goes through `aprocess_invoice`.
+        Cascade and hybrid mode need per-invoice calls, so they disable micro-batching.
+
+        Args:
+            file_paths: Invoice files
+            on_result: Called with (input index, result) as soon as each invoice is done,
+                in completion order (streaming endpoints); copies of an in-batch duplicate
+                are reported together with their original
+
+        Returns:
+            One ProcessingResult per input file, in input order
+        """
+        async def arrivals() -> AsyncIterator[InvoiceSource]:
+            for file_path in file_paths:
+                yield file_path
+
+        return await self.aprocess_stream(arrivals(), on_result)
+
+    async def aprocess_stream(
+        self,
+        sources: AsyncIterator[InvoiceSource],
+        on_result: Optional[Callable[[int, ProcessingResult], None]] = None,
+    ) -> List[ProcessingResult]:
+        """Process invoices as they arrive, e.g. while an upload is still being received.
+
+        Same duplicate reuse and micro-batching as `aprocess_invoices`, which calls this.
+        Every invoice starts as soon as it arrives: copies of an earlier invoice wait for
+        its result, and a micro-batch is sent once full (the last, partial one when
+        `sources` is exhausted).
+
+        Args:
+            sources: Invoice files, yielded as they become available
+            on_result: Called with (arrival index, result) as soon as each invoice is done
+
+        Returns:
+            One ProcessingResult per source, in arrival order
+        """
+        start_time = time.time()
+        results: Dict[int, ProcessingResult] = {}
+        tasks: List["asyncio.Future[None]"] = []
+        distinct: List[int] = []
+        fingerprints: Dict[int, Optional[Fingerprint]] = {}
+        copies: Dict[int, List[Tuple[int, InvoiceSource, DuplicateMatch]]] = {}
+        microbatch = settings.microbatch_enabled and not settings.cascade_enabled and not settings.hybrid_docai_enabled
+        prompt_tokens = self._estimate_tokens(self.create_batch_extraction_prompt(["inv0"])) if microbatch else 0
+        group: List[Tuple[int, _PreparedInvoice]] = []
+        group_tokens = prompt_tokens
+
+        def report(idx: int, result: ProcessingResult) -> None:
+            results[idx] = result
+            if on_result is not None:
+                on_result(idx, result)
 
+        def reuse(idx: int, source: InvoiceSource, original: ProcessingResult, match: DuplicateMatch) -> None:
+            if original.success and original.invoice_data is not None:
+                match.filename = original.filename
+                report(idx, self._duplicate_result(source.name, original.invoice_data, match, start_time))
+            else:
+                # The original failed; the copy gets its own attempt
+                tasks.append(asyncio.ensure_future(run_single(idx, source)))
+
+        def original_done(idx: int, result: ProcessingResult) -> None:
+            report(idx, result)
+            for copy_idx, source, match in copies.pop(idx, []):
+                reuse(copy_idx, source, result, match)
+
+        async def run_single(idx: int, source: InvoiceSource, microbatch_error: Optional[str] = None) -> None:
+            result = await self.aprocess_invoice(source)
+            result.microbatch_error = microbatch_error
+            original_done(idx, result)
+
+        async def run_group(batch: List[Tuple[int, _PreparedInvoice]]) -> None:
+            if len(batch) == 1:
+                await run_single(batch[0][0], batch[0][1][0])
+                return
+            try:
+                # One slot for the whole micro-batch: it is a single Claude request
+                async with extraction_slot() as slot:
+                    for _, item in batch:
+                        item[4]["stage_admission"] = slot.waited
+                    batch_results = await self._aprocess_microbatch([item for _, item in batch], start_time)
+            except Exception as e:
+                # The shared request failed: each invoice gets its own attempt (and error)
+                error = f"{type(e).__name__}: {e}"
+                await asyncio.gather(*(run_single(idx, item[0], error) for idx, item in batch))
+                return
+            for (idx, _), result in zip(batch, batch_results):
+                original_done(idx, result)
+
+        def send_group() -> None:
+            nonlocal group, group_tokens
+            if group:
+                tasks.append(asyncio.ensure_future(run_group(group)))
+            group, group_tokens = [], prompt_tokens
+
+        def add_to_group(idx: int, item: _PreparedInvoice) -> None:
+            nonlocal group_tokens
+            tokens = self._image_tokens(item[2])
+            if group and group_tokens + tokens > settings.microbatch_max_input_tokens:
+                send_group()
+            group.append((idx, item))
+            group_tokens += tokens
+            if len(group) >= settings.microbatch_max_images:
+                send_group()
+
+        async def prepare(idx: int, file_path: InvoiceSource) -> Optional[_PreparedInvoice]:
+            if not await asyncio.to_thread(self._microbatch_eligible, file_path):
+                return None
+            # Each task runs in its own context copy: this dict stays per file
+            own_metrics: Dict[str, float] = {}
+            _call_metrics.set(own_metrics)
+            lookup_start = time.perf_counter()
+            cache_key: Optional[str] = None
+            if self.cache is not None:
+                cache_key, cached = await asyncio.to_thread(self._cache_lookup, file_path)
+                if cached is not None:
+                    original_done(idx, self._cache_hit_result(file_path.name, cached, start_time))
+                    return None
+            if self.duplicates is not None:
+                duplicate = await asyncio.to_thread(self._duplicate_lookup, file_path)
+                if duplicate is not None:
+                    original_done(idx, self._duplicate_result(file_path.name, *duplicate, start_time))
+                    return None
+            _add_stage_time("lookup", time.perf_counter() - lookup_start)
+            page_input, stats = await self._aprepare_page(file_path, 0)
+            if page_input is None or "image" not in page_input:
+                return None  # digital PDFs take the (cheaper) text-layer path on their own
+            return file_path, page_input, stats, cache_key, own_metrics
+
+        async def run(
+            idx: int,
+            source: InvoiceSource,
+            fingerprint_task: Optional["asyncio.Future[Optional[Fingerprint]]"],
+            previous: Optional["asyncio.Future[None]"],
+            classified: "asyncio.Future[None]",
+        ) -> None:
+            # Classified in arrival order, against the distinct invoices before this one
+            try:
+                try:
+                    fingerprints[idx] = await fingerprint_task if fingerprint_task is not None else None
+                except Exception:
+                    fingerprints[idx] = None  # unreadable file: never a duplicate; it fails on its own
+                if previous is not None:
+                    await previous
+                for j in distinct:
+                    match = (
+                        self.duplicates.same(fingerprints[idx], fingerprints[j])
+                        if fingerprints[idx] is not None and fingerprints[j] is not None
+                        else None
+                    )
+                    if match is not None:
+                        if j in results:
+                            reuse(idx, source, results[j], match)
+                        else:
+                            copies.setdefault(j, []).append((idx, source, match))
+                        return
+                distinct.append(idx)
+            finally:
+                classified.set_result(None)
+
+            item: Optional[_PreparedInvoice] = None
+            if microbatch:
+                try:
+                    item = await prepare(idx, source)
+                except Exception:
+                    item = None  # corrupt or unreadable: aprocess_invoice reports the error for this file alone
+            if item is not None:
+                add_to_group(idx, item)
+            elif idx not in results:
+                await run_single(idx, source)
+
+        count = 0
+        try:
+            previous: Optional["asyncio.Future[None]"] = None
+            async for source in sources:
+                fingerprint_task = (
+                    asyncio.ensure_future(asyncio.to_thread(self._fingerprint, source))
+                    if self.duplicates is not None
+                    else None
+                )
+                classified: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+                tasks.append(asyncio.ensure_future(run(count, source, fingerprint_task, previous, classified)))
+                previous = classified
+                count += 1
+
+            # Groups and retries are added while earlier tasks finish
+            while True:
+                running = [t for t in tasks if not t.done()]
+                if running:
+                    await asyncio.gather(*running)
+                elif group:
+                    send_group()  # every arrival is prepared: the partial group goes now
+                else:
+                    break
+        finally:
+            for task in tasks:
+                task.cancel()
+        return [results[i] for i in range(count)]
+
+    def process_invoices(self, file_paths: Sequence[InvoiceSource]) -> List[ProcessingResult]:
+        """Sync wrapper around `aprocess_invoices`."""
+        return self._run_sync(self.aprocess_invoices(file_paths))
+
+    def _streamed_item(self, raw: Any, columns: Optional[List[Any]] = None) -> Optional[InvoiceItem]:
+        """InvoiceItem for one streamed array element, or None if it would be dropped anyway.
+
+        Compact rows are mapped with the reply's own "c" header (`columns`) when it was
+        streamed, like `expand_invoice` does for the final reply.
+        """
+        if isinstance(raw, list):
+            columns = columns or INVOICE_ITEM_COLUMNS
+            if len(raw) > len(columns) or not all(isinstance(c, str) for c in columns):
+                return None
+            raw = dict(zip(columns, raw))
+        if not isinstance(raw, dict):
+            return None
+        try:
+            item = InvoiceItem(**raw)
+        except (TypeError, ValueError):
+            return None
+        if item.llm_confidence is not None and item.llm_confidence < 8.5:
+            return None
+        return item
+
+    async def astream_invoice(self, file_path: InvoiceSource) -> AsyncIterator[Dict[str, Any]]:
+        """Process an invoice while streaming its line items.
+
+        Pages are extracted concurrently with the main model (no cascade); every line item
+        is yielded as soon as its JSON element closes in Claude's streamed reply. Streamed
+        items are provisional: page-break dedup, row repair and normalization only apply
+        to the final result, which goes through the same `_afinalize` as aprocess_invoice.
+
+        Yields:
+            {"event": "item", "page", "index", "elapsed", "item"} per line item, then one
+            {"event": "result", "result"} with the ProcessingResult (incl. time_to_first_item)
+        """
+        start_time = time.time()
+        filename = file_path.name
+        metrics: Dict[str, float] = {}
+        queue: "asyncio.Queue[Optional[Tuple[int, InvoiceItem]]]" = asyncio.Queue()
+        first_item_at: Optional[float] = None
+        emitted = 0
+
+        def item_event(page_index: int, item: InvoiceItem) -> Dict[str, Any]:
+            nonlocal first_item_at, emitted
+            elapsed = time.time() - start_time
+            if first_item_at is None:
+                first_item_at = elapsed
+            emitted += 1
+            return {"event": "item", "page": page_index, "index": emitted - 1, "elapsed": elapsed,
+                    "item": item.model_dump()}
+
+        cache_key: Optional[str] = None
+        if self.cache is not None:
+            cache_key, cached = await asyncio.to_thread(self._cache_lookup, file_path)
+            if cached is not None:
+                for item in cached.items:
+                    yield item_event(0, item)
+                yield {"event": "result", "result": self._cache_hit_result(
+                    filename, cached, start_time, time_to_first_item=first_item_at
+                ).model_dump()}
+                return
+        if self.duplicates is not None:
+            duplicate = await asyncio.to_thread(self._duplicate_lookup, file_path)
+            if duplicate is not None:
+                for item in duplicate[0].items:
+                    yield item_event(0, item)
+                yield {"event": "result", "result": self._duplicate_result(
+                    filename, *duplicate, start_time, time_to_first_item=first_item_at
+                ).model_dump()}
+                return
+
+        async def run_page(
+            page_index: int,
+        ) -> Tuple[Optional[InvoiceData], Dict[str, Any], Optional[Dict[str, Any]]]:
+            if self.output_mode == "compact":
+                parser = IncrementalItemParser("i", header_key="c")
+            else:
+                parser = IncrementalItemParser("items")
+
+            def on_delta(chunk: str) -> None:
+                for raw in parser.feed(chunk):
+                    item = self._streamed_item(raw, parser.header)
+                    if item is not None:
+                        queue.put_nowait((page_index, item))
+
+            start = time.perf_counter()
+            page_input, stats = await self._aprepare_page(file_path, page_index)
+            if page_input is None:
+                return None, stats, None
+            data = await self._aextract_prepared(page_input, on_delta=on_delta)
+            if parser.emitted == 0:
+                # Parsed locally from a vendor layout: nothing was streamed
+                for item in data.items:
+                    queue.put_nowait((page_index, item))
+            latency = time.perf_counter() - start
+            self._record_route_latency(stats["route"], latency)
+            stats["latency"] = latency
+            return data, stats, page_input
+
+        async def run_all() -> Tuple[InvoiceData, List[Dict[str, Any]], Dict[str, Any], Optional[str]]:
+            async with extraction_slot() as slot:
+                _add_stage_time("admission", slot.waited)
+                page_count = await asyncio.to_thread(self._page_count, file_path)
+                page_results = await asyncio.gather(*(run_page(i) for i in range(page_count)))
+                pages = [data for data, _, _ in page_results if data is not None]
+                if not pages:
+                    raise ValueError("No images extracted from file")
+                page_stats = [stats for _, stats, _ in page_results]
+                page_inputs = [page_input for _, _, page_input in page_results if page_input is not None]
+                # Without the cascade and DocAI reconciliation this is not the result
+                # aprocess_invoice would cache under the same key; finalize, don't store
+                invoice_data, repair_stats, vendor_key = await self._afinalize(
+                    file_path,
+                    self._merge_page_results(pages),
+                    page_stats,
+                    page_inputs,
+                    metrics,
+                    cache_key,
+                    remember=not (settings.cascade_enabled or settings.hybrid_docai_enabled),
+                )
+                return invoice_data, page_stats, repair_stats, vendor_key
+
+        # The task copies the context, so its Claude calls add to this invoice's metrics
+        metrics_token = _call_metrics.set(metrics)
+        try:
+            task = asyncio.ensure_future(run_all())
+        finally:
+            _call_metrics.reset(metrics_token)
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+
+        try:
+            while True:
+                entry = await queue.get()
+                if entry is None:
+                    break
+                yield item_event(*entry)
+
+            try:
+                invoice_data, page_stats, repair_stats, vendor_key = task.result()
+                route, route_stats = self._route_summary(page_stats)
+                result = ProcessingResult(
+                    filename=filename,
+                    success=True,
+                    invoice_data=invoice_data,
+                    processing_time=time.time() - start_time,
+                    model_used=self.model,
+                    output_mode=self.output_mode,
+                    cache_stats=self.cache.stats() if self.cache is not None else {},
+                    image_stats=self._merge_image_stats([s for s in page_stats if s.get("route") != "text"]),
+                    route=route,
+                    route_stats=route_stats,
+                    time_to_first_item=first_item_at,
+                    **self._metric_fields(metrics),
+                    repair_stats=repair_stats,
+                    vendor_profile=vendor_key,
+                )
+            except Exception as e:
+                result = ProcessingResult(
+                    filename=filename,
+                    success=False,
+                    error=str(e),
+                    processing_time=time.time() - start_time,
+                    model_used=self.model,
+                    output_mode=self.output_mode,
+                    time_to_first_item=first_item_at,
+                    **self._metric_fields(metrics),
+                )
+            yield {"event": "result", "result": result.model_dump()}
+        finally:
+            if not task.done():
+                # Client went away mid-stream
+                task.cancel()
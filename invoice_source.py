@@ -0,0 +1,51 @@
+"""In-memory invoice files for InvoiceProcessor.
+
+The processor only needs a few things from an invoice file: its name and suffix, its
+bytes, its size and, for PDFs, a PyMuPDF document. `InMemoryInvoice` provides the
+same (name, suffix, read_bytes(), stat()) for content that is already in memory, so
+API uploads are processed without a temporary file; `open_pdf` opens either kind.
+"""
+import hashlib
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, BinaryIO, Union
+
+import fitz  # PyMuPDF
+
+
+class InMemoryInvoice:
+    """An invoice file held in memory; accepted wherever the processor takes a Path."""
+
+    def __init__(self, name: str, content: Union[bytes, bytearray, memoryview, BinaryIO]):
+        if hasattr(content, "read"):
+            content = content.read()
+        self.name = Path(name).name
+        self.suffix = Path(name).suffix
+        self._content = content if isinstance(content, bytes) else bytes(content)
+        self._digest: Union[str, None] = None
+
+    def read_bytes(self) -> bytes:
+        return self._content
+
+    def stat(self) -> Any:
+        """The os.stat_result fields the processor reads (size; mtime is constant)."""
+        return SimpleNamespace(st_size=len(self._content), st_mtime_ns=0)
+
+    def __str__(self) -> str:
+        # Content-addressed, so per-file memo keys (e.g. fingerprints) never collide
+        if self._digest is None:
+            self._digest = hashlib.sha256(self._content).hexdigest()
+        return f"memory:{self._digest}/{self.name}"
+
+    def __repr__(self) -> str:
+        return f"InMemoryInvoice({self.name!r}, {len(self._content)} bytes)"
+
+
+InvoiceSource = Union[Path, InMemoryInvoice]
+
+
+def open_pdf(source: InvoiceSource) -> "fitz.Document":
+    """Open a PDF from disk or from memory (no copy of the bytes)."""
+    if isinstance(source, InMemoryInvoice):
+        return fitz.open(stream=source.read_bytes(), filetype="pdf")
+    return fitz.open(source)
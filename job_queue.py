@@ -0,0 +1,254 @@
+"""Background batch jobs for the API (POST /api/jobs, GET /api/jobs/{id}).
+
+/api/process/batch holds the HTTP connection until every invoice is done, which large
+uploads cannot survive behind a proxy. A job instead:
+- keeps its files under settings.jobs_dir/<id> (the API writes each upload there while
+  it arrives) and a row in a SQLite store
+- runs in the background, at most settings.jobs_max_concurrent jobs at a time (later
+  jobs wait in "queued")
+- processes its files in chunks of settings.jobs_chunk_size through
+  InvoiceProcessor.aprocess_invoices (micro-batching and in-batch duplicate reuse still
+  apply) and saves each chunk's results as soon as it completes
+- on completion writes the CSVs and the cost analysis, then deletes its files
+
+Jobs still queued or running when the process stops are picked up again on startup;
+files that already have a stored result are not processed twice.
+"""
+import asyncio
+import json
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from admission import client_scope
+from config import settings
+from cost_analyzer import CostAnalyzer
+from csv_exporter import CSVExporter
+from models import ProcessingResult
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+
+class JobStore:
+    """SQLite persistence for jobs and their per-file results."""
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                files TEXT NOT NULL,
+                summary TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS job_results (
+                job_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                result TEXT NOT NULL,
+                PRIMARY KEY (job_id, idx)
+            );
+            """
+        )
+        self._conn.commit()
+
+    def create(self, job_id: str, files: List[Dict[str, str]]) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, status, files, created_at) VALUES (?, 'queued', ?, ?)",
+                (job_id, json.dumps(files), time.time()),
+            )
+            self._conn.commit()
+
+    def set_status(self, job_id: str, status: str, summary: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> None:
+        now = time.time()
+        with self._lock:
+            if status == "running":
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, started_at = COALESCE(started_at, ?) WHERE id = ?",
+                    (status, now, job_id),
+                )
+            else:
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, summary = ?, error = ?, finished_at = ? WHERE id = ?",
+                    (status, json.dumps(summary) if summary is not None else None, error,
+                     now if status in TERMINAL_STATUSES else None, job_id),
+                )
+            self._conn.commit()
+
+    def save_results(self, job_id: str, results: Sequence[Tuple[int, ProcessingResult]]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO job_results (job_id, idx, result) VALUES (?, ?, ?)",
+                [(job_id, idx, result.model_dump_json()) for idx, result in results],
+            )
+            self._conn.commit()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, files, summary, error, created_at, started_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ("id", "status", "files", "summary", "error", "created_at", "started_at", "finished_at")
+        job = dict(zip(keys, row))
+        job["files"] = json.loads(job["files"])
+        job["summary"] = json.loads(job["summary"]) if job["summary"] else None
+        return job
+
+    def results(self, job_id: str) -> Dict[int, ProcessingResult]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT idx, result FROM job_results WHERE job_id = ? ORDER BY idx", (job_id,)
+            ).fetchall()
+        return {idx: ProcessingResult.model_validate_json(raw) for idx, raw in rows}
+
+    def unfinished(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at"
+            ).fetchall()
+        return [job_id for (job_id,) in rows]
+
+
+class JobManager:
+    """Runs jobs in the background on the API's event loop."""
+
+    def __init__(self, processor: Any, store: JobStore, jobs_dir: Path, max_concurrent: int = 2, chunk_size: int = 4):
+        self.processor = processor
+        self.store = store
+        self.jobs_dir = Path(jobs_dir)
+        self.chunk_size = max(1, chunk_size)
+        self._slots = asyncio.Semaphore(max(1, max_concurrent))
+        self._tasks: Dict[str, "asyncio.Task[None]"] = {}
+
+    @classmethod
+    def from_settings(cls, processor: Any) -> "JobManager":
+        return cls(
+            processor,
+            JobStore(Path(settings.jobs_db_path)),
+            Path(settings.jobs_dir),
+            max_concurrent=settings.jobs_max_concurrent,
+            chunk_size=settings.jobs_chunk_size,
+        )
+
+    def new_job(self) -> Tuple[str, Path]:
+        """A fresh job id and the directory its files belong in (deleted on completion)."""
+        job_id = uuid.uuid4().hex
+        return job_id, self.jobs_dir / job_id
+
+    async def submit(self, job_id: str, paths: Sequence[Path]) -> str:
+        """Queue a job for files already stored in its directory (see `new_job`); one
+        directory per file keeps the original name, which results report."""
+        files = [{"filename": Path(path).name, "path": str(path)} for path in paths]
+        await asyncio.to_thread(self.store.create, job_id, files)
+        self._start(job_id)
+        return job_id
+
+    def resume(self) -> List[str]:
+        """Restart jobs left queued/running by a previous process."""
+        job_ids = [job_id for job_id in self.store.unfinished() if job_id not in self._tasks]
+        for job_id in job_ids:
+            self._start(job_id)
+        return job_ids
+
+    def _start(self, job_id: str) -> None:
+        task = asyncio.ensure_future(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+
+    async def _run(self, job_id: str) -> None:
+        # Jobs queue for extraction slots as their own clients (round-robin with the API)
+        with client_scope(f"job:{job_id}"):
+            await self._run_job(job_id)
+
+    async def _run_job(self, job_id: str) -> None:
+        async with self._slots:
+            job = await asyncio.to_thread(self.store.get, job_id)
+            if job is None:
+                return
+            try:
+                await asyncio.to_thread(self.store.set_status, job_id, "running")
+                done = await asyncio.to_thread(self.store.results, job_id)
+                pending = [i for i in range(len(job["files"])) if i not in done]
+                chunks = [pending[i:i + self.chunk_size] for i in range(0, len(pending), self.chunk_size)]
+                await asyncio.gather(*(self._run_chunk(job_id, job["files"], chunk) for chunk in chunks))
+
+                results = list((await asyncio.to_thread(self.store.results, job_id)).values())
+                summary = await asyncio.to_thread(self._summarize, results)
+                await asyncio.to_thread(self.store.set_status, job_id, "completed", summary)
+                shutil.rmtree(self.jobs_dir / job_id, ignore_errors=True)
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                await asyncio.to_thread(self.store.set_status, job_id, "failed", None, str(e))
+
+    async def _run_chunk(self, job_id: str, files: List[Dict[str, str]], indexes: List[int]) -> None:
+        present = [i for i in indexes if Path(files[i]["path"]).exists()]
+        results = list(zip(present, await self.processor.aprocess_invoices([Path(files[i]["path"]) for i in present])))
+        results += [
+            (i, ProcessingResult(filename=files[i]["filename"], success=False, error="Uploaded file is missing"))
+            for i in indexes
+            if i not in present
+        ]
+        await asyncio.to_thread(self.store.save_results, job_id, results)
+
+    @staticmethod
+    def _summarize(results: List[ProcessingResult]) -> Dict[str, Any]:
+        csv_files = CSVExporter.export_all(results, Path(settings.output_dir))
+        return {
+            "cost_analysis": CostAnalyzer.calculate_savings_analysis(results),
+            "master_list": CostAnalyzer.get_master_list(results),
+            "downloads": {
+                "items_csv": f"/api/download/items/{Path(csv_files['items_csv']).name}",
+                "summary_csv": f"/api/download/summary/{Path(csv_files['summary_csv']).name}",
+            },
+        }
+
+    def status(self, job_id: str, include_results: bool = True) -> Optional[Dict[str, Any]]:
+        """Progress, (partial) results and, once completed, cost analysis and downloads
+        (blocking; run in a thread)."""
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        results = self.store.results(job_id)
+        ordered = [results[i] for i in sorted(results)]
+        total = len(job["files"])
+        successful = sum(1 for r in ordered if r.success)
+        out: Dict[str, Any] = {
+            "job_id": job_id,
+            "status": job["status"],
+            "error": job["error"],
+            "created_at": job["created_at"],
+            "started_at": job["started_at"],
+            "finished_at": job["finished_at"],
+            "progress": {
+                "total_files": total,
+                "processed": len(ordered),
+                "successful": successful,
+                "failed": len(ordered) - successful,
+                "percent": round(100.0 * len(ordered) / total, 1) if total else 100.0,
+            },
+            "estimated_cost_usd": sum(r.estimated_cost_usd for r in ordered),
+        }
+        if include_results:
+            out["results"] = [r.model_dump() for r in ordered]
+        if job["summary"] is not None:
+            out.update(job["summary"])
+        elif ordered:
+            # Running: cost analysis over the invoices finished so far
+            out["cost_analysis"] = CostAnalyzer.calculate_savings_analysis(ordered)
+        return out
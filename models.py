@@ -1,6 +1,6 @@
 """Data models for invoice processing."""
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 from datetime import datetime
 
 
@@ -41,6 +41,74 @@ class ProcessingResult(BaseModel):
     error: Optional[str] = None
     processing_time: float = 0.0
     model_used: str = ""
+    cache_hit: bool = Field(False, description="Result was served from the extraction cache")
+    cache_stats: Dict[str, int] = Field(
+        default_factory=dict, description="Cumulative extraction cache hit/miss counters"
+    )
+    image_stats: Dict[str, Any] = Field(
+        default_factory=dict,
+        description="Image preprocessing stats (bytes before/after, size, render/encode time)",
+    )
+    route: str = Field("", description="Extraction route: vision | text | mixed | cache | duplicate")
+    route_stats: Dict[str, Any] = Field(
+        default_factory=dict,
+        description="Pages per route, text-layer size and estimated time saved vs vision",
+    )
+    queue_wait_time: float = Field(0.0, description="Seconds spent waiting on the rate limiter / backoff")
+    model_latency: float = Field(0.0, description="Seconds spent inside Claude API calls")
+    api_retries: int = Field(0, description="Claude calls retried after 429/529/transient errors")
+    stage_timings: Dict[str, float] = Field(
+        default_factory=dict,
+        description=(
+            "Seconds per stage, summed over pages/calls: lookup, text_layer, render, image_encode, "
+            "mime_detect, base64, queue_wait, model (network + generation), parse, normalize"
+        ),
+    )
+    input_tokens: int = Field(0, description="Claude input tokens billed for this invoice")
+    output_tokens: int = Field(0, description="Claude output tokens billed for this invoice")
+    time_to_first_item: Optional[float] = Field(
+        None, description="Seconds until the first line item was streamed (streaming endpoint only)"
+    )
+    continuations: int = Field(0, description="Follow-up calls made after replies hit max_tokens")
+    continuation_latency: float = Field(0.0, description="Extra seconds spent on those follow-up calls")
+    output_mode: str = Field("", description="Claude output mode: json (free text) | tool (tool use) | compact (header + one array per item)")
+    hybrid_stats: Dict[str, Any] = Field(
+        default_factory=dict,
+        description="Hybrid DocAI + Claude mode: DocAI latency and rows agreed/settled/disputed/adjudicated",
+    )
+    repair_stats: Dict[str, Any] = Field(
+        default_factory=dict,
+        description="Row repair: rows failing qty x unit_price = total, located, repaired, latency",
+    )
+    vendor_profile: Optional[str] = Field(None, description="Vendor profile used for this invoice (normalized vendor key)")
+    prompt_tokens_saved: int = Field(0, description="Estimated input tokens saved by vendor prompts / the local parser")
+    vendor_local_pages: int = Field(0, description="Pages parsed locally from a trusted vendor layout (no Claude call)")
+    locally_parsed: bool = Field(
+        False,
+        description="Some line items come from the local vendor-layout parser, not Claude (their llm_confidence is null)",
+    )
+    duplicate_of: Optional[str] = Field(
+        None, description="route 'duplicate': file whose extraction was reused (near-duplicate input)"
+    )
+    duplicate_distance: Optional[int] = Field(None, description="pHash bits between this file and duplicate_of")
+    estimated_cost_usd: float = Field(
+        0.0, description="Claude cost estimate from the billed tokens (CLAUDE_*_USD_PER_MTOK)"
+    )
+    batch_size: int = Field(1, description="Invoices that shared this invoice's Claude request (micro-batching)")
+    amortized_time: Optional[float] = Field(
+        None, description="Micro-batched invoices: the shared request's latency divided by batch_size"
+    )
+    microbatch_error: Optional[str] = Field(
+        None, description="The shared micro-batch request failed with this error; the invoice was re-run on its own"
+    )
+    escalated: bool = Field(False, description="Cascade re-ran the extraction with the main model")
+    cascade_stages: List[Dict[str, Any]] = Field(
+        default_factory=list,
+        description="Per cascade stage: model, latency, invalid_ratio, low_confidence_share",
+    )
+    escalation_rate: Optional[float] = Field(
+        None, description="Share of cascaded invoices escalated so far in this process"
+    )
 
 
 class BenchmarkResult(BaseModel):
@@ -51,6 +119,12 @@ class BenchmarkResult(BaseModel):
     total_time: float
     average_time: float
     results: List[ProcessingResult]
+    stage_stats: Dict[str, Dict[str, float]] = Field(
+        default_factory=dict, description="Per stage over extracted invoices: mean, p50, p95, total seconds, share"
+    )
+    token_stats: Dict[str, float] = Field(
+        default_factory=dict, description="Input/output tokens and estimated cost: totals and per-invoice means"
+    )
     timestamp: str = Field(default_factory=lambda: datetime.now().isoformat())
 
 
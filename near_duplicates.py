@@ -0,0 +1,377 @@
+"""Near-duplicate detection for re-uploaded invoices.
+
+The extraction cache keys on exact bytes, so a WhatsApp recompression, a resized copy or
+a second photo of the same page pays for a new extraction. A Fingerprint catches those:
+- digital PDFs: a hash of the normalized text layer (same text = same invoice)
+- images and scans, per page (cropped to the inked area first, so margins and small
+  re-framing do not matter):
+  - a 64-bit pHash (DCT of a 32x32 thumbnail) and a 64-bit dHash (8x8 gradients), the
+    cheap nearest-neighbour filter (Hamming distance, vectorized with NumPy)
+  - a DETAIL_WIDTH px wide grayscale "detail" image for the final check
+
+The hashes alone cannot tell two invoices of the same supplier template apart (only a
+few digits differ), so every hash candidate is confirmed on the detail images: best
+alignment within a few pixels, then the largest difference of any small block. Changed
+digits show up there; recompression and resizing noise averages out.
+
+The index keeps hashes in memory and details/results in SQLite; entries are scoped by
+the extraction parameters, so a model or prompt change never reuses old results.
+"""
+import hashlib
+import io
+import json
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import fitz  # PyMuPDF
+import numpy as np
+from PIL import Image, ImageOps
+
+from config import settings
+
+DETAIL_WIDTH = 512
+DETAIL_BLOCK = 4  # px; block size of the detail comparison
+DETAIL_MAX_SHIFT = 2  # px; alignment search in each direction
+ASPECT_TOLERANCE = 0.03
+HASH_RENDER_DPI = 100
+MAX_VERIFY = 5  # nearest hash candidates confirmed on detail images per lookup
+INK_CONTRAST = 40  # gray levels below the page median that count as ink
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    return np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+
+
+_DCT32 = _dct_matrix(32)
+
+
+def _pack(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.astype(bool)).tobytes(), "big")
+
+
+def dhash(gray: Image.Image, size: int = 8) -> int:
+    """Difference hash: is each pixel of a (size+1) x size thumbnail brighter than its left neighbour."""
+    pixels = np.asarray(gray.resize((size + 1, size), Image.LANCZOS), dtype=np.int16)
+    return _pack((pixels[:, 1:] > pixels[:, :-1]).flatten())
+
+
+def phash(gray: Image.Image) -> int:
+    """DCT hash: the 8x8 lowest frequencies of a 32x32 thumbnail, above/below their median."""
+    pixels = np.asarray(gray.resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT32 @ pixels @ _DCT32.T)[:8, :8].flatten()
+    return _pack(low > np.median(low[1:]))
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def _hamming_many(hashes: np.ndarray, h: int) -> np.ndarray:
+    x = np.bitwise_xor(hashes, np.uint64(h))
+    return _POPCOUNT[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _content_crop(gray: Image.Image) -> Image.Image:
+    """Crop to the inked area (the bounding box of pixels clearly darker than the page)."""
+    pixels = np.asarray(gray)
+    ink = pixels < np.median(pixels) - INK_CONTRAST
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    if rows.size == 0 or cols.size == 0:
+        return gray
+    return gray.crop((int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1))
+
+
+@dataclass
+class PageSignature:
+    phash: int
+    dhash: int
+    detail: np.ndarray  # uint8, DETAIL_WIDTH wide
+
+
+@dataclass
+class Fingerprint:
+    """Perceptual identity of one input file."""
+    kind: str  # "text" (digital PDF) | "image"
+    text_hash: Optional[str] = None
+    pages: List[PageSignature] = field(default_factory=list)
+
+
+def page_signature(image: Image.Image) -> PageSignature:
+    gray = image.convert("L")
+    if max(gray.size) > 1600:
+        gray.thumbnail((1600, 1600), Image.LANCZOS)
+    content = _content_crop(gray)
+    height = max(1, min(4 * DETAIL_WIDTH, round(content.height * DETAIL_WIDTH / max(1, content.width))))
+    detail = np.asarray(content.resize((DETAIL_WIDTH, height), Image.LANCZOS), dtype=np.uint8)
+    return PageSignature(phash=phash(content), dhash=dhash(content), detail=detail)
+
+
+def detail_distance(a: np.ndarray, b: np.ndarray) -> Optional[float]:
+    """Largest block difference between two detail images at their best alignment
+    (in standard deviations of the page); None when the aspect ratios differ."""
+    if abs(a.shape[0] - b.shape[0]) > ASPECT_TOLERANCE * max(a.shape[0], b.shape[0]):
+        return None
+    r, k = DETAIL_MAX_SHIFT, DETAIL_BLOCK
+    height = min(a.shape[0], b.shape[0]) - 2 * r
+    if height < k:
+        return None
+    na = (a - a.mean()) / (a.std() or 1.0)
+    nb = (b - b.mean()) / (b.std() or 1.0)
+    core = na[r:r + height, r:DETAIL_WIDTH - r]
+    rows, cols = (core.shape[0] // k) * k, (core.shape[1] // k) * k
+    best: Optional[float] = None
+    for dy in range(-r, r + 1):
+        for dx in range(-r, r + 1):
+            diff = core - nb[r + dy:r + dy + height, r + dx:DETAIL_WIDTH - r + dx]
+            blocks = diff[:rows, :cols].reshape(rows // k, k, cols // k, k).mean(axis=(1, 3))
+            worst = float(np.abs(blocks).max())
+            best = worst if best is None else min(best, worst)
+    return best
+
+
+def _text_hash(texts: Sequence[str]) -> str:
+    normalized = "\f".join(" ".join(re.findall(r"\S+", t.lower())) for t in texts)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def fingerprint_bytes(
+    content: bytes, suffix: str, max_pages: int = 5, text_min_words: Optional[int] = 30
+) -> Optional[Fingerprint]:
+    """Fingerprint a PDF or image file's bytes (blocking; run in a thread).
+
+    PDFs whose pages all have a text layer (`text_min_words` words or more; None = never)
+    get a text fingerprint, other PDFs are rendered at HASH_RENDER_DPI. Returns None for
+    files that cannot be read.
+    """
+    try:
+        if suffix.lower() == ".pdf":
+            doc = fitz.open(stream=content, filetype="pdf")
+            try:
+                pages = [doc[i] for i in range(min(len(doc), max_pages))]
+                if not pages:
+                    return None
+                texts = [page.get_text() for page in pages]
+                if text_min_words is not None and all(len(t.split()) >= text_min_words for t in texts):
+                    return Fingerprint(kind="text", text_hash=_text_hash(texts))
+                signatures = []
+                for page in pages:
+                    pix = page.get_pixmap(dpi=HASH_RENDER_DPI, colorspace=fitz.csGRAY)
+                    signatures.append(page_signature(Image.frombytes("L", (pix.width, pix.height), pix.samples)))
+                return Fingerprint(kind="image", pages=signatures)
+            finally:
+                doc.close()
+        with Image.open(io.BytesIO(content)) as img:
+            img.draft("L", (1600, 1600))  # JPEG: decode at reduced size
+            return Fingerprint(kind="image", pages=[page_signature(ImageOps.exif_transpose(img))])
+    except Exception:
+        return None
+
+
+@dataclass
+class DuplicateMatch:
+    """An earlier extraction of the same invoice."""
+    value: str  # serialized InvoiceData
+    filename: str
+    distance: int  # summed pHash bits over pages (0 for identical text layers)
+    detail_diff: float = 0.0
+
+
+class DuplicateIndex:
+    """Nearest-neighbour index of fingerprints with the extraction result of each."""
+
+    def __init__(
+        self,
+        db_path: Path,
+        max_entries: int = 5000,
+        phash_max_distance: int = 10,
+        dhash_max_distance: int = 20,
+        detail_max_diff: float = 1.8,
+    ):
+        self.db_path = Path(db_path)
+        self.max_entries = max_entries
+        self.phash_max_distance = phash_max_distance
+        self.dhash_max_distance = dhash_max_distance
+        self.detail_max_diff = detail_max_diff
+
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = {"lookups": 0, "hits": 0, "text_hits": 0, "image_hits": 0, "rejected": 0}
+        # In-memory index of image entries (first page hashes) and text entries
+        self._ids: List[int] = []
+        self._params: List[str] = []
+        self._phash: List[int] = []
+        self._dhash: List[int] = []
+        self._arrays: Optional[tuple] = None
+        self._text: Dict[tuple, int] = {}
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS near_duplicates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                params TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                text_hash TEXT,
+                hashes TEXT NOT NULL,
+                details BLOB,
+                filename TEXT NOT NULL,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+        self._load()
+
+    @classmethod
+    def from_settings(cls) -> "DuplicateIndex":
+        return cls(
+            db_path=Path(settings.dedup_path),
+            max_entries=settings.dedup_max_entries,
+            phash_max_distance=settings.dedup_phash_max_distance,
+            dhash_max_distance=settings.dedup_dhash_max_distance,
+            detail_max_diff=settings.dedup_detail_max_diff,
+        )
+
+    def _load(self) -> None:
+        self._ids, self._params, self._phash, self._dhash = [], [], [], []
+        self._text = {}
+        self._arrays = None
+        for entry_id, params, kind, text_hash, hashes in self._conn.execute(
+            "SELECT id, params, kind, text_hash, hashes FROM near_duplicates ORDER BY id"
+        ):
+            self._index(entry_id, params, kind, text_hash, json.loads(hashes))
+
+    def _index(self, entry_id: int, params: str, kind: str, text_hash: Optional[str], hashes: List[List[str]]) -> None:
+        if kind == "text":
+            self._text[(params, text_hash)] = entry_id
+            return
+        self._ids.append(entry_id)
+        self._params.append(params)
+        self._phash.append(int(hashes[0][0], 16))
+        self._dhash.append(int(hashes[0][1], 16))
+        self._arrays = None
+
+    def same(self, a: Fingerprint, b: Fingerprint) -> Optional[DuplicateMatch]:
+        """Compare two fingerprints directly (within a batch or an order); the match
+        carries no stored value or filename."""
+        if a.kind != b.kind:
+            return None
+        if a.kind == "text":
+            return DuplicateMatch(value="", filename="", distance=0) if a.text_hash == b.text_hash else None
+        return self._same_pages(a.pages, b.pages)
+
+    def _same_pages(self, a: Sequence[PageSignature], b: Sequence[PageSignature]) -> Optional[DuplicateMatch]:
+        if len(a) != len(b):
+            return None
+        distance, worst = 0, 0.0
+        for pa, pb in zip(a, b):
+            d = hamming(pa.phash, pb.phash)
+            if d > self.phash_max_distance or hamming(pa.dhash, pb.dhash) > self.dhash_max_distance:
+                return None
+            diff = detail_distance(pa.detail, pb.detail)
+            if diff is None or diff > self.detail_max_diff:
+                return None
+            distance, worst = distance + d, max(worst, diff)
+        return DuplicateMatch(value="", filename="", distance=distance, detail_diff=worst)
+
+    def find(self, fingerprint: Fingerprint, params: str) -> Optional[DuplicateMatch]:
+        """Closest earlier extraction of the same invoice under the same parameters."""
+        with self._lock:
+            self._stats["lookups"] += 1
+            if fingerprint.kind == "text":
+                entry_id = self._text.get((params, fingerprint.text_hash))
+                if entry_id is None:
+                    return None
+                row = self._conn.execute(
+                    "SELECT filename, value FROM near_duplicates WHERE id = ?", (entry_id,)
+                ).fetchone()
+                if row is None:
+                    return None
+                self._stats["hits"] += 1
+                self._stats["text_hits"] += 1
+                return DuplicateMatch(value=row[1], filename=row[0], distance=0)
+
+            if not self._ids or not fingerprint.pages:
+                return None
+            if self._arrays is None:
+                self._arrays = (np.array(self._phash, dtype=np.uint64), np.array(self._dhash, dtype=np.uint64))
+            phashes, dhashes = self._arrays
+            first = fingerprint.pages[0]
+            p_dist = _hamming_many(phashes, first.phash)
+            d_dist = _hamming_many(dhashes, first.dhash)
+            candidates = np.flatnonzero((p_dist <= self.phash_max_distance) & (d_dist <= self.dhash_max_distance))
+            checked = 0
+            for i in candidates[np.argsort(p_dist[candidates], kind="stable")]:
+                if self._params[i] != params:
+                    continue
+                if checked >= MAX_VERIFY:
+                    break
+                checked += 1
+                row = self._conn.execute(
+                    "SELECT hashes, details, filename, value FROM near_duplicates WHERE id = ?", (self._ids[i],)
+                ).fetchone()
+                if row is None:
+                    continue
+                match = self._same_pages(fingerprint.pages, self._signatures(row[0], row[1]))
+                if match is None:
+                    self._stats["rejected"] += 1
+                    continue
+                self._stats["hits"] += 1
+                self._stats["image_hits"] += 1
+                match.filename, match.value = row[2], row[3]
+                return match
+            return None
+
+    @staticmethod
+    def _signatures(hashes: str, details: bytes) -> List[PageSignature]:
+        arrays = np.load(io.BytesIO(details), allow_pickle=False)
+        return [
+            PageSignature(phash=int(p, 16), dhash=int(d, 16), detail=arrays[f"p{i}"])
+            for i, (p, d) in enumerate(json.loads(hashes))
+        ]
+
+    def add(self, fingerprint: Fingerprint, params: str, filename: str, value: str) -> None:
+        """Remember an extraction result; the oldest entries go past max_entries."""
+        hashes = [[f"{p.phash:016x}", f"{p.dhash:016x}"] for p in fingerprint.pages]
+        details: Optional[bytes] = None
+        if fingerprint.pages:
+            buf = io.BytesIO()
+            np.savez_compressed(buf, **{f"p{i}": p.detail for i, p in enumerate(fingerprint.pages)})
+            details = buf.getvalue()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO near_duplicates (params, kind, text_hash, hashes, details, filename, value, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (params, fingerprint.kind, fingerprint.text_hash, json.dumps(hashes), details, filename, value, time.time()),
+            )
+            self._index(cur.lastrowid, params, fingerprint.kind, fingerprint.text_hash, hashes)
+            count = len(self._ids) + len(self._text)
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM near_duplicates WHERE id IN (SELECT id FROM near_duplicates ORDER BY id LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+                self._load()
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "entries": len(self._ids) + len(self._text)}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM near_duplicates")
+            self._conn.commit()
+            self._load()
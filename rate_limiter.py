@@ -0,0 +1,232 @@
+"""Process-wide rate limiter and retry policy for Claude calls.
+
+Three token buckets mirror Anthropic's per-minute limits:
+- requests per minute
+- input tokens per minute
+- output tokens per minute
+
+Callers reserve an estimate before each request and settle with the real usage
+afterwards. 429/529 responses pause every caller until `retry-after` has passed,
+then the request is retried with jittered exponential backoff.
+
+State is guarded by a threading lock and waits use asyncio.sleep, so one limiter is
+shared by every event loop in the process (API loop + the sync background loop).
+"""
+import asyncio
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import anthropic
+
+from config import settings
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class _Bucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount: float) -> float:
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+
+class RateLimiter:
+    """Token-bucket limiter (RPM, input TPM, output TPM) with 429-aware retries."""
+
+    def __init__(
+        self,
+        requests_per_minute: int,
+        input_tokens_per_minute: int,
+        output_tokens_per_minute: int,
+        max_retries: int = 6,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, _Bucket] = {
+            "requests": _Bucket(requests_per_minute),
+            "input_tokens": _Bucket(input_tokens_per_minute),
+            "output_tokens": _Bucket(output_tokens_per_minute),
+        }
+        self._blocked_until = 0.0
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._stats: Dict[str, float] = {
+            "calls": 0,
+            "throttled_calls": 0,
+            "queue_wait_total": 0.0,
+            "model_latency_total": 0.0,
+            "retries": 0,
+            "rate_limited": 0,
+            "overloaded": 0,
+        }
+
+    @classmethod
+    def from_settings(cls) -> "RateLimiter":
+        return cls(
+            requests_per_minute=settings.rate_limit_rpm,
+            input_tokens_per_minute=settings.rate_limit_input_tpm,
+            output_tokens_per_minute=settings.rate_limit_output_tpm,
+            max_retries=settings.rate_limit_max_retries,
+            backoff_base=settings.rate_limit_backoff_base,
+            backoff_max=settings.rate_limit_backoff_max,
+        )
+
+    async def acquire(self, input_tokens: int, output_tokens: int) -> float:
+        """Wait until the budget allows one request of this size; returns seconds waited."""
+        need = {"requests": 1.0, "input_tokens": float(input_tokens), "output_tokens": float(output_tokens)}
+        start = time.monotonic()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = max(0.0, self._blocked_until - now)
+                if wait == 0.0:
+                    for name, bucket in self._buckets.items():
+                        bucket.refill(now)
+                        wait = max(wait, bucket.wait_for(need[name]))
+                if wait == 0.0:
+                    for name, bucket in self._buckets.items():
+                        bucket.level -= min(need[name], bucket.capacity)
+                    return time.monotonic() - start
+            await asyncio.sleep(min(wait, 1.0) + random.uniform(0, 0.05))
+
+    def settle(self, reserved_input: int, reserved_output: int, actual_input: int, actual_output: int) -> None:
+        """Correct the token buckets with the usage reported by the API."""
+        with self._lock:
+            now = time.monotonic()
+            for name, reserved, actual in (
+                ("input_tokens", reserved_input, actual_input),
+                ("output_tokens", reserved_output, actual_output),
+            ):
+                bucket = self._buckets[name]
+                bucket.refill(now)
+                bucket.level = min(bucket.capacity, bucket.level + reserved - actual)
+
+    def _pause(self, seconds: float) -> None:
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+    def _backoff(self, attempt: int) -> float:
+        # "Equal jitter": half fixed, half random, capped
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def _retry_after(error: Exception) -> Optional[float]:
+        response = getattr(error, "response", None)
+        if response is None:
+            return None
+        value = response.headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return None
+
+    async def call(
+        self,
+        make_request: Callable[[], Awaitable[Any]],
+        input_tokens: int,
+        output_tokens: int,
+    ) -> Tuple[Any, Dict[str, float]]:
+        """
+        Run `make_request` under the limiter with retries.
+
+        Returns:
+            (response, timing) where timing has queue_wait (limiter + backoff sleeps),
+            model_latency (time inside API calls) and retries
+        """
+        queue_wait = 0.0
+        model_latency = 0.0
+        attempt = 0
+        throttled = False
+        while True:
+            waited = await self.acquire(input_tokens, output_tokens)
+            queue_wait += waited
+            throttled = throttled or waited > 0.01
+            t0 = time.monotonic()
+            try:
+                response = await make_request()
+            except (anthropic.APIStatusError, anthropic.APIConnectionError) as e:
+                model_latency += time.monotonic() - t0
+                status = getattr(e, "status_code", None)
+                retryable = isinstance(e, anthropic.APIConnectionError) or status in RETRYABLE_STATUS
+                # Failed attempts keep their request slot but give the tokens back
+                self.settle(input_tokens, output_tokens, 0, 0)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                retry_after = self._retry_after(e)
+                with self._lock:
+                    self._stats["retries"] += 1
+                    if status == 429:
+                        self._stats["rate_limited"] += 1
+                    elif status == 529:
+                        self._stats["overloaded"] += 1
+                if status in (429, 529):
+                    # Server says we are over budget: hold back every caller, not just this one
+                    self._pause(max(delay, retry_after or 0.0))
+                    delay = 0.0
+                elif retry_after is not None:
+                    delay = max(delay, retry_after)
+                attempt += 1
+                t_sleep = time.monotonic()
+                await asyncio.sleep(delay)
+                queue_wait += time.monotonic() - t_sleep
+                continue
+
+            model_latency += time.monotonic() - t0
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                self.settle(
+                    input_tokens,
+                    output_tokens,
+                    getattr(usage, "input_tokens", 0) or 0,
+                    getattr(usage, "output_tokens", 0) or 0,
+                )
+            with self._lock:
+                self._stats["calls"] += 1
+                self._stats["throttled_calls"] += 1 if throttled else 0
+                self._stats["queue_wait_total"] += queue_wait
+                self._stats["model_latency_total"] += model_latency
+            return response, {"queue_wait": queue_wait, "model_latency": model_latency, "retries": attempt}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            levels = {name: round(b.level, 1) for name, b in self._buckets.items()}
+        calls = stats["calls"] or 1
+        stats["avg_queue_wait"] = stats["queue_wait_total"] / calls
+        stats["avg_model_latency"] = stats["model_latency_total"] / calls
+        stats["bucket_levels"] = levels
+        return stats
+
+
+_limiter: Optional[RateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> Optional[RateLimiter]:
+    """Process-wide limiter (None when RATE_LIMIT_ENABLED is false)."""
+    global _limiter
+    if not settings.rate_limit_enabled:
+        return None
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter.from_settings()
+        return _limiter
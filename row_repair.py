@@ -0,0 +1,244 @@
+"""Row-level repair of line items that fail quantity × unit_price = total.
+
+When only a few rows of an invoice are wrong, re-running the whole page is wasteful.
+The repair pass instead:
+- finds the failing rows (numbers present, arithmetic off, no decimal-scale fix)
+- locates each row on the page, from the PyMuPDF text layer (born-digital PDFs) or
+  from DocAI line-item bounding boxes (hybrid mode, scans and photos)
+- crops just those bands (plus the table header when it can be found) at a higher
+  resolution than the full-page render, for one batched Claude re-read
+
+Regions use page-relative 0..1 coordinates so both sources crop the same way.
+"""
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import fitz  # PyMuPDF
+
+from invoice_source import InvoiceSource, open_pdf
+from models import InvoiceItem
+
+Box = Tuple[float, float, float, float]
+
+MATCH_THRESHOLD = 0.6
+HEADER_WORDS = {
+    "description", "item", "qty", "quantity", "unit", "uom", "rate", "price",
+    "amount", "total", "vat", "net",
+}
+# Vertical padding around a row, in row heights (keeps descenders and wrapped text)
+ROW_PADDING = 0.6
+HORIZONTAL_MARGIN = 0.01
+WRAPPED_PENALTY = 0.35
+
+
+@dataclass
+class RowRegion:
+    """Where one failing item sits on the page."""
+    page_index: int
+    box: Box
+    header_box: Optional[Box] = None
+    source: str = "text_layer"  # "text_layer" | "docai"
+    text: Optional[str] = None  # the row's text-layer words, a hint for the re-read
+
+
+def scale_fix(q: float, p: float, t: float) -> Optional[Tuple[float, float]]:
+    """(quantity, unit_price) with one of them scaled by 10/100 so the math holds, if any."""
+    for s in (0.1, 0.01, 10.0, 100.0):
+        for q2, p2 in ((q * s, p), (q, p * s)):
+            if abs((q2 * p2) - t) <= 0.01:
+                return q2, p2
+    return None
+
+
+def is_consistent(item: InvoiceItem) -> bool:
+    if item.quantity is None or item.unit_price is None or item.total is None:
+        return False
+    return abs((item.quantity * item.unit_price) - item.total) <= 0.01
+
+
+def failing_rows(items: Sequence[InvoiceItem]) -> List[int]:
+    """Indexes of items whose numbers are all present but fail the check outright."""
+    failing = []
+    for i, it in enumerate(items):
+        if it.quantity is None or it.unit_price is None or it.total is None or is_consistent(it):
+            continue
+        if scale_fix(float(it.quantity), float(it.unit_price), float(it.total)) is None:
+            failing.append(i)
+    return failing
+
+
+def _tokens(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]{2,}", (text or "").lower())
+
+
+def _numbers(text: str) -> List[float]:
+    values = []
+    for raw in re.findall(r"\d[\d,]*(?:\.\d+)?", text or ""):
+        try:
+            values.append(float(raw.replace(",", "")))
+        except ValueError:
+            continue
+    return values
+
+
+def _match_score(item: InvoiceItem, text: str) -> float:
+    """Share of the item's description tokens found in `text`, plus a bonus per number
+    (quantity, unit price, total) that also appears there; tells repeated products apart."""
+    desc = set(_tokens(item.description))
+    if not desc:
+        return 0.0
+    score = len(desc & set(_tokens(text))) / len(desc)
+    numbers = _numbers(text)
+    for value in (item.quantity, item.unit_price, item.total):
+        if value is not None and any(abs(v - value) <= 0.01 for v in numbers):
+            score += 0.1
+    return score
+
+
+def _pad(box: Box, row_height: float) -> Box:
+    x0, y0, x1, y1 = box
+    pad = row_height * ROW_PADDING
+    return (
+        max(0.0, x0 - HORIZONTAL_MARGIN),
+        max(0.0, y0 - pad),
+        min(1.0, x1 + HORIZONTAL_MARGIN),
+        min(1.0, y1 + pad),
+    )
+
+
+def _assign(scores: List[Tuple[float, int, int]]) -> Dict[int, int]:
+    """Greedy best-first item -> candidate assignment; each candidate used once."""
+    pairs: Dict[int, int] = {}
+    used = set()
+    for score, item_idx, cand_idx in sorted(scores, reverse=True):
+        if score < MATCH_THRESHOLD or item_idx in pairs or cand_idx in used:
+            continue
+        pairs[item_idx] = cand_idx
+        used.add(cand_idx)
+    return pairs
+
+
+def _page_rows(page: Any) -> List[Dict[str, Any]]:
+    """Text-layer words grouped into visual rows: {"text", "box" (normalized)}."""
+    words = page.get_text("words")
+    if not words:
+        return []
+    width, height = page.rect.width or 1.0, page.rect.height or 1.0
+    heights = sorted(w[3] - w[1] for w in words)
+    line_height = heights[len(heights) // 2] or 1.0
+
+    rows: List[List[Any]] = []
+    mids: List[float] = []
+    for w in sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        mid = (w[1] + w[3]) / 2
+        if mids and abs(mid - mids[-1]) <= line_height * 0.5:
+            rows[-1].append(w)
+        else:
+            rows.append([w])
+            mids.append(mid)
+
+    out = []
+    for row in rows:
+        row.sort(key=lambda w: w[0])
+        out.append({
+            "text": " ".join(w[4] for w in row),
+            "box": (
+                min(w[0] for w in row) / width,
+                min(w[1] for w in row) / height,
+                max(w[2] for w in row) / width,
+                max(w[3] for w in row) / height,
+            ),
+        })
+    return out
+
+
+def _is_header(text: str) -> bool:
+    return len(set(_tokens(text)) & HEADER_WORDS) >= 2
+
+
+def _union(a: Box, b: Box) -> Box:
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def locate_in_text_layer(
+    file_path: InvoiceSource, items: Sequence[InvoiceItem], indexes: Sequence[int], max_pages: int
+) -> Dict[int, RowRegion]:
+    """Match failing items to visual text-layer rows of a PDF (blocking; run in a thread)."""
+    if file_path.suffix.lower() != ".pdf":
+        return {}
+    candidates: List[Tuple[int, int, Dict[str, Any]]] = []  # (page, row index on page, row)
+    page_rows: List[List[Dict[str, Any]]] = []
+    doc = open_pdf(file_path)
+    try:
+        for page_index in range(min(len(doc), max_pages)):
+            rows = _page_rows(doc[page_index])
+            page_rows.append(rows)
+            for i, row in enumerate(rows):
+                candidates.append((page_index, i, row))
+                if i + 1 < len(rows):
+                    # Descriptions that wrap onto a second line
+                    nxt = rows[i + 1]
+                    candidates.append((page_index, i, {
+                        "text": f"{row['text']} {nxt['text']}",
+                        "box": _union(row["box"], nxt["box"]),
+                        "wrapped": True,
+                    }))
+    finally:
+        doc.close()
+
+    scores = [
+        # A two-line candidate must cover clearly more of the description than a single
+        # row; the penalty outweighs coincidental number matches from the extra line
+        (_match_score(items[idx], row["text"]) - (WRAPPED_PENALTY if row.get("wrapped") else 0.0), idx, ci)
+        for idx in indexes
+        for ci, (_, _, row) in enumerate(candidates)
+    ]
+    regions: Dict[int, RowRegion] = {}
+    for idx, ci in _assign(scores).items():
+        page_index, row_index, row = candidates[ci]
+        header = next(
+            (r for r in reversed(page_rows[page_index][:row_index]) if _is_header(r["text"])),
+            None,
+        )
+        box, header_box = row["box"], None
+        row_height = page_rows[page_index][row_index]["box"][3] - page_rows[page_index][row_index]["box"][1]
+        if header is not None:
+            # Same horizontal extent for both crops so the columns line up
+            x0, x1 = min(box[0], header["box"][0]), max(box[2], header["box"][2])
+            box = (x0, box[1], x1, box[3])
+            header_box = _pad((x0, header["box"][1], x1, header["box"][3]), row_height)
+        regions[idx] = RowRegion(
+            page_index=page_index,
+            box=_pad(box, row_height),
+            header_box=header_box,
+            source="text_layer",
+            text=row["text"],
+        )
+    return regions
+
+
+def locate_in_docai(
+    docai_rows: Sequence[Dict[str, Any]],
+    boxes: Sequence[Optional[Dict[str, Any]]],
+    items: Sequence[InvoiceItem],
+    indexes: Sequence[int],
+) -> Dict[int, RowRegion]:
+    """Match failing items to DocAI line items that carry a bounding box."""
+    scores = []
+    for ci, (row, anchor) in enumerate(zip(docai_rows, boxes)):
+        if anchor is None:
+            continue
+        text = " ".join(str(row.get(k) or "") for k in ("raw_text", "description", "total"))
+        scores.extend((_match_score(items[idx], text), idx, ci) for idx in indexes)
+
+    regions: Dict[int, RowRegion] = {}
+    for idx, ci in _assign(scores).items():
+        x0, y0, x1, y1 = boxes[ci]["box"]
+        # DocAI boxes hug the row text; pad with a typical row height instead
+        regions[idx] = RowRegion(
+            page_index=boxes[ci]["page"],
+            box=_pad((x0, y0, x1, y1), min(y1 - y0, 0.02)),
+            source="docai",
+        )
+    return regions
@@ -0,0 +1,101 @@
+"""Incremental JSON parsing for streamed Claude replies.
+
+Claude streams an extraction reply a few characters at a time. IncrementalItemParser
+scans the growing text once (string/escape/depth state is kept between chunks) and
+returns each element of the top-level items array as soon as that element closes, so
+line items can be shown long before the reply is complete. For compact replies it also
+captures the column header ("c") so streamed rows are mapped in the order the model
+actually used.
+"""
+import json
+from typing import Any, List, Optional
+
+
+class IncrementalItemParser:
+    """Emit elements of `{"<array_key>": [ ... ]}` while the JSON text is still arriving.
+
+    Works for regular replies ("items": objects), compact replies ("i": arrays) and
+    streamed tool input; code fences or text before the JSON object are ignored. With
+    `header_key`, the root-level array under that key is parsed into `header` as soon
+    as it closes.
+    """
+
+    def __init__(self, array_key: str = "items", header_key: Optional[str] = None):
+        self.array_key = array_key
+        self.header_key = header_key
+        self.header: Optional[List[Any]] = None
+        self._header_start: Optional[int] = None
+        self.text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._str_start = 0
+        self._last_key: Optional[str] = None  # last string seen directly inside the root object
+        self._array_depth: Optional[int] = None  # depth of the items array's elements
+        self._elem_start: Optional[int] = None
+        self.finished = False  # items array closed
+        self.emitted = 0
+
+    def feed(self, chunk: str) -> List[Any]:
+        """Add streamed text; return the array elements completed by it (parsed JSON)."""
+        self.text += chunk
+        text = self.text
+        out: List[Any] = []
+        i = self._pos
+        while i < len(text):
+            c = text[i]
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif c == "\\":
+                    self._esc = True
+                elif c == "\"":
+                    self._in_str = False
+                    if self._depth == 1:
+                        self._last_key = text[self._str_start + 1 : i]
+            elif c == "\"":
+                self._in_str = True
+                self._str_start = i
+            elif c in "{[":
+                if (
+                    c == "["
+                    and not self.finished
+                    and self._array_depth is None
+                    and self._depth == 1
+                    and self._last_key == self.array_key
+                ):
+                    self._array_depth = self._depth + 1
+                elif (
+                    c == "["
+                    and self.header_key is not None
+                    and self.header is None
+                    and self._depth == 1
+                    and self._last_key == self.header_key
+                ):
+                    self._header_start = i
+                elif self._array_depth is not None and self._depth == self._array_depth:
+                    self._elem_start = i
+                self._depth += 1
+            elif c in "}]":
+                self._depth -= 1
+                if self._header_start is not None and self._depth == 1:
+                    try:
+                        self.header = json.loads(text[self._header_start : i + 1])
+                    except ValueError:
+                        pass  # malformed header; rows fall back to the default columns
+                    self._header_start = None
+                if self._array_depth is not None:
+                    if self._elem_start is not None and self._depth == self._array_depth:
+                        try:
+                            out.append(json.loads(text[self._elem_start : i + 1]))
+                        except ValueError:
+                            pass  # malformed element; the final parse decides
+                        self._elem_start = None
+                    elif self._depth == self._array_depth - 1:
+                        self._array_depth = None
+                        self.finished = True
+            i += 1
+        self._pos = i
+        self.emitted += len(out)
+        return out
@@ -0,0 +1,135 @@
+"""Tool-use structured output for Claude calls.
+
+In "tool" mode every extraction / cleaning call forces Claude to answer through a tool
+whose input_schema is derived from the pydantic models. The API then returns the
+arguments as already-parsed JSON, so there are no code fences, preambles or half-closed
+objects to scan for, and far fewer replies that fail to parse.
+"""
+import copy
+from functools import lru_cache
+from typing import Any, Dict
+
+from models import InvoiceData, InvoiceItem
+
+OUTPUT_MODES = ("json", "tool", "compact")
+
+INVOICE_TOOL = "record_invoice"
+INVOICE_BATCH_TOOL = "record_invoices"
+CLEANED_ITEM_TOOL = "record_cleaned_item"
+CLEANED_ITEMS_BATCH_TOOL = "record_cleaned_items_batch"
+CLEANED_ITEMS_TOOL = "record_cleaned_items"
+
+
+def _inline_refs(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """Resolve local `#/$defs/...` references and drop titles (smaller tool definitions)."""
+    defs = schema.get("$defs", {})
+
+    def resolve(node: Any) -> Any:
+        if isinstance(node, dict):
+            ref = node.get("$ref")
+            if isinstance(ref, str) and ref.startswith("#/$defs/"):
+                return resolve(copy.deepcopy(defs[ref[len("#/$defs/"):]]))
+            return {k: resolve(v) for k, v in node.items() if k not in ("$defs", "title")}
+        if isinstance(node, list):
+            return [resolve(v) for v in node]
+        return node
+
+    return resolve(schema)
+
+
+def _tool(name: str, description: str, input_schema: Dict[str, Any]) -> Dict[str, Any]:
+    return {"name": name, "description": description, "input_schema": input_schema}
+
+
+def _cleaned_item_schema(with_id: bool) -> Dict[str, Any]:
+    """InvoiceItem without item_number, plus `skip` (and the stable `id` for batches)."""
+    schema = _inline_refs(InvoiceItem.model_json_schema())
+    schema["properties"].pop("item_number", None)
+    schema["properties"]["skip"] = {
+        "type": "boolean",
+        "description": "true when the row has no real product description",
+    }
+    schema["required"] = []
+    if with_id:
+        schema["properties"] = {
+            "id": {"type": "string", "description": "Same id as the input item"},
+            **schema["properties"],
+        }
+        schema["required"] = ["id"]
+    return schema
+
+
+@lru_cache(maxsize=None)
+def invoice_tool() -> Dict[str, Any]:
+    return _tool(
+        INVOICE_TOOL,
+        "Record the invoice metadata, ALL line items and the financial totals.",
+        _inline_refs(InvoiceData.model_json_schema()),
+    )
+
+
+@lru_cache(maxsize=None)
+def invoice_batch_tool() -> Dict[str, Any]:
+    """Several invoices from one micro-batched request, each tagged with its input key."""
+    invoice = _inline_refs(InvoiceData.model_json_schema())
+    invoice["properties"] = {
+        "key": {"type": "string", "description": "Key printed before the invoice image"},
+        **invoice["properties"],
+    }
+    invoice["required"] = ["key", *invoice.get("required", [])]
+    return _tool(
+        INVOICE_BATCH_TOOL,
+        "Record every invoice separately: metadata, ALL line items and totals, keyed by its input key.",
+        {
+            "type": "object",
+            "properties": {"invoices": {"type": "array", "items": invoice}},
+            "required": ["invoices"],
+        },
+    )
+
+
+@lru_cache(maxsize=None)
+def cleaned_item_tool() -> Dict[str, Any]:
+    return _tool(
+        CLEANED_ITEM_TOOL,
+        "Record one cleaned DocAI line item, or skip=true.",
+        _cleaned_item_schema(with_id=False),
+    )
+
+
+@lru_cache(maxsize=None)
+def cleaned_items_batch_tool() -> Dict[str, Any]:
+    return _tool(
+        CLEANED_ITEMS_BATCH_TOOL,
+        "Record exactly one cleaned result (or skip) per input id.",
+        {
+            "type": "object",
+            "properties": {"results": {"type": "array", "items": _cleaned_item_schema(with_id=True)}},
+            "required": ["results"],
+        },
+    )
+
+
+@lru_cache(maxsize=None)
+def cleaned_items_tool() -> Dict[str, Any]:
+    return _tool(
+        CLEANED_ITEMS_TOOL,
+        "Record the cleaned line items (skipped items are omitted).",
+        {
+            "type": "object",
+            "properties": {"items": {"type": "array", "items": _cleaned_item_schema(with_id=False)}},
+            "required": ["items"],
+        },
+    )
+
+
+def tool_input(message: Any, tool_name: str) -> Dict[str, Any]:
+    """Arguments of the forced tool call; ValueError if the reply has none (e.g. truncated)."""
+    for block in message.content:
+        if getattr(block, "type", None) == "tool_use" and getattr(block, "name", None) == tool_name:
+            if not isinstance(block.input, dict):
+                raise ValueError(f"{tool_name} input is not an object")
+            return block.input
+    raise ValueError(
+        f"No {tool_name} tool call in reply (stop_reason={getattr(message, 'stop_reason', None)})"
+    )
@@ -0,0 +1,106 @@
+"""AdmissionController: per-client round-robin, cancellation and queue bounds."""
+import asyncio
+
+import pytest
+
+import admission
+from admission import AdmissionController, QueueFull
+
+
+async def _queue(controller, client, order):
+    await controller.acquire(client)
+    order.append(client)
+
+
+def test_freed_slots_go_round_robin_across_clients():
+    controller = AdmissionController(max_in_flight=1, max_queue=10)
+    order = []
+
+    async def run():
+        await controller.acquire("holder")
+        waiters = [asyncio.ensure_future(_queue(controller, "a", order)) for _ in range(3)]
+        waiters.append(asyncio.ensure_future(_queue(controller, "b", order)))
+        await asyncio.sleep(0)
+        assert controller.stats()["queue_depth_by_client"] == {"a": 3, "b": 1}
+        for _ in range(4):
+            controller.release(0.1)
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*waiters)
+
+    asyncio.run(run())
+    # "a" queued three before "b" arrived, yet "b" is served second
+    assert order == ["a", "b", "a", "a"]
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    controller = AdmissionController(max_in_flight=1, max_queue=10)
+    order = []
+
+    async def run():
+        await controller.acquire("holder")
+        cancelled = asyncio.ensure_future(controller.acquire("a"))
+        waiting = asyncio.ensure_future(_queue(controller, "b", order))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert controller.stats()["queue_depth"] == 1
+        controller.release(0.1)
+        await waiting
+
+    asyncio.run(run())
+    assert order == ["b"]
+    assert controller.stats()["in_flight"] == 1
+
+
+def test_slot_granted_to_a_cancelled_waiter_is_passed_on():
+    controller = AdmissionController(max_in_flight=1, max_queue=10)
+    order = []
+
+    async def run():
+        await controller.acquire("holder")
+        cancelled = asyncio.ensure_future(controller.acquire("a"))
+        waiting = asyncio.ensure_future(_queue(controller, "b", order))
+        await asyncio.sleep(0)
+        controller.release(0.1)  # "a" is granted the slot ...
+        cancelled.cancel()  # ... but is cancelled before it runs
+        await waiting
+
+    asyncio.run(run())
+    assert order == ["b"]
+    assert controller.stats()["in_flight"] == 1
+
+
+def test_check_rejects_when_the_queue_is_full():
+    controller = AdmissionController(max_in_flight=1, max_queue=2)
+
+    async def run():
+        await controller.acquire("holder")
+        waiters = [asyncio.ensure_future(controller.acquire("a"))]
+        await asyncio.sleep(0)
+        controller.check()
+        waiters.append(asyncio.ensure_future(controller.acquire("a")))
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull) as excinfo:
+            controller.check()
+        assert excinfo.value.queue_depth == 2 and excinfo.value.retry_after >= 1
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+
+    asyncio.run(run())
+    assert controller.stats()["rejected"] == 1
+
+
+def test_acquire_slot_is_reentrant(monkeypatch):
+    controller = AdmissionController(max_in_flight=1, max_queue=10)
+    monkeypatch.setattr(admission, "get_admission", lambda: controller)
+
+    async def run():
+        async with admission.extraction_slot():
+            # A fallback inside a held slot (e.g. a micro-batch retry) must not deadlock
+            inner = await asyncio.wait_for(admission.acquire_slot(), timeout=1)
+            inner.release()
+            assert controller.stats()["in_flight"] == 1
+        assert controller.stats()["in_flight"] == 0
+
+    asyncio.run(run())
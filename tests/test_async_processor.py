@@ -0,0 +1,150 @@
+"""Async InvoiceProcessor: concurrent pages, concurrent invoices, sync wrappers in threads."""
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import fitz
+import pytest
+from PIL import Image
+
+import anthropic_client
+from config import settings
+from invoice_processor import InvoiceProcessor
+
+
+class _Messages:
+    """Stands in for AsyncAnthropic().messages; tracks how many calls overlap."""
+
+    def __init__(self, delay: float = 0.1, error: Exception = None):
+        self.delay = delay
+        self.error = error
+        self.active = 0
+        self.peak = 0
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    async def create(self, **kwargs):
+        with self._lock:
+            self.calls += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            n = self.calls
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            with self._lock:
+                self.active -= 1
+        if self.error is not None:
+            raise self.error
+        text = json.dumps({
+            "invoice_number": "INV-1",
+            "vendor_name": "ACME Foods",
+            "items": [{"item_number": 1, "description": f"Item {n}", "quantity": 2, "unit_price": 3.5,
+                       "total": 7.0, "unit": "kg", "llm_confidence": 9.5}],
+        })
+        return SimpleNamespace(
+            content=[SimpleNamespace(type="text", text=text)],
+            stop_reason="end_turn",
+            usage=SimpleNamespace(input_tokens=100, output_tokens=50),
+        )
+
+
+@pytest.fixture
+def processor(monkeypatch):
+    for name, value in {
+        "cache_enabled": False,
+        "dedup_enabled": False,
+        "vendor_profiles_enabled": False,
+        "microbatch_enabled": False,
+        "cascade_enabled": False,
+        "hybrid_docai_enabled": False,
+        "row_repair_enabled": False,
+        "text_layer_enabled": False,
+        "structured_output_mode": "json",
+    }.items():
+        monkeypatch.setattr(settings, name, value)
+    return InvoiceProcessor()
+
+
+def _install(processor, messages):
+    client = SimpleNamespace(messages=messages)
+    processor._async_client = lambda: client
+
+
+def _image(path):
+    Image.new("RGB", (400, 300), "white").save(path)
+    return path
+
+
+def _pdf(path, pages):
+    doc = fitz.open()
+    for i in range(pages):
+        doc.new_page().insert_text((50, 60), f"Page {i + 1}")
+    doc.save(path)
+    return path
+
+
+def test_pages_of_one_invoice_are_extracted_concurrently(processor, tmp_path):
+    messages = _Messages(delay=1.0)  # longer than rendering a page, so the calls overlap
+    _install(processor, messages)
+
+    result = asyncio.run(processor.aprocess_invoice(_pdf(tmp_path / "three.pdf", 3)))
+
+    assert result.success, result.error
+    assert messages.calls == 3 and messages.peak == 3
+    # One item per page, merged into one invoice
+    assert len(result.invoice_data.items) == 3
+
+
+def test_invoices_are_processed_concurrently(processor, tmp_path):
+    messages = _Messages()
+    _install(processor, messages)
+    files = [_image(tmp_path / f"{i}.png") for i in range(4)]
+
+    async def run():
+        return await asyncio.gather(*(processor.aprocess_invoice(f) for f in files))
+
+    results = asyncio.run(run())
+
+    assert all(r.success for r in results)
+    assert messages.peak == 4
+
+
+def test_sync_wrapper_from_worker_threads(processor, tmp_path):
+    messages = _Messages(delay=0.05)
+    _install(processor, messages)
+    files = [_image(tmp_path / f"{i}.png") for i in range(6)]
+
+    # Helper scripts call the sync API from thread pools; it shares one background loop
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        results = list(pool.map(processor.process_invoice, files))
+
+    assert [r.filename for r in results] == [f.name for f in files]
+    assert all(r.success for r in results)
+    assert messages.peak > 1
+
+
+def test_failed_calls_do_not_stay_in_flight(processor, tmp_path):
+    _install(processor, _Messages(delay=0.01, error=RuntimeError("connection reset")))
+    before = anthropic_client.pool_stats()
+
+    result = processor.process_invoice(_image(tmp_path / "a.png"))
+
+    after = anthropic_client.pool_stats()
+    assert not result.success
+    assert after["in_flight"] == before["in_flight"] == 0
+    assert after["errors"] > before["errors"]
+
+
+def test_run_sync_refuses_the_background_loop():
+    async def nested():
+        coro = asyncio.sleep(0)
+        try:
+            return anthropic_client.run_sync(coro)
+        finally:
+            coro.close()
+
+    with pytest.raises(RuntimeError, match="background loop"):
+        anthropic_client.run_sync(nested())
@@ -0,0 +1,108 @@
+"""aprocess_stream: one bad file must not fail the rest of the batch."""
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+from config import settings
+from invoice_processor import InvoiceProcessor
+
+INVOICE = {
+    "invoice_number": "INV-1",
+    "vendor_name": "ACME Foods",
+    "currency": "AED",
+    "items": [{"item_number": 1, "description": "Tomato", "quantity": 2, "unit_price": 3.5, "total": 7.0,
+               "unit": "kg", "llm_confidence": 9.5}],
+    "subtotal": 7.0,
+}
+
+
+class _Messages:
+    """Stands in for AsyncAnthropic().messages: answers single and micro-batch prompts."""
+
+    def __init__(self, fail_batches: bool = False):
+        self.fail_batches = fail_batches
+        self.calls = []
+
+    async def create(self, **kwargs):
+        self.calls.append(kwargs)
+        content = kwargs["messages"][0]["content"]
+        keys = [
+            block["text"][len("Invoice "):-1]
+            for block in content
+            if isinstance(block, dict) and block.get("type") == "text" and block["text"].startswith("Invoice inv")
+        ]
+        if keys:
+            if self.fail_batches:
+                raise RuntimeError("batch request failed")
+            text = json.dumps({"invoices": [dict(INVOICE, key=key) for key in keys]})
+        else:
+            text = json.dumps(INVOICE)
+        await asyncio.sleep(0)
+        return SimpleNamespace(
+            content=[SimpleNamespace(type="text", text=text)],
+            stop_reason="end_turn",
+            usage=SimpleNamespace(input_tokens=100, output_tokens=50),
+        )
+
+
+@pytest.fixture
+def processor(monkeypatch):
+    for name, value in {
+        "cache_enabled": False,
+        "dedup_enabled": False,
+        "vendor_profiles_enabled": False,
+        "microbatch_enabled": True,
+        "microbatch_max_images": 4,
+        "cascade_enabled": False,
+        "hybrid_docai_enabled": False,
+        "row_repair_enabled": False,
+        "structured_output_mode": "json",
+    }.items():
+        monkeypatch.setattr(settings, name, value)
+    return InvoiceProcessor()
+
+
+def _install(processor, messages):
+    client = SimpleNamespace(messages=messages)
+    processor._async_client = lambda: client
+
+
+def _image(path, color):
+    Image.new("RGB", (400, 300), color).save(path)
+    return path
+
+
+def test_corrupt_and_missing_files_fail_alone(processor, tmp_path):
+    _install(processor, _Messages())
+    bad_pdf = tmp_path / "bad.pdf"
+    bad_pdf.write_bytes(b"not a pdf")
+    files = [
+        _image(tmp_path / "a.png", "white"),
+        bad_pdf,
+        _image(tmp_path / "b.png", "gray"),
+        tmp_path / "missing.png",
+    ]
+
+    results = processor.process_invoices(files)
+
+    assert [r.filename for r in results] == ["a.png", "bad.pdf", "b.png", "missing.png"]
+    assert [r.success for r in results] == [True, False, True, False]
+    assert results[1].error and results[3].error
+    # The readable images still shared one Claude request
+    assert results[0].batch_size == 2 and results[2].batch_size == 2
+
+
+def test_failed_micro_batch_falls_back_to_single_invoices(processor, tmp_path):
+    messages = _Messages(fail_batches=True)
+    _install(processor, messages)
+    files = [_image(tmp_path / f"{i}.png", color) for i, color in enumerate(["white", "gray", "black"])]
+
+    results = processor.process_invoices(files)
+
+    assert all(r.success for r in results)
+    assert all(r.batch_size == 1 for r in results)
+    assert len(messages.calls) == 1 + len(files)
+    assert all(r.microbatch_error == "RuntimeError: batch request failed" for r in results)
@@ -0,0 +1,115 @@
+"""RateLimiter: token buckets, settle and 429/529-aware retries."""
+import asyncio
+from types import SimpleNamespace
+
+import anthropic
+import pytest
+
+from rate_limiter import RateLimiter
+
+
+def _status_error(cls, status: int, retry_after=None):
+    # Built without an HTTP response; the limiter only reads status_code and headers
+    error = cls.__new__(cls)
+    error.status_code = status
+    error.response = SimpleNamespace(headers={"retry-after": retry_after} if retry_after is not None else {})
+    return error
+
+
+def _limiter(**kwargs) -> RateLimiter:
+    params = dict(
+        requests_per_minute=600,
+        input_tokens_per_minute=60_000,
+        output_tokens_per_minute=60_000,
+        backoff_base=0.01,
+        backoff_max=0.02,
+    )
+    params.update(kwargs)
+    return RateLimiter(**params)
+
+
+def test_burst_up_to_capacity_then_waits():
+    limiter = _limiter(requests_per_minute=3)
+
+    async def run():
+        waits = [await limiter.acquire(10, 10) for _ in range(3)]
+        assert max(waits) < 0.01
+        assert limiter._buckets["requests"].wait_for(1) == pytest.approx(20.0, rel=0.01)
+
+    asyncio.run(run())
+
+
+def test_token_bucket_limits_large_requests():
+    limiter = _limiter(input_tokens_per_minute=1_000)
+
+    async def run():
+        await limiter.acquire(900, 10)
+        # 900 of 1000 input tokens used: the next 500 need 400 more, at 1000/60 per second
+        assert limiter._buckets["input_tokens"].wait_for(500) == pytest.approx(24.0, rel=0.01)
+
+    asyncio.run(run())
+
+
+def test_settle_returns_unused_tokens():
+    limiter = _limiter(input_tokens_per_minute=1_000)
+
+    async def run():
+        await limiter.acquire(800, 100)
+        limiter.settle(800, 100, 200, 50)
+        assert limiter._buckets["input_tokens"].level == pytest.approx(800, abs=1)
+
+    asyncio.run(run())
+
+
+def test_retries_rate_limited_calls_then_succeeds():
+    limiter = _limiter()
+    attempts = []
+
+    async def make_request():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise _status_error(anthropic.RateLimitError, 429, retry_after="0")
+        return SimpleNamespace(usage=SimpleNamespace(input_tokens=5, output_tokens=5))
+
+    response, timing = asyncio.run(limiter.call(make_request, 10, 10))
+    assert response.usage.input_tokens == 5
+    assert timing["retries"] == 2
+    stats = limiter.stats()
+    assert stats["retries"] == 2 and stats["rate_limited"] == 2 and stats["calls"] == 1
+
+
+def test_rate_limit_pauses_every_caller():
+    limiter = _limiter()
+
+    async def run():
+        failed = asyncio.Event()
+
+        async def make_request():
+            if not failed.is_set():
+                failed.set()
+                raise _status_error(anthropic.RateLimitError, 429, retry_after="0.3")
+            return SimpleNamespace(usage=None)
+
+        first = asyncio.ensure_future(limiter.call(make_request, 10, 10))
+        await failed.wait()
+        # Another caller, not the one that got the 429, waits out the retry-after too
+        waited = await limiter.acquire(10, 10)
+        await first
+        return waited
+
+    assert asyncio.run(run()) >= 0.25
+
+
+def test_non_retryable_errors_are_raised_at_once():
+    limiter = _limiter()
+    attempts = []
+
+    async def make_request():
+        attempts.append(1)
+        raise _status_error(anthropic.BadRequestError, 400)
+
+    with pytest.raises(anthropic.BadRequestError):
+        asyncio.run(limiter.call(make_request, 10, 10))
+    assert len(attempts) == 1
+    # The failed attempt gave its tokens back
+    assert limiter._buckets["input_tokens"].level == pytest.approx(60_000, abs=1)
@@ -0,0 +1,27 @@
+"""IncrementalItemParser: items and the compact column header while the reply streams."""
+from streaming_json import IncrementalItemParser
+
+
+def _feed(parser, text):
+    out = []
+    for ch in text:
+        out += parser.feed(ch)
+    return out
+
+
+def test_compact_header_is_captured_before_rows():
+    parser = IncrementalItemParser("i", header_key="c")
+    text = '```json\n{"m":{"note":"[x]"},"c":["total","description"],"i":[[7,"Tom[a]to"],[3,"B"]]}'
+
+    rows = _feed(parser, text)
+
+    assert parser.header == ["total", "description"]
+    assert rows == [[7, "Tom[a]to"], [3, "B"]]
+    assert parser.finished
+
+
+def test_header_is_ignored_without_header_key():
+    parser = IncrementalItemParser("items")
+
+    assert _feed(parser, '{"c":["x"],"items":[{"total":1}]}') == [{"total": 1}]
+    assert parser.header is None
@@ -0,0 +1,171 @@
+"""UploadReader: size limit while bytes arrive, spooling, memory accounting."""
+import asyncio
+from pathlib import Path
+
+import pytest
+
+import upload_stream
+from invoice_source import InMemoryInvoice
+from upload_stream import MB, RejectedUpload, UploadError, UploadReader
+
+BOUNDARY = b"testboundary"
+
+
+class _Request:
+    """The two things UploadReader reads from a Starlette request."""
+
+    def __init__(self, files, chunk_size=64 * 1024, content_type=None):
+        self.headers = {"content-type": content_type or f"multipart/form-data; boundary={BOUNDARY.decode()}"}
+        body = b""
+        for name, data in files:
+            body += (
+                b"--" + BOUNDARY + b"\r\n"
+                + b'Content-Disposition: form-data; name="files"; filename="' + name.encode() + b'"\r\n'
+                + b"Content-Type: application/octet-stream\r\n\r\n" + data + b"\r\n"
+            )
+        body += b"--" + BOUNDARY + b"--\r\n"
+        self._chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+
+    async def stream(self):
+        for chunk in self._chunks:
+            yield chunk
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(upload_stream.settings, "max_file_size_mb", 1)
+    monkeypatch.setattr(upload_stream.settings, "upload_spool_threshold_mb", 1)
+    monkeypatch.setattr(upload_stream.settings, "upload_request_memory_mb", 1)
+
+
+def _read(reader):
+    async def run():
+        return [upload async for upload in reader]
+
+    return asyncio.run(run())
+
+
+def test_oversized_file_is_rejected_and_others_kept(limits):
+    reader = UploadReader(_Request([
+        ("a.pdf", b"a" * 1000),
+        ("big.pdf", b"b" * (MB + 1)),
+        ("c.png", b"c" * 1000),
+    ]), allowed_extensions=(".pdf", ".png"))
+    try:
+        uploads = _read(reader)
+        assert [type(u) for u in uploads] == [InMemoryInvoice, RejectedUpload, InMemoryInvoice]
+        assert uploads[1].filename == "big.pdf" and "MAX_FILE_SIZE_MB" in uploads[1].error
+        assert uploads[1].too_large
+        assert uploads[2].read_bytes() == b"c" * 1000
+        stats = reader.stats()
+        assert stats["complete"] and stats["files"] == 3 and stats["rejected_files"] == 1
+        # The oversized file was never held beyond the limit
+        assert stats["peak_memory_bytes"] <= MB
+    finally:
+        reader.close()
+
+
+def test_files_beyond_the_memory_budget_are_spooled(limits):
+    reader = UploadReader(_Request([
+        ("a.pdf", b"a" * (400 * 1024)),
+        ("b.pdf", b"b" * (400 * 1024)),
+    ]), allowed_extensions=(".pdf",))
+    try:
+        first, second = _read(reader)
+        assert isinstance(first, InMemoryInvoice)
+        # a.pdf is still held (not released), so b.pdf does not fit the 1 MB budget
+        assert isinstance(second, Path) and second.read_bytes() == b"b" * (400 * 1024)
+        assert reader.stats()["spooled_files"] == 1
+        assert reader.stats()["peak_memory_bytes"] <= MB
+    finally:
+        reader.close()
+    assert not second.exists()
+
+
+def test_release_frees_the_budget_for_later_files(limits):
+    reader = UploadReader(_Request([
+        ("a.pdf", b"a" * (400 * 1024)),
+        ("b.pdf", b"b" * (400 * 1024)),
+    ], chunk_size=16 * 1024), allowed_extensions=(".pdf",))
+
+    async def run():
+        uploads = []
+        async for upload in reader:
+            uploads.append(upload)
+            reader.release(upload)  # processed at once
+        return uploads
+
+    try:
+        uploads = asyncio.run(run())
+        assert all(isinstance(u, InMemoryInvoice) for u in uploads)
+        assert reader.stats()["spooled_files"] == 0
+        assert reader.stats()["memory_bytes"] == 0
+    finally:
+        reader.close()
+
+
+def test_max_files_and_unsupported_types(limits):
+    reader = UploadReader(_Request([
+        ("a.pdf", b"a"),
+        ("notes.txt", b"skip me"),
+        ("b.pdf", b"b"),
+        ("c.pdf", b"c"),
+    ]), allowed_extensions=(".pdf",), max_files=2)
+    try:
+        uploads = _read(reader)
+        assert [getattr(u, "name", None) or u.filename for u in uploads] == ["a.pdf", "b.pdf", "c.pdf"]
+        assert isinstance(uploads[2], RejectedUpload) and "/api/jobs" in uploads[2].error
+    finally:
+        reader.close()
+
+
+def test_non_multipart_body_raises_upload_error(limits):
+    reader = UploadReader(_Request([], content_type="application/json"), allowed_extensions=(".pdf",))
+    try:
+        with pytest.raises(UploadError):
+            _read(reader)
+    finally:
+        reader.close()
+
+
+def test_close_returns_process_wide_memory(limits):
+    before = upload_stream.upload_stats()
+    reader = UploadReader(_Request([("a.pdf", b"a" * 1000)]), allowed_extensions=(".pdf",))
+    _read(reader)
+    assert upload_stream.upload_stats()["in_memory_bytes"] == before["in_memory_bytes"] + 1000
+    reader.close()
+    reader.close()  # idempotent
+    after = upload_stream.upload_stats()
+    assert after["in_memory_bytes"] == before["in_memory_bytes"]
+    assert after["requests_active"] == before["requests_active"]
+
+
+def test_unsupported_files_are_skipped_by_name(limits):
+    reader = UploadReader(_Request([
+        ("notes.txt", b"n" * 1000),
+        ("a.pdf", b"a" * 1000),
+    ]), allowed_extensions=(".pdf",))
+    try:
+        uploads = _read(reader)
+        assert [u.name for u in uploads] == ["a.pdf"]
+        assert reader.skipped == ["notes.txt"]
+    finally:
+        reader.close()
+
+
+def test_destination_receives_every_file_on_disk(limits, tmp_path):
+    reader = UploadReader(_Request([
+        ("a.pdf", b"a" * 1000),
+        ("big.pdf", b"b" * (MB + 1)),
+        ("c.png", b"c" * 1000),
+    ]), allowed_extensions=(".pdf", ".png"), destination=tmp_path / "job")
+    try:
+        first, rejected, second = _read(reader)
+        assert first == tmp_path / "job" / "0" / "a.pdf" and first.read_bytes() == b"a" * 1000
+        assert second.parent.parent == tmp_path / "job" and second.read_bytes() == b"c" * 1000
+        assert isinstance(rejected, RejectedUpload) and rejected.too_large
+        assert reader.stats()["peak_memory_bytes"] == 0
+    finally:
+        reader.close()
+    # The caller owns the files; the oversized one left nothing behind
+    assert sorted(p.name for p in (tmp_path / "job").rglob("*.*")) == ["a.pdf", "c.png"]
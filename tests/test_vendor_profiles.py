@@ -0,0 +1,68 @@
+"""parse_text_layer and the local parser's trust rules."""
+from models import InvoiceData, InvoiceItem
+from vendor_profiles import CELL_SEPARATOR, VendorProfile, VendorProfileStore, parse_text_layer
+
+COLUMNS = ["Description", "Unit", "Qty", "Rate", "Amount"]
+
+
+def _profile(**overrides) -> VendorProfile:
+    fields = dict(
+        vendor_key="al noor vegetables",
+        vendor_name="Al Noor Vegetables Trading LLC",
+        columns=COLUMNS,
+        column_fields={"description": 0, "unit": 1, "quantity": 2, "unit_price": 3, "total": 4},
+        labels={"invoice_number": "Invoice No:", "subtotal": "Subtotal:"},
+        currency="AED",
+        vat_convention="net",
+    )
+    fields.update(overrides)
+    return VendorProfile(**fields)
+
+
+def _page(rows, subtotal) -> str:
+    lines = ["Al Noor Vegetables Trading LLC", "Invoice No: INV-7", CELL_SEPARATOR.join(COLUMNS)]
+    lines += [CELL_SEPARATOR.join(row) for row in rows]
+    lines.append(f"Subtotal: {subtotal}")
+    return "\n".join(lines)
+
+
+ROWS = [
+    ["Fresh Tomato Roma", "kg", "3", "3.50", "10.50"],
+    ["Red Onion Large", "kg", "5", "2.25", "11.25"],
+]
+
+
+def test_parses_rows_with_the_learned_layout():
+    data = parse_text_layer(_profile(), _page(ROWS, "21.75"))
+    assert data is not None
+    assert [(i.description, i.unit, i.quantity, i.unit_price, i.total) for i in data.items] == [
+        ("Fresh Tomato Roma", "kg", 3.0, 3.5, 10.5),
+        ("Red Onion Large", "kg", 5.0, 2.25, 11.25),
+    ]
+    assert data.invoice_number == "INV-7" and data.subtotal == 21.75 and data.currency == "AED"
+    # No model read these rows: no confidence is made up for them
+    assert all(i.llm_confidence is None for i in data.items)
+
+
+def test_rejects_rows_that_do_not_add_up():
+    rows = ROWS + [["Garlic Peeled", "pc", "3", "1.50", "4.00"]]
+    assert parse_text_layer(_profile(), _page(rows, "25.75")) is None
+
+
+def test_rejects_a_subtotal_mismatch():
+    # A row went missing or was misread: let Claude read the page
+    assert parse_text_layer(_profile(), _page(ROWS, "30.00")) is None
+
+
+def test_rejects_an_unknown_header():
+    text = _page(ROWS, "21.75").replace("Rate", "Price" + CELL_SEPARATOR + "Disc")
+    assert parse_text_layer(_profile(), text) is None
+
+
+def test_local_parser_needs_the_setting_and_enough_matches(tmp_path):
+    trusted = _profile(local_matches=2)
+    assert not VendorProfileStore(tmp_path / "a.sqlite3").local_trusted(trusted)
+    store = VendorProfileStore(tmp_path / "b.sqlite3", local_min_matches=2, local_parser_enabled=True)
+    assert store.local_trusted(trusted)
+    assert not store.local_trusted(_profile(local_matches=1))
+    assert not store.local_trusted(_profile(local_matches=2, columns=[]))
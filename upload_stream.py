@@ -0,0 +1,325 @@
+"""Streaming multipart uploads for the processing endpoints.
+
+`files: List[UploadFile] = File(...)` only reaches the endpoint once the whole request
+body has been received and copied into spooled temporary files, and nothing checked
+settings.max_file_size_mb. `UploadReader` parses the body as it arrives instead:
+- every file is checked against max_file_size_mb while its bytes come in; an oversized
+  file stops being buffered at once (the rest of it is read off the wire and dropped)
+  and is reported as a `RejectedUpload`
+- a file is handed over as soon as its last byte has arrived, so processing starts
+  while later files are still uploading
+- files stay in memory (InMemoryInvoice) up to upload_spool_threshold_mb each and
+  upload_request_memory_mb per request; anything beyond is written to a temporary file
+  chunk by chunk
+- with a `destination` (background jobs), every file is written chunk by chunk to
+  `destination/<n>/<filename>` instead and left there for the caller
+
+Bytes held in memory count against the request until the caller `release`s the file
+(after its result is in), so a request never holds much more than its budget. Per
+request numbers come from `UploadReader.stats()`, process-wide ones from
+`upload_stats()` (/api/diagnostics).
+"""
+import asyncio
+import shutil
+import tempfile
+import threading
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Any, AsyncIterator, BinaryIO, Callable, Dict, List, Optional, Sequence, Union
+
+from config import settings
+from invoice_source import InMemoryInvoice, InvoiceSource
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
+
+MB = 1024 * 1024
+
+
+class UploadError(ValueError):
+    """The request body is not a readable multipart upload."""
+
+
+@dataclass
+class RejectedUpload:
+    """A file that was not kept (too large, or past the per-request file limit)."""
+    filename: str
+    error: str
+    too_large: bool = False
+
+
+@dataclass
+class _Part:
+    filename: Optional[str] = None
+    skip: bool = True  # form fields and unsupported file types
+    size: int = 0
+    buffer: Optional[bytearray] = None
+    file: Optional[BinaryIO] = None
+    path: Optional[Path] = None
+    error: Optional[str] = None
+    too_large: bool = False
+
+
+class _Totals:
+    """Process-wide upload counters."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stats: Dict[str, float] = {
+            "requests_active": 0,
+            "in_memory_bytes": 0,
+            "peak_in_memory_bytes": 0,
+            "bytes_received": 0,
+            "files": 0,
+            "spooled_files": 0,
+            "rejected_files": 0,
+        }
+
+    def add(self, **deltas: int) -> None:
+        with self._lock:
+            for name, value in deltas.items():
+                self._stats[name] += value
+            self._stats["peak_in_memory_bytes"] = max(
+                self._stats["peak_in_memory_bytes"], self._stats["in_memory_bytes"]
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats)
+
+
+_totals = _Totals()
+
+
+def upload_stats() -> Dict[str, Any]:
+    """Process-wide streaming upload counters (bytes held in memory now and at peak)."""
+    return _totals.stats()
+
+
+class UploadReader:
+    """Incremental multipart parser; iterate it for InvoiceSource / RejectedUpload items
+    in upload order, `release` each source once processed, `close` when done. Files of
+    other types are not read; their names are collected in `skipped`."""
+
+    def __init__(
+        self,
+        request: Any,
+        allowed_extensions: Sequence[str],
+        max_files: Optional[int] = None,
+        destination: Optional[Path] = None,
+    ):
+        self.request = request
+        self.allowed_extensions = tuple(allowed_extensions)
+        self.max_files = max_files
+        self.destination = Path(destination) if destination is not None else None
+        self._stored = 0  # files written under destination
+        self.max_file_bytes = settings.max_file_size_mb * MB
+        self.spool_threshold = settings.upload_spool_threshold_mb * MB
+        self.memory_budget = settings.upload_request_memory_mb * MB
+        self.complete = False
+        self.finished = asyncio.Event()  # the body has been read (or reading failed)
+        self.skipped: List[str] = []
+        self._closed = False
+        self._stats: Dict[str, int] = {
+            "files": 0,
+            "bytes_received": 0,
+            "spooled_files": 0,
+            "rejected_files": 0,
+            "memory_bytes": 0,
+            "peak_memory_bytes": 0,
+        }
+        self._held: Dict[int, int] = {}  # id(InMemoryInvoice) -> bytes counted
+        self._spool_dirs: List[Path] = []
+        self._part = _Part()
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._io: List[Callable[[], Any]] = []  # file writes queued by the parser callbacks
+        self._ready: List[Union[InvoiceSource, RejectedUpload]] = []
+        _totals.add(requests_active=1)
+
+    def _hold(self, n: int) -> None:
+        self._stats["memory_bytes"] += n
+        self._stats["peak_memory_bytes"] = max(self._stats["peak_memory_bytes"], self._stats["memory_bytes"])
+        _totals.add(in_memory_bytes=n)
+
+    # python-multipart callbacks (synchronous; file I/O is queued for a worker thread)
+
+    def _on_part_begin(self) -> None:
+        self._part = _Part()
+        self._disposition = b""
+
+    def _on_header_field(self, data: bytes, start: int, end: int) -> None:
+        self._header_name += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int) -> None:
+        self._header_value += data[start:end]
+
+    def _on_header_end(self) -> None:
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = self._header_value = b""
+
+    def _on_headers_finished(self) -> None:
+        _, options = parse_options_header(self._disposition)
+        if b"filename" not in options:
+            return  # a plain form field
+        part = self._part
+        part.filename = Path(options[b"filename"].decode("utf-8", "replace")).name
+        if not part.filename.lower().endswith(self.allowed_extensions):
+            self.skipped.append(part.filename)
+            return
+        part.skip = False
+        self._stats["files"] += 1
+        _totals.add(files=1)
+        if self.max_files is not None and self._stats["files"] > self.max_files:
+            part.error = f"More than {self.max_files} files in one request; use /api/jobs"
+        elif self.destination is not None:
+            self._store(part)
+        else:
+            part.buffer = bytearray()
+
+    def _on_part_data(self, data: bytes, start: int, end: int) -> None:
+        n = end - start
+        self._stats["bytes_received"] += n
+        _totals.add(bytes_received=n)
+        part = self._part
+        if part.skip or part.error is not None:
+            return
+        part.size += n
+        if part.size > self.max_file_bytes:
+            part.error = f"File exceeds MAX_FILE_SIZE_MB ({settings.max_file_size_mb} MB)"
+            part.too_large = True
+            self._drop(part)
+            return
+        chunk = data[start:end]
+        # Room for the buffer plus its copy into bytes when the part ends (see _on_part_end)
+        if part.file is None and (
+            part.size > self.spool_threshold or self._stats["memory_bytes"] + n + part.size > self.memory_budget
+        ):
+            self._spool(part)
+        if part.file is not None:
+            self._io.append(partial(part.file.write, chunk))
+        else:
+            part.buffer.extend(chunk)
+            self._hold(n)
+
+    def _on_part_end(self) -> None:
+        part = self._part
+        if part.skip:
+            return
+        if part.error is not None:
+            self._stats["rejected_files"] += 1
+            _totals.add(rejected_files=1)
+            self._ready.append(RejectedUpload(part.filename, part.error, part.too_large))
+        elif part.file is not None:
+            self._io.append(part.file.close)
+            self._ready.append(part.path)
+        else:
+            size = len(part.buffer)
+            self._hold(size)  # bytes() copies the buffer for a moment
+            source = InMemoryInvoice(part.filename, bytes(part.buffer))
+            part.buffer = None
+            self._hold(-size)
+            self._held[id(source)] = size
+            self._ready.append(source)
+
+    def _spool(self, part: _Part) -> None:
+        """Move a file that outgrew the memory limits to a temporary file."""
+        spool_dir = Path(tempfile.mkdtemp(prefix="invoice-upload-"))
+        self._spool_dirs.append(spool_dir)
+        part.path = spool_dir / part.filename
+        part.file = open(part.path, "wb")
+        if part.buffer:
+            self._io.append(partial(part.file.write, bytes(part.buffer)))
+            self._hold(-len(part.buffer))
+        part.buffer = None
+        self._stats["spooled_files"] += 1
+        _totals.add(spooled_files=1)
+
+    def _store(self, part: _Part) -> None:
+        """Write a file straight to its own directory under `destination`."""
+        part.path = self.destination / str(self._stored) / part.filename
+        self._stored += 1
+        part.path.parent.mkdir(parents=True, exist_ok=True)
+        part.file = open(part.path, "wb")
+
+    def _drop(self, part: _Part) -> None:
+        if part.buffer is not None:
+            self._hold(-len(part.buffer))
+            part.buffer = None
+        if part.file is not None:
+            self._io.append(part.file.close)
+            self._io.append(partial(shutil.rmtree, part.path.parent, True))
+            part.file = None
+
+    async def _flush_io(self) -> None:
+        if self._io:
+            ops, self._io = self._io, []
+            await asyncio.to_thread(lambda: [op() for op in ops])
+
+    def __aiter__(self) -> AsyncIterator[Union[InvoiceSource, RejectedUpload]]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[Union[InvoiceSource, RejectedUpload]]:
+        _, params = parse_options_header(self.request.headers.get("content-type", ""))
+        boundary = params.get(b"boundary")
+        if not boundary:
+            self.finished.set()
+            raise UploadError("Expected a multipart/form-data upload")
+        parser = multipart.MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+        try:
+            async for chunk in self.request.stream():
+                parser.write(chunk)
+                await self._flush_io()
+                while self._ready:
+                    yield self._ready.pop(0)
+            parser.finalize()
+        except FormParserError as e:
+            raise UploadError(f"Malformed multipart upload: {e}") from e
+        finally:
+            self.finished.set()
+        await self._flush_io()
+        while self._ready:
+            yield self._ready.pop(0)
+        self.complete = True
+
+    def release(self, source: InvoiceSource) -> None:
+        """Done with a file: stop counting its bytes, delete it if it was spooled."""
+        held = self._held.pop(id(source), 0)
+        if held:
+            self._hold(-held)
+        if isinstance(source, Path):
+            shutil.rmtree(source.parent, ignore_errors=True)
+
+    def close(self) -> None:
+        """Delete leftover temporary files and return unreleased memory accounting."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._part.file is not None and not self._part.file.closed:
+            self._part.file.close()
+        for spool_dir in self._spool_dirs:
+            shutil.rmtree(spool_dir, ignore_errors=True)
+        self._hold(-self._stats["memory_bytes"])
+        self._held.clear()
+        _totals.add(requests_active=-1)
+
+    def stats(self) -> Dict[str, Any]:
+        """This request's upload numbers (peak_memory_bytes is bounded by the budget)."""
+        return {**self._stats, "memory_budget_bytes": self.memory_budget, "complete": self.complete}
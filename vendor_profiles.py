@@ -0,0 +1,447 @@
+"""Vendor layout memory for repeat suppliers.
+
+Most invoices come from a few dozen suppliers whose layouts never change, yet every
+extraction re-explains column detection from scratch. A VendorProfile remembers, per
+normalized vendor name:
+- the line-item table header and which column holds description / quantity /
+  unit price / net total / unit (learned from born-digital PDF text layers)
+- units seen, currency and the VAT convention (line totals net or VAT-inclusive)
+- the labels printed next to invoice number, date and totals
+
+Known vendors get a short vendor-specific prompt. With vendor_local_parser_enabled, the
+profile can also parse digital PDFs' text layer locally (no Claude call), but only after
+the local parse has reproduced Claude's own extraction `vendor_local_parser_min_matches`
+times in a row. Locally parsed items carry no llm_confidence (no model read them) and
+the result is flagged `locally_parsed`.
+
+Profiles live in a small SQLite table (one JSON row per vendor, all loaded in memory).
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from pydantic import BaseModel, Field
+
+from config import settings
+from models import InvoiceData, InvoiceItem
+from row_repair import HEADER_WORDS
+
+TABLE_FIELDS = ("description", "quantity", "unit_price", "total", "unit")
+LABEL_FIELDS = ("invoice_number", "invoice_date", "subtotal", "tax", "total_amount")
+TOTALS_WORDS = {"subtotal", "total", "vat", "tax", "gross", "net", "discount", "balance"}
+LEGAL_SUFFIXES = {
+    "llc", "l", "c", "fze", "fzco", "fzc", "ltd", "limited", "co", "company", "est",
+    "establishment", "trading", "inc", "plc", "the",
+}
+CELL_SEPARATOR = " | "
+
+
+class VendorProfile(BaseModel):
+    """Everything remembered about one supplier's invoice layout."""
+    vendor_key: str
+    vendor_name: str
+    layout_fingerprint: Optional[str] = None
+    columns: List[str] = Field(default_factory=list, description="Table header cells, left to right")
+    column_fields: Dict[str, int] = Field(
+        default_factory=dict, description="Field -> header cell index (description, quantity, ...)"
+    )
+    labels: Dict[str, str] = Field(
+        default_factory=dict, description="Field -> text printed before its value (invoice_number, ...)"
+    )
+    units: List[str] = Field(default_factory=list)
+    currency: Optional[str] = None
+    vat_convention: str = Field("unknown", description="net | gross | unknown (printed line totals)")
+    vat_rate: Optional[float] = None
+    invoices: int = 0
+    local_matches: int = Field(0, description="Consecutive invoices where the local parse matched Claude")
+    updated_at: float = 0.0
+
+    @property
+    def has_layout(self) -> bool:
+        return bool(self.columns) and all(f in self.column_fields for f in ("description", "quantity", "unit_price", "total"))
+
+
+def normalize_vendor(name: Optional[str]) -> str:
+    """Lowercase alphanumeric vendor key without legal-form suffixes."""
+    tokens = re.findall(r"[a-z0-9]+", (name or "").lower())
+    core = [t for t in tokens if t not in LEGAL_SUFFIXES]
+    return " ".join(core or tokens)
+
+
+def _tokens(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", (text or "").lower())
+
+
+def _number(cell: str) -> Optional[float]:
+    """The cell's value if it is a single number (currency codes/symbols allowed)."""
+    m = re.fullmatch(r"[^\d\-]*(-?\d[\d,]*(?:\.\d+)?)\s*[a-zA-Z%]*", cell.strip())
+    if not m:
+        return None
+    try:
+        return float(m.group(1).replace(",", ""))
+    except ValueError:
+        return None
+
+
+def _close(a: Optional[float], b: Optional[float]) -> bool:
+    return a is not None and b is not None and abs(a - b) <= max(0.011, 0.001 * abs(b))
+
+
+def _cells(line: str) -> List[str]:
+    return [c.strip() for c in line.split(CELL_SEPARATOR)]
+
+
+def _header_index(lines: Sequence[str]) -> Optional[int]:
+    for i, line in enumerate(lines):
+        cells = _cells(line)
+        if len(cells) >= 3 and len(set(_tokens(line)) & HEADER_WORDS) >= 2:
+            return i
+    return None
+
+
+def layout_fingerprint(page_text: str) -> Optional[str]:
+    """Hash of the normalized table header row of a text-layer page, if one is found."""
+    lines = page_text.splitlines()
+    idx = _header_index(lines)
+    if idx is None:
+        return None
+    header = "|".join(" ".join(_tokens(c)) for c in _cells(lines[idx]))
+    return hashlib.sha256(header.encode("utf-8")).hexdigest()[:16]
+
+
+def _is_totals_line(line: str, columns: int) -> bool:
+    return len(_cells(line)) != columns and bool(set(_tokens(line)) & TOTALS_WORDS)
+
+
+def _table_rows(lines: Sequence[str], header_idx: int, columns: int) -> Tuple[List[List[str]], bool]:
+    """Rows below the header with the header's cell count, and whether every numeric line
+    of the table had that shape (False = the layout does not fit this page)."""
+    rows: List[List[str]] = []
+    clean = True
+    for line in lines[header_idx + 1:]:
+        if _is_totals_line(line, columns):
+            break
+        cells = _cells(line)
+        if len(cells) == columns:
+            rows.append(cells)
+        elif sum(1 for c in cells if _number(c) is not None) >= 2:
+            clean = False
+    return rows, clean
+
+
+def _desc_score(description: str, cell: str) -> float:
+    desc = set(_tokens(description))
+    return len(desc & set(_tokens(cell))) / len(desc) if desc else 0.0
+
+
+def _learn_columns(lines: Sequence[str], items: Sequence[InvoiceItem]) -> Tuple[List[str], Dict[str, int]]:
+    """Header cells and field -> column index, by majority vote over Claude's items."""
+    header_idx = _header_index(lines)
+    if header_idx is None:
+        return [], {}
+    header = _cells(lines[header_idx])
+    rows, _ = _table_rows(lines, header_idx, len(header))
+    votes: Dict[str, Dict[int, int]] = {f: {} for f in TABLE_FIELDS}
+    matched = 0
+    for item in items:
+        best = max(
+            ((max(_desc_score(item.description, c) for c in row), row) for row in rows),
+            default=(0.0, None),
+            key=lambda pair: pair[0],
+        )
+        row = best[1]
+        if row is None or best[0] < 0.6:
+            continue
+        matched += 1
+        desc_col = max(range(len(row)), key=lambda i: _desc_score(item.description, row[i]))
+        votes["description"][desc_col] = votes["description"].get(desc_col, 0) + 1
+        for field in ("quantity", "unit_price", "total"):
+            for i, cell in enumerate(row):
+                if i != desc_col and _close(_number(cell), getattr(item, field)):
+                    votes[field][i] = votes[field].get(i, 0) + 1
+        if item.unit:
+            for i, cell in enumerate(row):
+                if cell.lower() == item.unit.lower():
+                    votes["unit"][i] = votes["unit"].get(i, 0) + 1
+
+    mapping: Dict[str, int] = {}
+    for field, counts in votes.items():
+        if counts:
+            col, n = max(counts.items(), key=lambda kv: kv[1])
+            if matched and n * 2 >= matched:
+                mapping[field] = col
+    # Quantity and unit price can coincide (qty 1); a layout needs distinct columns
+    numeric = [mapping.get(f) for f in ("quantity", "unit_price", "total")]
+    if None in numeric or len(set(numeric)) < 3:
+        return header, {k: v for k, v in mapping.items() if k in ("description", "unit")}
+    return header, mapping
+
+
+def _learn_labels(lines: Sequence[str], data: InvoiceData) -> Dict[str, str]:
+    """Text printed just before each metadata value on the same line."""
+    labels: Dict[str, str] = {}
+    for field in LABEL_FIELDS:
+        value = getattr(data, field)
+        if value is None or value == "":
+            continue
+        for line in lines:
+            if isinstance(value, str):
+                pos = line.find(value)
+                found = pos > 0
+            else:
+                m = next(
+                    (m for m in re.finditer(r"\d[\d,]*(?:\.\d+)?", line)
+                     if _close(float(m.group(0).replace(",", "")), float(value))),
+                    None,
+                )
+                pos = m.start() if m else -1
+                found = m is not None and pos > 0
+            if not found:
+                continue
+            label = line[:pos].split(CELL_SEPARATOR.strip())[-1].strip(" :#.-\t")
+            if _tokens(label):
+                labels[field] = label
+                break
+    return labels
+
+
+def _label_value(lines: Sequence[str], label: str) -> Optional[str]:
+    """Value printed after `label`; the label must start a line or a cell."""
+    pattern = re.compile(r"(?:^|\| )" + re.escape(label))
+    for line in lines:
+        m = pattern.search(line)
+        if m is None:
+            continue
+        rest = line[m.end():].lstrip(" :#.-|\t")
+        value = rest.split(CELL_SEPARATOR)[0].strip()
+        if value:
+            return value.split("  ")[0].strip()
+    return None
+
+
+def parse_text_layer(profile: VendorProfile, page_text: str) -> Optional[InvoiceData]:
+    """Parse a text-layer page with the vendor's learned layout.
+
+    Returns None (use Claude instead) unless the header is found, every table row has the
+    learned shape and every parsed row satisfies quantity × unit_price = total.
+    """
+    if not profile.has_layout:
+        return None
+    lines = page_text.splitlines()
+    header_idx = _header_index(lines)
+    if header_idx is None or len(_cells(lines[header_idx])) != len(profile.columns):
+        return None
+    rows, clean = _table_rows(lines, header_idx, len(profile.columns))
+    if not clean or not rows:
+        return None
+
+    fields = profile.column_fields
+    items: List[InvoiceItem] = []
+    for row in rows:
+        q, p, t = (_number(row[fields[f]]) for f in ("quantity", "unit_price", "total"))
+        description = row[fields["description"]]
+        if q is None and p is None and t is None:
+            continue  # wrapped description line or blank row
+        if q is None or p is None or t is None or not _tokens(description) or abs(q * p - t) > 0.01:
+            return None
+        unit = row[fields["unit"]] if "unit" in fields else None
+        items.append(InvoiceItem(
+            item_number=len(items) + 1,
+            description=description,
+            quantity=q,
+            unit_price=p,
+            total=t,
+            unit=unit or None,
+        ))
+    if not items:
+        return None
+
+    meta: Dict[str, Any] = {}
+    for field, label in profile.labels.items():
+        raw = _label_value(lines, label)
+        if raw is None:
+            continue
+        meta[field] = raw if field in ("invoice_number", "invoice_date") else _number(raw)
+    subtotal = meta.get("subtotal")
+    if subtotal is not None and profile.vat_convention == "net" and not _close(sum(i.total for i in items), subtotal):
+        return None  # rows missing or misread; let Claude read the page
+    return InvoiceData(
+        vendor_name=profile.vendor_name,
+        currency=profile.currency,
+        items=items,
+        **meta,
+    )
+
+
+def _same_items(a: Sequence[InvoiceItem], b: Sequence[InvoiceItem]) -> bool:
+    if len(a) != len(b) or not a:
+        return False
+    return all(
+        _close(x.quantity, y.quantity) and _close(x.unit_price, y.unit_price) and _close(x.total, y.total)
+        for x, y in zip(a, b)
+    )
+
+
+class VendorProfileStore:
+    """SQLite-backed profiles (all held in memory) plus per-process hit counters."""
+
+    def __init__(self, db_path: Path, local_min_matches: int = 2, local_parser_enabled: bool = False):
+        self.db_path = Path(db_path)
+        self.local_min_matches = local_min_matches
+        self.local_parser_enabled = local_parser_enabled
+        self._lock = threading.Lock()
+        self._profiles: Dict[str, VendorProfile] = {}
+        self._by_fingerprint: Dict[str, str] = {}
+        self._stats: Dict[str, int] = {"invoices": 0, "hits": 0, "local_pages": 0, "prompt_tokens_saved": 0}
+        self._vendor_stats: Dict[str, Dict[str, int]] = {}
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS vendor_profiles (
+                vendor_key TEXT PRIMARY KEY,
+                profile TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+        for (raw,) in self._conn.execute("SELECT profile FROM vendor_profiles"):
+            try:
+                profile = VendorProfile.model_validate_json(raw)
+            except ValueError:
+                continue
+            self._index(profile)
+
+    @classmethod
+    def from_settings(cls) -> "VendorProfileStore":
+        return cls(
+            db_path=Path(settings.vendor_profiles_path),
+            local_min_matches=settings.vendor_local_parser_min_matches,
+            local_parser_enabled=settings.vendor_local_parser_enabled,
+        )
+
+    def _index(self, profile: VendorProfile) -> None:
+        self._profiles[profile.vendor_key] = profile
+        if profile.layout_fingerprint:
+            self._by_fingerprint[profile.layout_fingerprint] = profile.vendor_key
+
+    def _save(self, profile: VendorProfile) -> None:
+        profile.updated_at = time.time()
+        self._index(profile)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO vendor_profiles (vendor_key, profile, updated_at) VALUES (?, ?, ?)",
+            (profile.vendor_key, profile.model_dump_json(), profile.updated_at),
+        )
+        self._conn.commit()
+
+    def lookup(self, page_text: Optional[str] = None, vendor_hint: Optional[str] = None) -> Tuple[Optional[VendorProfile], str]:
+        """Find the profile for a page: caller's vendor hint, layout fingerprint, or a known
+        vendor name in the page's first lines.
+
+        Returns:
+            (copy of the profile or None, how it matched: "hint" | "fingerprint" | "name" | "")
+        """
+        with self._lock:
+            if vendor_hint:
+                profile = self._profiles.get(normalize_vendor(vendor_hint))
+                if profile is not None:
+                    return profile.model_copy(deep=True), "hint"
+            if not page_text:
+                return None, ""
+            fp = layout_fingerprint(page_text)
+            if fp and fp in self._by_fingerprint:
+                return self._profiles[self._by_fingerprint[fp]].model_copy(deep=True), "fingerprint"
+            head = " " + " ".join(_tokens(" ".join(page_text.splitlines()[:15]))) + " "
+            for profile in self._profiles.values():
+                if f" {profile.vendor_key} " in head:
+                    return profile.model_copy(deep=True), "name"
+            return None, ""
+
+    def local_trusted(self, profile: VendorProfile) -> bool:
+        return self.local_parser_enabled and profile.has_layout and profile.local_matches >= self.local_min_matches
+
+    def record(self, vendor_name: Optional[str], profile_key: Optional[str], local_pages: int, tokens_saved: int) -> None:
+        """Count one processed invoice: its vendor, whether a profile was used, savings."""
+        key = profile_key or normalize_vendor(vendor_name)
+        with self._lock:
+            self._stats["invoices"] += 1
+            self._stats["hits"] += 1 if profile_key else 0
+            self._stats["local_pages"] += local_pages
+            self._stats["prompt_tokens_saved"] += tokens_saved
+            if not key:
+                return
+            vendor = self._vendor_stats.setdefault(
+                key, {"invoices": 0, "hits": 0, "local_pages": 0, "prompt_tokens_saved": 0}
+            )
+            vendor["invoices"] += 1
+            vendor["hits"] += 1 if profile_key else 0
+            vendor["local_pages"] += local_pages
+            vendor["prompt_tokens_saved"] += tokens_saved
+
+    def learn(self, data: InvoiceData, page_texts: Sequence[str]) -> Optional[VendorProfile]:
+        """Create or refresh the vendor's profile from a Claude extraction.
+
+        `page_texts` are the text-layer pages (empty for scans/photos: only units,
+        currency and VAT convention are learned then). The local parser is checked
+        against Claude's items here; only matching invoices count toward trusting it.
+        """
+        key = normalize_vendor(data.vendor_name)
+        if not key or not data.items:
+            return None
+        with self._lock:
+            profile = self._profiles.get(key) or VendorProfile(vendor_key=key, vendor_name=data.vendor_name)
+            profile = profile.model_copy(deep=True)
+            profile.invoices += 1
+            profile.currency = data.currency or profile.currency
+            profile.units = sorted({*profile.units, *(i.unit for i in data.items if i.unit)})[:20]
+
+            item_sum = sum(i.total or 0.0 for i in data.items)
+            if data.subtotal is not None and _close(item_sum, data.subtotal):
+                profile.vat_convention = "net"
+            elif data.total_amount is not None and data.tax and _close(item_sum, data.total_amount):
+                profile.vat_convention = "gross"
+            if data.subtotal and data.tax:
+                profile.vat_rate = round(data.tax / data.subtotal, 3)
+
+            if page_texts:
+                first = page_texts[0].splitlines()
+                if profile.has_layout:
+                    local_items: List[InvoiceItem] = []
+                    for text in page_texts:
+                        parsed = parse_text_layer(profile, text)
+                        local_items.extend(parsed.items if parsed is not None else [])
+                    profile.local_matches = profile.local_matches + 1 if _same_items(local_items, data.items) else 0
+                columns, mapping = _learn_columns(first, data.items)
+                if columns and len(mapping) >= len(profile.column_fields):
+                    if (columns, mapping) != (profile.columns, profile.column_fields):
+                        profile.local_matches = 0  # layout changed: trust has to be re-earned
+                    profile.columns, profile.column_fields = columns, mapping
+                    profile.layout_fingerprint = layout_fingerprint(page_texts[0])
+                profile.labels.update(_learn_labels(first, data))
+            self._save(profile)
+            return profile
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit rates and prompt tokens saved in this process, overall and per vendor."""
+        def rate(counts: Dict[str, int]) -> float:
+            return counts["hits"] / counts["invoices"] if counts["invoices"] else 0.0
+
+        with self._lock:
+            stats = dict(self._stats)
+            vendors = {
+                key: {
+                    **counts,
+                    "hit_rate": rate(counts),
+                    "invoices_learned": self._profiles[key].invoices if key in self._profiles else 0,
+                    "local_parser": key in self._profiles and self.local_trusted(self._profiles[key]),
+                }
+                for key, counts in self._vendor_stats.items()
+            }
+            profiles = len(self._profiles)
+        return {**stats, "hit_rate": rate(stats), "profiles": profiles, "vendors": vendors}